@@ -0,0 +1,368 @@
+"""
+In-process stand-ins for Discord and the Anthropic messages API used by the benchmarks.
+"""
+
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+import asyncio
+import datetime
+import itertools
+import random
+import re
+
+import anthropic
+
+_ids = itertools.count(1_000_000)
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class FakeUser:
+    def __init__(self, display_name: str, bot: bool = False):
+        self.id = next(_ids)
+        self.display_name = display_name
+        self.name = display_name
+        self.bot = bot
+        self.mention = f"<@{self.id}>"
+        self.mutual_guilds = []
+
+    def __repr__(self):
+        return self.display_name
+
+
+class FakeGuild:
+    def __init__(self, name: str):
+        self.id = next(_ids)
+        self.name = name
+        self.members: List[FakeUser] = []
+        self.text_channels: List["FakeChannel"] = []
+
+    def get_member(self, user_id: int) -> Optional[FakeUser]:
+        for member in self.members:
+            if member.id == user_id:
+                return member
+        return None
+
+    def __repr__(self):
+        return self.name
+
+
+class FakeMessage:
+    def __init__(
+        self,
+        channel: "FakeChannel",
+        author: FakeUser,
+        content: str,
+        mentions: List[FakeUser],
+    ):
+        self.id = next(_ids)
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.mentions = mentions
+        self.created_at = _now()
+
+
+class FakeChannel:
+    def __init__(self, name: str, guild: FakeGuild):
+        self.id = next(_ids)
+        self.name = name
+        self.guild = guild
+        self.messages: List[FakeMessage] = []
+        self.history_fetches = 0
+        guild.text_channels.append(self)
+
+    async def history(self, limit: int, oldest_first: bool, after: datetime.datetime):
+        self.history_fetches += 1
+        messages = [x for x in self.messages if x.created_at > after]
+        for message in list(reversed(messages))[:limit]:
+            yield message
+
+    def __repr__(self):
+        return f"#{self.name}"
+
+
+class BotChannelView:
+    """
+    A channel as seen by one bot, sending messages as that bot.
+    """
+
+    def __init__(self, channel: FakeChannel, user: FakeUser, gateway: "FakeGateway"):
+        self._channel = channel
+        self._user = user
+        self._gateway = gateway
+        self.id = channel.id
+        self.name = channel.name
+        self.guild = channel.guild
+
+    def history(self, **kwargs):
+        return self._channel.history(**kwargs)
+
+    @asynccontextmanager
+    async def typing(self):
+        yield
+
+    async def send(self, content: str):
+        await asyncio.sleep(self._gateway.send_latency)
+        mentioned_ids = {int(x) for x in re.findall(r"<@!?(\d+)>", content)}
+        mentions = [x for x in self.guild.members if x.id in mentioned_ids]
+        message = FakeMessage(self._channel, self._user, content, mentions)
+        self._gateway.on_reply(message)
+        self._gateway.dispatch(message)
+        return message
+
+
+class FakeGateway:
+    def __init__(self, send_latency: float = 0.05):
+        """
+        Delivers every message to every connected bot like the Discord gateway would.
+        """
+        self.send_latency = send_latency
+        self.services = []
+        self.channels: Dict[int, FakeChannel] = {}
+        self._views: Dict[tuple, BotChannelView] = {}
+        self.message_listeners: List[Callable[[FakeMessage], None]] = []
+        self.reply_listeners: List[Callable[[FakeMessage], None]] = []
+
+    def add_channel(self, channel: FakeChannel):
+        self.channels[channel.id] = channel
+
+    def connect(self, service, user: FakeUser, guilds: List[FakeGuild]):
+        """
+        Log a DiscordService in as the given user without a websocket.
+        """
+        service._connection.user = user
+        service.get_channel = lambda channel_id: self._view(channel_id, user)
+        service.get_partial_messageable = lambda channel_id: self._view(
+            channel_id, user
+        )
+        for guild in guilds:
+            guild.members.append(user)
+            user.mutual_guilds.append(guild)
+        if service.gateway is not None:
+            service.gateway.register(service)
+        if not service.send_only:
+            # Send-only clients get their mentions from the shared gateway listener
+            self.services.append(service)
+            # As on_ready would
+            service._listening.set()
+
+    def _view(self, channel_id: int, user: FakeUser) -> BotChannelView:
+        key = (channel_id, user.id)
+        if key not in self._views:
+            self._views[key] = BotChannelView(self.channels[channel_id], user, self)
+        return self._views[key]
+
+    def dispatch(self, message: FakeMessage):
+        message.channel.messages.append(message)
+        for listener in self.message_listeners:
+            listener(message)
+        for service in self.services:
+            asyncio.create_task(service.on_message(message))
+
+    def on_reply(self, message: FakeMessage):
+        for listener in self.reply_listeners:
+            listener(message)
+
+
+class FakeAnthropicBackend:
+    def __init__(
+        self,
+        latency: float = 1.0,
+        latency_jitter: float = 0.3,
+        error_rate: float = 0.0,
+        overload_rate: float = 0.0,
+        timeout_rate: float = 0.0,
+        ping_chance: float = 0.0,
+        ping_names: Optional[List[str]] = None,
+        batch_latency: float = 5.0,
+    ):
+        """
+        Stand-in for AsyncAnthropic with configurable latency and error rates.
+
+        Args:
+            error_rate: Chance of a 500 error
+            overload_rate: Chance of a 529 overloaded error
+            timeout_rate: Chance of a timeout
+            ping_chance: Chance the reply pings one of ping_names
+            batch_latency: Time a Message Batch takes to end
+        """
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.overload_rate = overload_rate
+        self.timeout_rate = timeout_rate
+        self.ping_chance = ping_chance
+        self.ping_names = ping_names or []
+        self.batch_latency = batch_latency
+        self.calls = 0
+        self.batch_requests = 0
+        self.errors = 0
+        self.input_characters = 0
+        self.messages = _FakeMessages(self)
+
+    @staticmethod
+    def _status_error(status_code: int) -> anthropic.APIStatusError:
+        response = SimpleNamespace(request=None, status_code=status_code, headers={})
+        return anthropic.APIStatusError(
+            f"Fake error {status_code}", response=response, body=None
+        )
+
+    def _reply_text(self) -> str:
+        text = "That is an interesting question. I would rather talk about myself."
+        if self.ping_names and random.random() < self.ping_chance:
+            text += f" What do you think @{random.choice(self.ping_names)} ?"
+        return text
+
+    async def _complete(self, batched: bool = False, **kwargs) -> SimpleNamespace:
+        if batched:
+            self.batch_requests += 1
+        else:
+            self.calls += 1
+        self.input_characters += len(str(kwargs.get("system", ""))) + sum(
+            len(str(x["content"])) for x in kwargs["messages"]
+        )
+        if not batched:
+            # Batches take batch_latency as a whole
+            await asyncio.sleep(
+                max(0.0, random.gauss(self.latency, self.latency_jitter))
+            )
+
+        roll = random.random()
+        if roll < self.timeout_rate:
+            self.errors += 1
+            raise anthropic.APITimeoutError(None)
+        roll -= self.timeout_rate
+        if roll < self.overload_rate:
+            self.errors += 1
+            raise self._status_error(529)
+        roll -= self.overload_rate
+        if roll < self.error_rate:
+            self.errors += 1
+            raise self._status_error(500)
+
+        text = self._reply_text()
+        system = kwargs.get("system", "")
+        if not isinstance(system, str):
+            system = "".join(x["text"] for x in system)
+        if "The participants you write for:" in system:
+            # Multi persona completion, answer as every participant
+            text = "".join(
+                f'<reply name="{name}">{self._reply_text()}</reply>\n'
+                for name in self.ping_names
+                if f"\n{name}: " in system or f":\n{name}: " in system
+            )
+        return SimpleNamespace(
+            content=[SimpleNamespace(text=text)],
+            usage=SimpleNamespace(
+                input_tokens=self.input_characters // 4,
+                output_tokens=len(text) // 4,
+                cache_read_input_tokens=0,
+                cache_creation_input_tokens=0,
+            ),
+        )
+
+
+class _FakeRawResponse:
+    def __init__(self, response: SimpleNamespace):
+        self.headers = {}
+        self._response = response
+
+    async def parse(self) -> SimpleNamespace:
+        return self._response
+
+
+class _FakeRawMessages:
+    def __init__(self, backend: FakeAnthropicBackend):
+        self._backend = backend
+
+    async def create(self, **kwargs) -> _FakeRawResponse:
+        return _FakeRawResponse(await self._backend._complete(**kwargs))
+
+
+class _FakeStream:
+    def __init__(self, backend: FakeAnthropicBackend, kwargs: dict):
+        self._backend = backend
+        self._kwargs = kwargs
+        self._response = None
+
+    async def __aenter__(self):
+        self._response = await self._backend._complete(**self._kwargs)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    @property
+    async def text_stream(self):
+        for word in self._response.content[0].text.split(" "):
+            await asyncio.sleep(0.01)
+            yield word + " "
+
+    async def get_final_message(self) -> SimpleNamespace:
+        return self._response
+
+
+class _FakeBatches:
+    def __init__(self, backend: FakeAnthropicBackend):
+        """
+        Message Batches processed in the background, ending after the batch latency.
+        """
+        self._backend = backend
+        # Batch id to the task completing its requests
+        self._batches: Dict[str, asyncio.Task] = {}
+
+    async def _process(self, requests: List[dict]) -> List[SimpleNamespace]:
+        await asyncio.sleep(self._backend.batch_latency)
+        results = []
+        for request in requests:
+            try:
+                message = await self._backend._complete(
+                    batched=True, **request["params"]
+                )
+                result = SimpleNamespace(type="succeeded", message=message)
+            except anthropic.APIError:
+                result = SimpleNamespace(type="errored")
+            results.append(
+                SimpleNamespace(custom_id=request["custom_id"], result=result)
+            )
+        return results
+
+    async def create(self, requests: List[dict]) -> SimpleNamespace:
+        batch_id = f"msgbatch_{next(_ids)}"
+        self._batches[batch_id] = asyncio.create_task(self._process(requests))
+        return SimpleNamespace(id=batch_id, processing_status="in_progress")
+
+    async def retrieve(self, batch_id: str) -> SimpleNamespace:
+        done = self._batches[batch_id].done()
+        return SimpleNamespace(
+            id=batch_id, processing_status="ended" if done else "in_progress"
+        )
+
+    async def results(self, batch_id: str):
+        results = self._batches[batch_id].result()
+
+        async def entries():
+            for result in results:
+                yield result
+
+        return entries()
+
+    async def cancel(self, batch_id: str):
+        self._batches.pop(batch_id).cancel()
+
+
+class _FakeMessages:
+    def __init__(self, backend: FakeAnthropicBackend):
+        self._backend = backend
+        self.with_raw_response = _FakeRawMessages(backend)
+        self.batches = _FakeBatches(backend)
+
+    async def create(self, **kwargs) -> SimpleNamespace:
+        return await self._backend._complete(**kwargs)
+
+    def stream(self, **kwargs) -> _FakeStream:
+        return _FakeStream(self._backend, kwargs)
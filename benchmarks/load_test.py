@@ -0,0 +1,248 @@
+"""
+Offline load test of the mention-to-reply pipeline.
+
+Drives the real BotFactory/BotService wiring with a fake Discord gateway and a fake
+Anthropic backend, so no tokens from private_data.json are needed.
+
+Run from the repository root:
+    python -m benchmarks.load_test --duration 60 --mentions-per-second 2
+"""
+
+from typing import Dict, List, Tuple
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import src.bot_factory
+import src.chat
+from src.bot_factory import BotFactory
+from src.chat_scheduler import DEFAULT_LANE_SHARES
+from src.log import configure_logging, stop_logging
+from src.personality import CustomPersonality
+from benchmarks.fakes import (
+    FakeAnthropicBackend,
+    FakeChannel,
+    FakeGateway,
+    FakeGuild,
+    FakeMessage,
+    FakeUser,
+)
+
+
+def _percentile(values: List[float], percentile: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * percentile / 100))
+    return values[index]
+
+
+class LoadTestMetrics:
+    def __init__(self, bot_user_ids: List[int]):
+        self._bot_user_ids = set(bot_user_ids)
+        # (bot user id, channel id) to time of the oldest unanswered mention
+        self._pending_mentions: Dict[Tuple[int, int], float] = {}
+        self.mentions = 0
+        self.replies = 0
+        self.latencies: List[float] = []
+        self.loop_lags: List[float] = []
+
+    def on_message(self, message: FakeMessage):
+        for user in message.mentions:
+            if user.id not in self._bot_user_ids:
+                continue
+            self.mentions += 1
+            self._pending_mentions.setdefault(
+                (user.id, message.channel.id), time.monotonic()
+            )
+
+    def on_reply(self, message: FakeMessage):
+        self.replies += 1
+        mentioned_at = self._pending_mentions.pop(
+            (message.author.id, message.channel.id), None
+        )
+        if mentioned_at is not None:
+            self.latencies.append(time.monotonic() - mentioned_at)
+
+    async def monitor_loop_lag(self, interval: float = 0.05):
+        """
+        Measure how late the event loop wakes up a sleeping task.
+        """
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(interval)
+            self.loop_lags.append(time.monotonic() - start - interval)
+
+
+def _patch_private_data(backend: FakeAnthropicBackend):
+    """
+    Point the real wiring at the fakes instead of private_data.json and the API.
+    """
+    src.bot_factory.discord_token = lambda personality_name: "fake-token"
+    src.chat.anthropic_api_key = lambda: "fake-key"
+    src.chat.AsyncAnthropic = lambda **kwargs: backend
+
+
+async def _mention_storm(
+    gateway: FakeGateway,
+    channels: List[FakeChannel],
+    humans: List[FakeUser],
+    bot_users: List[FakeUser],
+    args: argparse.Namespace,
+):
+    interval = 1 / args.mentions_per_second
+    while True:
+        channel = random.choice(channels)
+        targets = random.sample(
+            bot_users, k=random.randint(1, min(args.max_pings, len(bot_users)))
+        )
+        content = " ".join(x.mention for x in targets) + " what is the meaning of life?"
+        gateway.dispatch(FakeMessage(channel, random.choice(humans), content, targets))
+        await asyncio.sleep(random.expovariate(1 / interval))
+
+
+async def run_load_test(args: argparse.Namespace):
+    bot_names = [f"Load Bot {i}" for i in range(args.bots)]
+    backend = FakeAnthropicBackend(
+        latency=args.llm_latency,
+        latency_jitter=args.llm_latency / 3,
+        error_rate=args.error_rate,
+        overload_rate=args.overload_rate,
+        timeout_rate=args.timeout_rate,
+        ping_chance=args.bot_ping_chance,
+        ping_names=bot_names,
+        batch_latency=args.batch_latency,
+    )
+    _patch_private_data(backend)
+
+    gateway = FakeGateway(send_latency=args.send_latency)
+    guild = FakeGuild("Load Test Guild")
+    channels = [FakeChannel(f"channel-{i}", guild) for i in range(args.channels)]
+    for channel in channels:
+        gateway.add_channel(channel)
+    humans = [FakeUser(f"Human {i}") for i in range(args.humans)]
+    guild.members.extend(humans)
+
+    factory = BotFactory(
+        calls_per_minute=args.calls_per_minute,
+        decay_chance_per_minute=args.decay_chance_per_minute,
+        max_concurrent_anthropic_calls=args.workers,
+        num_scheduler_workers=args.workers,
+        burst_capacity=args.burst_capacity,
+        stream_responses=args.stream,
+        shared_gateway=args.shared_gateway,
+        call_deadline_seconds=args.call_deadline,
+        recency_half_life_seconds=args.recency_half_life,
+        lane_shares=DEFAULT_LANE_SHARES if args.lanes else None,
+        max_bot_turns_per_channel=args.max_bot_turns,
+        state_path=args.state_path,
+        multi_persona=args.multi_persona,
+        batch_bot_mentions=args.batch_bot_mentions,
+        batch_submit_interval=args.batch_submit_interval,
+        batch_poll_interval=1,
+        hedge_requests=args.hedge,
+        prefetch_likely_calls=args.prefetch,
+        response_cache_ttl_seconds=args.response_cache_ttl,
+    )
+    bot_users = []
+    for name in bot_names:
+        bot = factory.create_bot(
+            CustomPersonality(name, "You are a load test bot.", larping_allowed=False)
+        )
+        user = FakeUser(name, bot=True)
+        gateway.connect(bot.discord_service, user, [guild])
+        bot_users.append(user)
+
+    metrics = LoadTestMetrics([x.id for x in bot_users])
+    gateway.message_listeners.append(metrics.on_message)
+    gateway.reply_listeners.append(metrics.on_reply)
+
+    tasks = [
+        asyncio.create_task(factory.run()),
+        asyncio.create_task(metrics.monitor_loop_lag()),
+        asyncio.create_task(_mention_storm(gateway, channels, humans, bot_users, args)),
+    ]
+    start = time.monotonic()
+    await asyncio.sleep(args.duration)
+    elapsed = time.monotonic() - start
+    await factory.stop()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    print(f"Duration:              {elapsed:.1f}s")
+    print(f"Bots / channels:       {args.bots} / {args.channels}")
+    print(f"Mentions:              {metrics.mentions}")
+    print(f"Replies:               {metrics.replies}")
+    print(
+        "Mention to reply:      "
+        f"p50 {_percentile(metrics.latencies, 50):.2f}s "
+        f"p99 {_percentile(metrics.latencies, 99):.2f}s "
+        f"({len(metrics.latencies)} answered)"
+    )
+    print(f"LLM calls per minute:  {backend.calls / elapsed * 60:.1f}")
+    print(f"LLM batch requests:    {backend.batch_requests}")
+    print(f"LLM errors:            {backend.errors}")
+    print(f"LLM input characters:  {backend.input_characters}")
+    print(
+        "Event loop lag:        "
+        f"p50 {_percentile(metrics.loop_lags, 50) * 1000:.1f}ms "
+        f"p99 {_percentile(metrics.loop_lags, 99) * 1000:.1f}ms "
+        f"max {max(metrics.loop_lags, default=0) * 1000:.1f}ms"
+    )
+    print(f"History REST fetches:  {sum(x.history_fetches for x in channels)}")
+    if metrics.latencies:
+        print(f"Mean latency:          {statistics.mean(metrics.latencies):.2f}s")
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--bots", type=int, default=10)
+    parser.add_argument("--channels", type=int, default=5)
+    parser.add_argument("--humans", type=int, default=20)
+    parser.add_argument("--mentions-per-second", type=float, default=2)
+    parser.add_argument("--max-pings", type=int, default=3)
+    parser.add_argument("--bot-ping-chance", type=float, default=0.1)
+    parser.add_argument("--calls-per-minute", type=float, default=120)
+    parser.add_argument("--decay-chance-per-minute", type=float, default=0.25)
+    parser.add_argument("--burst-capacity", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--shared-gateway", action="store_true")
+    parser.add_argument("--call-deadline", type=float, default=None)
+    parser.add_argument("--recency-half-life", type=float, default=None)
+    parser.add_argument("--lanes", action="store_true")
+    parser.add_argument("--max-bot-turns", type=int, default=None)
+    parser.add_argument("--state-path", default=None)
+    parser.add_argument("--multi-persona", action="store_true")
+    parser.add_argument("--batch-bot-mentions", action="store_true")
+    parser.add_argument("--batch-submit-interval", type=float, default=5)
+    parser.add_argument("--batch-latency", type=float, default=5)
+    parser.add_argument("--hedge", action="store_true")
+    parser.add_argument("--prefetch", type=int, default=0)
+    parser.add_argument("--response-cache-ttl", type=float, default=None)
+    parser.add_argument("--llm-latency", type=float, default=1.5)
+    parser.add_argument("--send-latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--overload-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-level", default="WARNING")
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+    random.seed(args.seed)
+    configure_logging(args.log_level)
+    try:
+        asyncio.run(run_load_test(args))
+    finally:
+        stop_logging()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Microbenchmark for the WeightedIndex implementations used by the WeightedKeySampler.
+
+Run from the repository root:
+    python -m benchmarks.weighted_index_benchmark
+"""
+
+import random
+import time
+from typing import Callable, List
+
+from src.chat_scheduler import AnthropicCall
+from src.weighted_index import DictWeightedIndex, FenwickWeightedIndex, WeightedIndex
+
+KEY_COUNTS = [1_000, 10_000, 50_000]
+OPERATIONS = 2_000
+
+
+def _build_keys(key_count: int) -> List[AnthropicCall]:
+    return [AnthropicCall(f"Personality {i % 10}", i) for i in range(key_count)]
+
+
+def _populate(index: WeightedIndex, keys: List[AnthropicCall]) -> None:
+    for key in keys:
+        index.add(key, random.randint(1, 5))
+
+
+def _time_per_operation(operation: Callable[[], None]) -> float:
+    start = time.perf_counter()
+    for _ in range(OPERATIONS):
+        operation()
+    return (time.perf_counter() - start) / OPERATIONS * 1_000_000
+
+
+def _benchmark_index(name: str, index: WeightedIndex, keys: List[AnthropicCall]):
+    _populate(index, keys)
+
+    def increment():
+        index.add(random.choice(keys), 1)
+
+    def sample_and_pop():
+        key = index.sample()
+        index.add(key, index.pop(key))
+
+    def evict_least_weighted():
+        key = index.least_weighted_key()
+        index.add(key, index.pop(key))
+
+    print(
+        f"{name:>10} | {len(keys):>7} keys | "
+        f"increment {_time_per_operation(increment):8.2f}us | "
+        f"sample+pop {_time_per_operation(sample_and_pop):8.2f}us | "
+        f"least weighted {_time_per_operation(evict_least_weighted):8.2f}us"
+    )
+
+
+def main():
+    random.seed(0)
+    for key_count in KEY_COUNTS:
+        keys = _build_keys(key_count)
+        _benchmark_index("dict", DictWeightedIndex(), keys)
+        _benchmark_index("fenwick", FenwickWeightedIndex(), keys)
+
+
+if __name__ == "__main__":
+    main()
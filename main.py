@@ -1,16 +1,31 @@
 from src.personality import PhilosophyPersonality, CustomPersonality, Personality
 from src.bot_factory import BotFactory
+from src.sharding import ShardCoordinator
 import threading
 from typing import List
 
+from src.log import configure_logging, get_logger, stop_logging
 import asyncio
-import traceback
+import os
+
+logger = get_logger(__name__)
+
+# Don't answer pings after the conversation moved on
+CALL_DEADLINE_SECONDS = 10 * 60
+# Bot triggered replies allowed per channel every ten minutes
+MAX_BOT_TURNS_PER_CHANNEL = 6
 
 
 async def _initialize_and_run_bots(
     personalities: List[Personality],
 ) -> List[threading.Thread]:
-    bot_factory = BotFactory(calls_per_minute=4, decay_chance_per_minute=0.25)
+    bot_factory = BotFactory(
+        calls_per_minute=4,
+        decay_chance_per_minute=0.25,
+        shared_gateway=os.environ.get("SHARED_GATEWAY") == "1",
+        call_deadline_seconds=CALL_DEADLINE_SECONDS,
+        max_bot_turns_per_channel=MAX_BOT_TURNS_PER_CHANNEL,
+    )
 
     # Create bots
     bots = [bot_factory.create_bot(personality) for personality in personalities]
@@ -29,13 +44,29 @@ async def _initialize_and_run_bots(
         raise e
 
 
+async def _run_sharded_bots(personalities: List[Personality], num_shards: int):
+    coordinator = ShardCoordinator(
+        personalities,
+        num_shards=num_shards,
+        log_level=os.environ.get("LOG_LEVEL", "INFO"),
+        calls_per_minute=4,
+        decay_chance_per_minute=0.25,
+        shared_gateway=os.environ.get("SHARED_GATEWAY") == "1",
+        call_deadline_seconds=CALL_DEADLINE_SECONDS,
+        max_bot_turns_per_channel=MAX_BOT_TURNS_PER_CHANNEL,
+    )
+    await coordinator.run()
+
+
 def handle_exception(loop, context):
     msg = context.get("exception", context["message"])
-    print(f"Caught exception: {msg}")
-    traceback.print_exc()
+    logger.error("Caught exception: %s", msg, exc_info=context.get("exception"))
 
 
 def main():
+    # OFF disables logging
+    configure_logging(os.environ.get("LOG_LEVEL", "INFO"))
+
     # Create personalities
     carl_jung = PhilosophyPersonality("Carl Jung", None)
     soren_kierkegaard = PhilosophyPersonality("Soren Kierkegaard", None)
@@ -89,7 +120,15 @@ def main():
 
     loop = asyncio.get_event_loop()
     loop.set_exception_handler(handle_exception)
-    asyncio.run(_initialize_and_run_bots(personalities))
+    # Spread the bots over this many processes
+    num_shards = int(os.environ.get("SHARDS", "1"))
+    try:
+        if num_shards > 1:
+            asyncio.run(_run_sharded_bots(personalities, num_shards))
+        else:
+            asyncio.run(_initialize_and_run_bots(personalities))
+    finally:
+        stop_logging()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,88 @@
+from src.log import get_logger
+from typing import Optional
+import math
+
+logger = get_logger(__name__)
+
+ADMIN_COMMAND_PREFIX = "!bots"
+
+USAGE = (
+    f"{ADMIN_COMMAND_PREFIX} silence [personality] | "
+    f"{ADMIN_COMMAND_PREFIX} mute [minutes] | "
+    f"{ADMIN_COMMAND_PREFIX} unmute | "
+    f"{ADMIN_COMMAND_PREFIX} pending"
+)
+
+
+class AdminCommands:
+    def __init__(self, anthropic_scheduler):
+        """
+        Chat commands for moderators to control the scheduler.
+
+        Args:
+            anthropic_scheduler: AnthropicScheduler, or the RemoteScheduler of a shard
+        """
+        self.anthropic_scheduler = anthropic_scheduler
+
+    @staticmethod
+    def is_command(content: str) -> bool:
+        return content.split(maxsplit=1)[:1] == [ADMIN_COMMAND_PREFIX]
+
+    async def handle(self, content: str, channel_id: int) -> str:
+        """
+        Run an admin command sent in a channel and return the reply.
+        """
+        words = content.split()[1:]
+        command = words[0].lower() if words else None
+        arguments = words[1:]
+        logger.info("Admin command %s in channel: %s", words, channel_id)
+
+        if command == "silence" and not arguments:
+            await self.anthropic_scheduler.silence_bots()
+            return "Silenced every bot."
+
+        if command == "silence":
+            personality_name = " ".join(arguments)
+            await self.anthropic_scheduler.silence_bot(personality_name)
+            return f"Silenced {personality_name}."
+
+        if command == "mute":
+            try:
+                minutes = self._parse_minutes(arguments)
+            except ValueError:
+                return USAGE
+            await self.anthropic_scheduler.mute_channel(
+                channel_id, minutes * 60 if minutes is not None else None
+            )
+            if minutes is None:
+                return "Muted this channel until it is unmuted."
+            return f"Muted this channel for {minutes:g} minutes."
+
+        if command == "unmute":
+            await self.anthropic_scheduler.unmute_channel(channel_id)
+            return "Unmuted this channel."
+
+        if command == "pending":
+            pending_calls = await self.anthropic_scheduler.pending_calls(channel_id)
+            if not pending_calls:
+                return "Nobody is waiting to speak here."
+            return "\n".join(
+                f"{personality_name}: {weight:g}"
+                for personality_name, weight in pending_calls
+            )
+
+        return USAGE
+
+    @staticmethod
+    def _parse_minutes(arguments) -> Optional[float]:
+        """
+        Minutes of a mute, None without an argument for an indefinite one.
+
+        Raises ValueError unless the argument is a positive number.
+        """
+        if not arguments:
+            return None
+        minutes = float(arguments[0])
+        if not math.isfinite(minutes) or minutes <= 0:
+            raise ValueError(f"Invalid mute duration: {arguments[0]}")
+        return minutes
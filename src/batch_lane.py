@@ -0,0 +1,164 @@
+from src.chat import AnthropicChat
+from src.messenger import AnthropicBatchMessageHandler, AnthropicMessage
+from src.metrics import metrics
+from src.log import get_logger
+from typing import Callable, Dict, Hashable, Set, Tuple
+import asyncio
+import itertools
+import time
+
+logger = get_logger(__name__)
+
+
+class BatchLane:
+    def __init__(
+        self,
+        anthropic_chat: AnthropicChat,
+        submit_interval: float = 30,
+        poll_interval: float = 15,
+        max_batch_size: int = 256,
+        max_wait_seconds: float = 3600,
+    ):
+        """
+        Answer calls nobody is waiting on through the Message Batches API.
+
+        Calls are collected and submitted as one batch every submit_interval seconds,
+        then each batch is polled in the background and its responses delivered.
+        Batched calls don't use the real-time call budget and cost half as much.
+
+        Args:
+            max_batch_size: Most calls submitted in one batch, the rest wait a round
+            max_wait_seconds: Cancel a batch which hasn't ended after this long, its
+                replies would be too late to make sense
+        """
+        self.anthropic_chat = anthropic_chat
+        self.submit_interval = submit_interval
+        self.poll_interval = poll_interval
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        # Call key to the handler answering it, in the order they were added
+        self._pending: Dict[
+            Hashable, Tuple[AnthropicBatchMessageHandler, AnthropicMessage]
+        ] = {}
+        self._collect_tasks: Set[asyncio.Task] = set()
+        self._custom_ids = itertools.count()
+
+    def add(
+        self,
+        key: Hashable,
+        handler: AnthropicBatchMessageHandler,
+        message: AnthropicMessage,
+    ):
+        """
+        Answer a call in the next batch, a call already waiting is only answered once.
+        """
+        self._pending[key] = (handler, message)
+        metrics.set_gauge("batch_pending", len(self._pending))
+
+    def discard(self, predicate: Callable[[Hashable], bool]) -> int:
+        """
+        Drop the calls waiting for the next batch whose key matches the predicate.
+
+        Returns the number of calls dropped.
+        """
+        keys = [key for key in self._pending if predicate(key)]
+        for key in keys:
+            del self._pending[key]
+        metrics.set_gauge("batch_pending", len(self._pending))
+        return len(keys)
+
+    async def _prepare(self, handler, message):
+        try:
+            return await handler.prepare_batch_message(message)
+        except Exception:
+            logger.exception("Failed to build batch context for: %s", message)
+            return None
+
+    async def submit(self):
+        """
+        Submit the waiting calls as one batch and start polling for its results.
+        """
+        keys = list(itertools.islice(self._pending, self.max_batch_size))
+        entries = [(key, *self._pending.pop(key)) for key in keys]
+        metrics.set_gauge("batch_pending", len(self._pending))
+        if not entries:
+            return
+
+        contexts = await asyncio.gather(
+            *(self._prepare(handler, message) for _, handler, message in entries)
+        )
+        requests = {}
+        for (key, handler, message), context in zip(entries, contexts):
+            if context is not None:
+                custom_id = f"call-{next(self._custom_ids)}"
+                requests[custom_id] = (key, handler, message, context)
+        if not requests:
+            return
+
+        try:
+            batch_id = await self.anthropic_chat.create_batch(
+                {custom_id: x[3] for custom_id, x in requests.items()}
+            )
+        except Exception:
+            logger.exception("Failed to submit batch, retrying next round")
+            for key, handler, message, _ in requests.values():
+                self._pending.setdefault(key, (handler, message))
+            metrics.set_gauge("batch_pending", len(self._pending))
+            return
+
+        metrics.increment("batch_calls", len(requests))
+        task = asyncio.create_task(self._collect(batch_id, requests))
+        self._collect_tasks.add(task)
+        task.add_done_callback(self._collect_tasks.discard)
+
+    async def _collect(self, batch_id: str, requests: Dict[str, tuple]):
+        """
+        Poll a batch until it ends and deliver its responses.
+        """
+        submitted = time.monotonic()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                responses = await self.anthropic_chat.batch_results(batch_id)
+            except Exception:
+                logger.exception("Failed to poll batch %s", batch_id)
+                responses = None
+            if responses is not None:
+                break
+            if time.monotonic() - submitted > self.max_wait_seconds:
+                logger.warning("Cancelling batch %s which took too long", batch_id)
+                try:
+                    await self.anthropic_chat.cancel_batch(batch_id)
+                except Exception:
+                    # It ends on its own eventually, its replies are dropped anyway
+                    logger.exception("Failed to cancel batch %s", batch_id)
+                # The replies would be too late to make sense
+                metrics.increment("batch_expired", len(requests))
+                return
+
+        metrics.observe("batch_turnaround", time.monotonic() - submitted)
+        logger.info("Batch %s ended with %s responses", batch_id, len(responses))
+        deliveries = [
+            (message, handler.deliver_batch_message(message, context, responses[x]))
+            for x, (_, handler, message, context) in requests.items()
+            if x in responses
+        ]
+        results = await asyncio.gather(
+            *(delivery for _, delivery in deliveries), return_exceptions=True
+        )
+        for (message, _), result in zip(deliveries, results):
+            if isinstance(result, Exception):
+                logger.error("Failed to deliver batch response for: %s", message)
+        metrics.increment("batch_replies", len(deliveries))
+
+    async def run(self):
+        """
+        Submit a batch every submit_interval seconds until cancelled.
+        """
+        try:
+            while True:
+                await asyncio.sleep(self.submit_interval)
+                await self.submit()
+        finally:
+            for task in self._collect_tasks:
+                task.cancel()
@@ -1,31 +1,265 @@
 from src.personality import Personality
-from src.discord_bot import DiscordService
-from src.chat import AnthropicChat
+from src.messenger import MentionOrigin
+from src.discord_bot import DiscordService, SharedGateway
+from src.chat import AnthropicChat, PromptCacheUsage
 from src.bot_service import BotService
 from src.chat_scheduler import AnthropicScheduler
 from src.private_data import discord_token
 from src.context import ContextBuilder
+from src.message_cache import ChannelMessageCache
+from src.mention_index import GuildMemberIndex
+from src.summary import ConversationSummarizer
+from src.metrics import metrics, MetricsExporter
+from src.admin import AdminCommands
+from src.state_store import PendingCall, StateStore
+from src.response_cache import ResponseCache
+from src.send_queue import ChannelSendQueue
+from src.multi_persona import MultiPersonaResponder
+from src.batch_lane import BatchLane
+from src.resilience import CircuitBreaker, ResilientCaller
+from typing import Dict, List, Optional
+import asyncio
 
 
 class BotFactory:
-    def __init__(self, calls_per_minute: int, decay_chance_per_minute: float):
+    def __init__(
+        self,
+        calls_per_minute: int,
+        decay_chance_per_minute: float,
+        max_concurrent_anthropic_calls: int = 4,
+        num_scheduler_workers: int = 4,
+        anthropic_base_url: Optional[str] = None,
+        history_token_budget: Optional[int] = None,
+        burst_capacity: Optional[int] = None,
+        stream_responses: bool = False,
+        metrics_port: Optional[int] = None,
+        metrics_snapshot_path: Optional[str] = None,
+        shared_gateway: bool = False,
+        anthropic_scheduler: Optional[AnthropicScheduler] = None,
+        call_deadline_seconds: Optional[float] = None,
+        recency_half_life_seconds: Optional[float] = None,
+        lane_shares: Optional[Dict[MentionOrigin, float]] = None,
+        max_bot_turns_per_channel: Optional[int] = None,
+        bot_turn_window_seconds: float = 600,
+        admin_commands: bool = True,
+        state_path: Optional[str] = None,
+        response_cache_ttl_seconds: Optional[float] = None,
+        multi_persona: bool = False,
+        batch_bot_mentions: bool = False,
+        batch_submit_interval: float = 30,
+        batch_poll_interval: float = 15,
+        llm_max_attempts: int = 3,
+        llm_deadline_seconds: float = 60,
+        hedge_requests: bool = False,
+        circuit_breaker_failures: Optional[int] = 5,
+        prefetch_likely_calls: int = 0,
+        max_concurrent_prefetches: int = 2,
+    ):
+        """
+        Args:
+            shared_gateway: Only the first bot connects to the gateway and routes
+                mentions to the others, which are send-only
+            anthropic_scheduler: Schedule through this scheduler instead of creating
+                one, e.g. the RemoteScheduler of a shard
+            call_deadline_seconds: Drop calls pending this long since the last ping
+            recency_half_life_seconds: Bias call sampling toward recent pings
+            lane_shares: Share of the calls for mentions by humans and by bots, None
+                samples every call by weight alone
+            max_bot_turns_per_channel: Cap on bot triggered calls per channel in
+                bot_turn_window_seconds
+            admin_commands: Let the first bot answer admin commands
+            state_path: SQLite file keeping the message cache and pending calls across
+                restarts
+            response_cache_ttl_seconds: Reuse the completion of an identical context
+                for this long, None disables the response cache
+            multi_persona: Answer the personalities pinged in a channel with one
+                completion instead of one each, ignored with a given scheduler
+            batch_bot_mentions: Answer mentions by bots through the Message Batches
+                API instead of the real-time budget, ignored with a given scheduler
+            llm_max_attempts: Attempts of a completion failing with an overloaded or
+                server error, with jittered backoff in between
+            llm_deadline_seconds: Give up on a completion, retries included, after
+                this long
+            hedge_requests: Send a second request when a completion is slower than
+                the 95th percentile of recent ones
+            circuit_breaker_failures: Consecutive failed completions which pause
+                scheduling for a while, None disables the circuit breaker
+            prefetch_likely_calls: Build the context of this many of the most likely
+                calls while they wait, at most max_concurrent_prefetches at once.
+                Ignored with a given scheduler
+        """
         calls_per_second = calls_per_minute / 60
-        self.anthropic_scheduler = AnthropicScheduler(
-            calls_per_second=calls_per_second,
-            decay_chance_per_minute=decay_chance_per_minute,
+        self.circuit_breaker = None
+        if circuit_breaker_failures is not None:
+            self.circuit_breaker = CircuitBreaker(circuit_breaker_failures)
+        # Shared by every bot so the latency percentiles cover every completion
+        self.resilience = ResilientCaller(
+            AnthropicChat.is_retryable,
+            deadline_seconds=llm_deadline_seconds,
+            max_attempts=llm_max_attempts,
+            hedge_percentile=95 if hedge_requests else None,
+            circuit_breaker=self.circuit_breaker,
+        )
+        self.anthropic_base_url = anthropic_base_url
+        self.prompt_cache_usage = PromptCacheUsage()
+        self.batch_lane = None
+        if batch_bot_mentions and anthropic_scheduler is None:
+            self.batch_lane = BatchLane(
+                AnthropicChat(
+                    base_url=anthropic_base_url, cache_usage=self.prompt_cache_usage
+                ),
+                submit_interval=batch_submit_interval,
+                poll_interval=batch_poll_interval,
+            )
+        self.anthropic_scheduler = anthropic_scheduler
+        if self.anthropic_scheduler is None:
+            self.anthropic_scheduler = AnthropicScheduler(
+                calls_per_second=calls_per_second,
+                decay_chance_per_minute=decay_chance_per_minute,
+                num_workers=num_scheduler_workers,
+                burst_capacity=burst_capacity,
+                deadline_seconds=call_deadline_seconds,
+                recency_half_life_seconds=recency_half_life_seconds,
+                lane_shares=lane_shares,
+                max_bot_turns_per_channel=max_bot_turns_per_channel,
+                bot_turn_window_seconds=bot_turn_window_seconds,
+                multi_persona=multi_persona,
+                batch_lane=self.batch_lane,
+                circuit_breaker=self.circuit_breaker,
+                prefetch_likely_calls=prefetch_likely_calls,
+            )
+        max_messages_per_channel = 50
+        self.state_store = None
+        if state_path is not None:
+            self.state_store = StateStore(
+                state_path, max_messages_per_channel=max_messages_per_channel
+            )
+        self.message_cache = ChannelMessageCache(
+            max_messages_per_channel, journal=self.state_store
+        )
+        if self.state_store is not None:
+            self.message_cache.restore(self.state_store.load_messages())
+        self.member_index = GuildMemberIndex()
+        # Shared by every bot so the send budget of a channel covers all of them
+        self.send_queue = ChannelSendQueue()
+        # Shared by every bot so the cap applies to the whole process
+        self.anthropic_in_flight_limiter = asyncio.Semaphore(
+            max_concurrent_anthropic_calls
+        )
+        # Shared by every bot, the personality is part of the cache key
+        self.response_cache = None
+        if response_cache_ttl_seconds is not None:
+            self.response_cache = ResponseCache(ttl_seconds=response_cache_ttl_seconds)
+        self.history_token_budget = history_token_budget
+        # Shared by every bot so prefetching can't crowd out the calls themselves
+        self.prefetch_limiter = asyncio.Semaphore(max_concurrent_prefetches)
+        self.stream_responses = stream_responses
+        self.metrics_exporter = MetricsExporter(
+            metrics, port=metrics_port, snapshot_path=metrics_snapshot_path
+        )
+        self.gateway = SharedGateway() if shared_gateway else None
+        self.admin_commands = (
+            AdminCommands(self.anthropic_scheduler) if admin_commands else None
+        )
+        self._bots_created = 0
+        self.discord_services: List[DiscordService] = []
+        self._pending_calls_restored = False
+        self.summarizer = None
+        if history_token_budget is not None:
+            self.summarizer = ConversationSummarizer(
+                self._create_chat().summarize,
+                acquire_call_budget=self.anthropic_scheduler.acquire_call_budget,
+            )
+        self.multi_persona_responder = None
+        if multi_persona and anthropic_scheduler is None:
+            self.multi_persona_responder = MultiPersonaResponder(self._create_chat())
+            self.anthropic_scheduler.register_group_message_handler(
+                self.multi_persona_responder
+            )
+
+    def _create_chat(self) -> AnthropicChat:
+        return AnthropicChat(
+            self.anthropic_in_flight_limiter,
+            base_url=self.anthropic_base_url,
+            cache_usage=self.prompt_cache_usage,
+            rate_limiter=self.anthropic_scheduler.rate_limiter,
+            response_cache=self.response_cache,
+            resilience=self.resilience,
         )
 
     def create_bot(self, personality: Personality) -> BotService:
-        discord_service = DiscordService(discord_token(personality.name))
-        return BotService(
+        discord_service = DiscordService(
+            discord_token(personality.name),
+            message_cache=self.message_cache,
+            member_index=self.member_index,
+            gateway=self.gateway,
+            # The first bot becomes the listener
+            send_only=self.gateway is not None and self.gateway.listener is not None,
+            # Only one client answers so each command gets one reply
+            admin_commands=self.admin_commands if not self._bots_created else None,
+            send_queue=self.send_queue,
+            personality_name=personality.name,
+        )
+        self._bots_created += 1
+        self.discord_services.append(discord_service)
+        bot = BotService(
             discord_service=discord_service,
-            anthropic_chat=AnthropicChat(),
+            anthropic_chat=self._create_chat(),
             anthropic_scheduler=self.anthropic_scheduler,
-            context_builder=ContextBuilder(discord_service, personality),
+            context_builder=ContextBuilder(
+                discord_service,
+                personality,
+                history_token_budget=self.history_token_budget,
+                summarizer=self.summarizer,
+                prefetch_limiter=self.prefetch_limiter,
+            ),
+            stream_responses=self.stream_responses,
         )
+        if self.multi_persona_responder is not None:
+            self.multi_persona_responder.add_bot(bot)
+        return bot
+
+    async def wait_until_listening(self):
+        """
+        Wait until every bot has its channels cached.
+        """
+        await asyncio.gather(*(x.wait_until_listening() for x in self.discord_services))
+
+    async def _restore_pending_calls(self):
+        # A restored call needs the channel of its bot to build the context
+        await self.wait_until_listening()
+        await self.anthropic_scheduler.restore_pending_calls(
+            self.state_store.load_pending_calls()
+        )
+        self._pending_calls_restored = True
+
+    def _export_pending_calls(self) -> Optional[List[PendingCall]]:
+        # Keep the stored calls until they have been restored
+        if not self._pending_calls_restored:
+            return None
+        return self.anthropic_scheduler.export_pending_calls()
 
     async def run(self):
-        return await self.anthropic_scheduler.run()
+        tasks = [asyncio.create_task(self.metrics_exporter.run())]
+        if self.state_store is not None:
+            # A shard's calls are kept by the coordinator
+            owns_calls = isinstance(self.anthropic_scheduler, AnthropicScheduler)
+            if owns_calls:
+                tasks.append(asyncio.create_task(self._restore_pending_calls()))
+            tasks.append(
+                asyncio.create_task(
+                    self.state_store.run(
+                        self._export_pending_calls if owns_calls else None
+                    )
+                )
+            )
+        try:
+            return await self.anthropic_scheduler.run()
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Let the state store write its last snapshot
+            await asyncio.gather(*tasks, return_exceptions=True)
 
     async def stop(self):
         await self.anthropic_scheduler.stop()
@@ -1,62 +1,135 @@
 from src.discord_bot import DiscordService
+from src.send_queue import DISCORD_MESSAGE_LIMIT
 from src.chat_scheduler import AnthropicScheduler
 from src.chat import AnthropicChat
 from src.messenger import (
     DiscordMessage,
+    AnthropicBatchMessageHandler,
     AnthropicMessageHandler,
+    AnthropicPrefetchHandler,
     DiscordMessageHandler,
     AnthropicMessage,
+    MentionOrigin,
 )
-from src.context import ContextBuilder
+from src.context import AnthropicContext, ContextBuilder
+from src.errors import BackoffError
+from src.log import get_logger
 from typing import List
 import asyncio
 
+logger = get_logger(__name__)
 
-class BotService(DiscordMessageHandler, AnthropicMessageHandler):
+
+class BotService(
+    DiscordMessageHandler,
+    AnthropicMessageHandler,
+    AnthropicBatchMessageHandler,
+    AnthropicPrefetchHandler,
+):
     def __init__(
         self,
         discord_service: DiscordService,
         anthropic_chat: AnthropicChat,
         anthropic_scheduler: AnthropicScheduler,
         context_builder: ContextBuilder,
+        stream_responses: bool = False,
     ):
+        """
+        Args:
+            stream_responses: Send the response in sentence aligned chunks as it is
+                generated instead of waiting for the whole completion
+        """
         self.discord_service = discord_service
         self.anthropic_chat = anthropic_chat
         self.anthropic_scheduler = anthropic_scheduler
         self.context_builder = context_builder
+        self.stream_responses = stream_responses
+        # Leave room for mentions which get longer when they are replaced
+        self.max_chunk_length = DISCORD_MESSAGE_LIMIT - 100
         self.discord_service.messenger = self
+        self.anthropic_scheduler.register_anthropic_message_handler(
+            self.context_builder.personality, self
+        )
 
     async def handle_discord_message(
-        self, message: List[DiscordMessage], channel_id: int
+        self,
+        message: List[DiscordMessage],
+        channel_id: int,
+        origin: MentionOrigin = MentionOrigin.HUMAN,
     ):
         """
         The discord bot will call this method when a message is received.
         """
-        print(
-            "Handling discord message for personality: ",
+        logger.debug(
+            "Handling discord message for personality: %s",
             self.context_builder.personality.name,
         )
-        self.anthropic_scheduler.register_anthropic_message_handler(
-            self.context_builder.personality, self
-        )
         await self.anthropic_scheduler.request_anthropic_call(
-            self.context_builder.personality, channel_id
+            self.context_builder.personality, channel_id, origin
         )
 
     async def handle_anthropic_message(self, message: AnthropicMessage):
         """
         The anthropic scheduler will call this method when a message must be sent.
         """
-        print(
-            "Handling anthropic message for personality: ",
+        logger.debug(
+            "Handling anthropic message for personality: %s channel_id: %s",
             message.personality.name,
-            "channel_id: ",
             message.channel_id,
         )
+        if self.stream_responses:
+            await self._stream_anthropic_message(message)
+            return
+
         context = await self.context_builder.build_context(message.channel_id)
-        print("Build context for personality: ", message.personality.name)
-        response = self.anthropic_chat.send_message(context)
+        logger.debug("Built context for personality: %s", message.personality.name)
+        response = await self.anthropic_chat.send_message(context)
+        # Only queued, the worker moves on without waiting for discord
         await self.discord_service.send_message(response, message.channel_id)
 
+    def prefetch_anthropic_message(self, message: AnthropicMessage):
+        """
+        The anthropic scheduler will call this method when the message is likely to
+        be selected soon.
+        """
+        self.context_builder.prefetch(message.channel_id)
+
+    async def prepare_batch_message(self, message: AnthropicMessage) -> AnthropicContext:
+        """
+        The batch lane will call this method when the message is submitted.
+        """
+        return await self.context_builder.build_context(message.channel_id)
+
+    async def deliver_batch_message(
+        self, message: AnthropicMessage, context: AnthropicContext, response: str
+    ):
+        """
+        The batch lane will call this method when the response has arrived.
+        """
+        response = self.anthropic_chat.post_process(response, context)
+        await self.discord_service.send_message(response, message.channel_id)
+
+    async def _stream_anthropic_message(self, message: AnthropicMessage):
+        """
+        Stream the response to discord while it is being generated.
+        """
+        sent_chunks = 0
+        async with self.discord_service.typing(message.channel_id):
+            context = await self.context_builder.build_context(message.channel_id)
+            logger.debug(
+                "Built context for personality: %s", message.personality.name
+            )
+            try:
+                async for chunk in self.anthropic_chat.stream_message(
+                    context, max_chunk_length=self.max_chunk_length
+                ):
+                    await self.discord_service.send_message(chunk, message.channel_id)
+                    sent_chunks += 1
+            except (TimeoutError, BackoffError):
+                if not sent_chunks:
+                    raise
+                # Part of the response was already sent, don't retry
+                logger.warning("Stream interrupted after %s chunks", sent_chunks)
+
     async def run(self):
         return await self.discord_service.run()
@@ -1,14 +1,95 @@
-from anthropic import Anthropic, APITimeoutError
+from anthropic import (
+    AsyncAnthropic,
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+)
 from src.private_data import anthropic_api_key
 from src.context import AnthropicContext
+from src.errors import RateLimitedError, ServiceUnavailableError
+from src.messenger import DiscordMessage
+from src.rate_limiter import AdaptiveTokenBucket
+from src.response_cache import ResponseCache
+from src.resilience import ResilientCaller
+from src.metrics import metrics
+from src.log import get_logger
+from typing import AsyncIterator, Callable, Dict, List, Mapping, Optional, Union
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+import asyncio
+import hashlib
+import json
+import time
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class PromptCacheUsage:
+    """
+    Running totals of token usage reported by the API.
+    """
+
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_creation_input_tokens: int = 0
+    cache_read_input_tokens: int = 0
+    cache_hits: int = 0
+    cache_misses: int = 0
+
+    def record(self, usage) -> None:
+        cache_read_input_tokens = getattr(usage, "cache_read_input_tokens", None) or 0
+        cache_creation_input_tokens = (
+            getattr(usage, "cache_creation_input_tokens", None) or 0
+        )
+        self.input_tokens += usage.input_tokens
+        self.output_tokens += usage.output_tokens
+        self.cache_read_input_tokens += cache_read_input_tokens
+        self.cache_creation_input_tokens += cache_creation_input_tokens
+        if cache_read_input_tokens:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
 
 
 class AnthropicChat:
-    def __init__(self):
+    def __init__(
+        self,
+        in_flight_limiter: Optional[asyncio.Semaphore] = None,
+        base_url: Optional[str] = None,
+        cache_usage: Optional[PromptCacheUsage] = None,
+        rate_limiter: Optional[AdaptiveTokenBucket] = None,
+        response_cache: Optional[ResponseCache] = None,
+        resilience: Optional[ResilientCaller] = None,
+        request_timeout_seconds: float = 30,
+    ):
+        """
+        Args:
+            in_flight_limiter: Semaphore shared between chats to cap the number of
+                concurrent in-flight requests. No cap if None.
+            base_url: Override the API endpoint, e.g. to point at a local fake server
+            cache_usage: Where token and prompt cache usage is recorded, can be shared
+            rate_limiter: Informed of rate limit headers and errors so it can adapt
+            response_cache: Reuse the response to an identical context instead of
+                requesting another completion
+            resilience: Retries, hedges and deadlines for completions, replacing the
+                retries of the client
+            request_timeout_seconds: Timeout of a single HTTP request
+        """
         # Aggressive timeout settings because we will handle timeouts in the service
         # we want fresh context data for the bots
-        self.anthropic_client = Anthropic(
+        self.anthropic_client = AsyncAnthropic(
             api_key=anthropic_api_key(),
+            base_url=base_url,
+            timeout=request_timeout_seconds,
+            max_retries=0 if resilience is not None else 2,
+        )
+        self.resilience = resilience
+        self.in_flight_limiter = in_flight_limiter
+        self.rate_limiter = rate_limiter
+        self.response_cache = response_cache
+        self.cache_usage = (
+            cache_usage if cache_usage is not None else PromptCacheUsage()
         )
 
     def _remove_self_reference(self, message: str, name: str) -> str:
@@ -38,25 +119,394 @@ class AnthropicChat:
 
         return result.replace("\n\n\n", "\n")
 
-    def send_message(self, context: AnthropicContext) -> str:
+    @staticmethod
+    def _build_system(context: AnthropicContext) -> Union[str, List[dict]]:
+        """
+        Build the system prompt, marking cache breakpoints with cache_control.
+        """
+        if not context.system_blocks:
+            return context.system_directive
+
+        system = []
+        for block in context.system_blocks:
+            text_block = {"type": "text", "text": block.text}
+            if block.cache_breakpoint:
+                text_block["cache_control"] = {"type": "ephemeral"}
+            system.append(text_block)
+        return system
+
+    @contextmanager
+    def _circuit(self):
+        """
+        Fail fast while the circuit breaker is open and tell it the outcome otherwise.
+        """
+        breaker = self.resilience.circuit_breaker if self.resilience else None
+        if breaker is None:
+            yield
+            return
+        is_probe = breaker.is_open
+        if not breaker.allow_request():
+            raise ServiceUnavailableError(breaker.time_until_probe())
+        try:
+            yield
+        except Exception as e:
+            # The API error the failure was translated from
+            cause = e.__context__ or e
+            if self.is_retryable(cause) or isinstance(e, TimeoutError):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            raise
+        except BaseException:
+            # Cancelled or the stream was closed early, no outcome to record
+            if is_probe and breaker.is_open:
+                breaker.release_probe()
+            raise
+        breaker.record_success()
+
+    @asynccontextmanager
+    async def _in_flight_slot(self):
+        """
+        Wait for a free slot if the in-flight limit has been reached.
+        """
+        if self.in_flight_limiter is None:
+            yield
+        else:
+            async with self.in_flight_limiter:
+                yield
+
+    @staticmethod
+    def is_retryable(e: BaseException) -> bool:
+        """
+        Whether a failed request is worth retrying right away.
+        """
+        if isinstance(e, APIStatusError):
+            # 529 is overloaded, 429 is left to the rate limiter
+            return e.status_code >= 500
+        return isinstance(e, (APIConnectionError, TimeoutError))
+
+    def _raise_for_status_error(self, e: APIStatusError):
+        if e.status_code >= 500 and e.status_code != 529:
+            raise ServiceUnavailableError() from e
+        # 429 is rate limited and 529 is overloaded
+        if e.status_code not in (429, 529):
+            raise e
+        retry_after = self._parse_retry_after(e.response.headers)
+        if self.rate_limiter is not None:
+            self.rate_limiter.on_rate_limited(retry_after)
+        raise RateLimitedError(retry_after)
+
+    async def _create(self, **kwargs):
+        """
+        Create a message, waiting for a free slot if the in-flight limit has been reached.
+        """
         try:
-            response = (
-                self.anthropic_client.messages.create(
-                    model="claude-4-6-sonnet-latest",
-                    messages=context.messages,
-                    max_tokens=512,
-                    system=context.system_directive,
+            if self.resilience is None:
+                raw_response = await self._attempt(**kwargs)
+            else:
+                raw_response = await self.resilience.call(
+                    lambda: self._attempt(**kwargs)
                 )
-                .content[0]
-                .text
+        except APIStatusError as e:
+            self._raise_for_status_error(e)
+        except APITimeoutError:
+            raise
+        except APIConnectionError as e:
+            raise ServiceUnavailableError() from e
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.observe_headers(raw_response.headers)
+            self.rate_limiter.on_success()
+
+        response = await raw_response.parse()
+        self.cache_usage.record(response.usage)
+        return response
+
+    async def _attempt(self, **kwargs):
+        async with self._in_flight_slot():
+            return await self._create_raw(**kwargs)
+
+    async def _create_raw(self, **kwargs):
+        return await self.anthropic_client.messages.with_raw_response.create(**kwargs)
+
+    @staticmethod
+    def _parse_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+        try:
+            return float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            return None
+
+    def _message_parameters(self, context: AnthropicContext) -> dict:
+        return dict(
+            model="claude-4-6-sonnet-latest",
+            messages=context.messages,
+            max_tokens=512,
+            system=self._build_system(context),
+        )
+
+    @staticmethod
+    def _record_token_usage(usage, **labels):
+        metrics.increment("llm_input_tokens", usage.input_tokens, **labels)
+        metrics.increment("llm_output_tokens", usage.output_tokens, **labels)
+        metrics.increment(
+            "llm_cache_read_input_tokens",
+            getattr(usage, "cache_read_input_tokens", None) or 0,
+            **labels,
+        )
+
+    async def _create_message(self, context: AnthropicContext) -> str:
+        labels = dict(personality=context.name, channel=context.channel_id)
+        with metrics.span("llm", **labels):
+            response = await self._create(**self._message_parameters(context))
+        self._record_token_usage(response.usage, **labels)
+        return response.content[0].text
+
+    async def summarize(
+        self, previous_summary: Optional[str], messages: List[DiscordMessage]
+    ) -> str:
+        """
+        Fold messages into the previous summary of a conversation.
+        """
+        transcript = "\n".join(f"{x.author}: {x.content}" for x in messages)
+        prompt = (
+            f"Summary of the conversation so far:\n{previous_summary or 'None'}\n\n"
+            f"Newer messages:\n{transcript}\n\n"
+            "Write an updated summary of the whole conversation in a few sentences. "
+            "Keep who said what and any open questions."
+        )
+        try:
+            response = await self._create(
+                model="claude-4-6-sonnet-latest",
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=256,
             )
         except APITimeoutError:
             raise TimeoutError
+        return response.content[0].text
+
+    async def create_batch(self, contexts: Mapping[str, AnthropicContext]) -> str:
+        """
+        Submit a Message Batch with one request per context, keyed by custom id.
+
+        Returns the batch id.
+        """
+        batch = await self.anthropic_client.messages.batches.create(
+            requests=[
+                {"custom_id": custom_id, "params": self._message_parameters(context)}
+                for custom_id, context in contexts.items()
+            ]
+        )
+        logger.info("Submitted batch %s with %s requests", batch.id, len(contexts))
+        return batch.id
+
+    async def batch_results(self, batch_id: str) -> Optional[Dict[str, str]]:
+        """
+        Get the response text of every succeeded request of a batch by custom id, or
+        None while the batch is still processing.
+        """
+        batch = await self.anthropic_client.messages.batches.retrieve(batch_id)
+        if batch.processing_status != "ended":
+            return None
+
+        responses = {}
+        async for entry in await self.anthropic_client.messages.batches.results(
+            batch_id
+        ):
+            if entry.result.type != "succeeded":
+                logger.warning(
+                    "Batch request %s %s", entry.custom_id, entry.result.type
+                )
+                continue
+            message = entry.result.message
+            self.cache_usage.record(message.usage)
+            self._record_token_usage(message.usage, lane="batch")
+            responses[entry.custom_id] = message.content[0].text
+        return responses
+
+    async def cancel_batch(self, batch_id: str):
+        await self.anthropic_client.messages.batches.cancel(batch_id)
+
+    @staticmethod
+    def _context_fingerprint(context: AnthropicContext) -> str:
+        """
+        Hash everything which affects the completion, ignoring surrounding whitespace.
+        """
+        normalized = [
+            context.name,
+            context.larping_allowed,
+            [block.text.strip() for block in context.system_blocks]
+            or context.system_directive.strip(),
+            [
+                [message["role"], message["content"].strip()]
+                for message in context.messages
+            ],
+        ]
+        return hashlib.sha256(json.dumps(normalized).encode()).hexdigest()
+
+    async def send_message(self, context: AnthropicContext) -> str:
+        """
+        Request a completion without blocking the event loop.
+        """
+        if self.response_cache is None:
+            return await self._send_message(context)
+        return await self.response_cache.get_or_create(
+            self._context_fingerprint(context), lambda: self._send_message(context)
+        )
+
+    async def _send_message(self, context: AnthropicContext) -> str:
+        try:
+            response = await self._create_message(context)
+        except APITimeoutError:
+            raise TimeoutError
+
+        logger.debug("Anthropic response: %s", response)
+        return self.post_process(response, context)
 
-        print("Anthropic response:", response)
+    def post_process(self, response: str, context: AnthropicContext) -> str:
         message = self._remove_self_reference(response, context.name)
 
         if not context.larping_allowed:
             message = self._remove_larping(message)
 
         return message
+
+    async def stream_message(
+        self,
+        context: AnthropicContext,
+        max_chunk_length: int,
+        min_chunk_length: int = 200,
+    ) -> AsyncIterator[str]:
+        """
+        Stream a completion, yielding post processed sentence aligned chunks.
+
+        Args:
+            max_chunk_length: Chunks are never longer than this, e.g. the message limit
+            min_chunk_length: Sentences are grouped until a chunk is at least this long
+        """
+        processor = StreamingPostProcessor(
+            lambda text: self.post_process(text, context),
+            larping_allowed=context.larping_allowed,
+            max_chunk_length=max_chunk_length,
+            min_chunk_length=min_chunk_length,
+        )
+        labels = dict(personality=context.name, channel=context.channel_id)
+        start = time.monotonic()
+        first_chunk = True
+        # Not retried since chunks may have been sent already
+        with self._circuit():
+            try:
+                async with self._in_flight_slot():
+                    async with self.anthropic_client.messages.stream(
+                        **self._message_parameters(context)
+                    ) as stream:
+                        async for text in stream.text_stream:
+                            for chunk in processor.feed(text):
+                                if first_chunk:
+                                    first_chunk = False
+                                    metrics.observe(
+                                        "llm_first_chunk",
+                                        time.monotonic() - start,
+                                        **labels,
+                                    )
+                                yield chunk
+                        response = await stream.get_final_message()
+            except APITimeoutError:
+                raise TimeoutError
+            except APIConnectionError as e:
+                raise ServiceUnavailableError() from e
+            except APIStatusError as e:
+                self._raise_for_status_error(e)
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.on_success()
+        self.cache_usage.record(response.usage)
+        metrics.observe("llm", time.monotonic() - start, **labels)
+        self._record_token_usage(response.usage, **labels)
+        logger.debug("Anthropic streamed response: %s", response.content[0].text)
+
+        for chunk in processor.finish():
+            yield chunk
+
+
+class StreamingPostProcessor:
+    def __init__(
+        self,
+        post_process: Callable[[str], str],
+        larping_allowed: bool,
+        max_chunk_length: int,
+        min_chunk_length: int,
+    ):
+        """
+        Turn streamed text into post processed chunks that are safe to send.
+
+        Text is only post processed up to a sentence boundary. Without larping, text
+        from the first asterisk on is held until the stream ends, since whether italics
+        are removed depends on the asterisks of the whole message.
+        """
+        self._post_process = post_process
+        self._larping_allowed = larping_allowed
+        self._max_chunk_length = max_chunk_length
+        self._min_chunk_length = min_chunk_length
+        # Raw text which can't be post processed yet
+        self._pending = ""
+        # Post processed text which hasn't been sent yet
+        self._ready = ""
+
+    @staticmethod
+    def _is_sentence_end(text: str, i: int) -> bool:
+        if text[i] == "\n":
+            return True
+        return text[i] in ".!?" and i + 1 < len(text) and text[i + 1].isspace()
+
+    def _safe_cut(self) -> int:
+        """
+        Index of the last sentence boundary which can be post processed on its own.
+        """
+        cut = 0
+        for i, char in enumerate(self._pending):
+            if char == "*" and not self._larping_allowed:
+                break
+            if self._is_sentence_end(self._pending, i):
+                cut = i + 1
+        return cut
+
+    def _split_position(self) -> int:
+        """
+        Where to split ready text that is too long for one chunk.
+        """
+        for i in range(self._max_chunk_length - 1, 0, -1):
+            if self._is_sentence_end(self._ready, i):
+                return i + 1
+        return self._max_chunk_length
+
+    def _take_chunks(self, final: bool) -> List[str]:
+        chunks = []
+        while len(self._ready) > self._max_chunk_length:
+            split_position = self._split_position()
+            chunks.append(self._ready[:split_position])
+            self._ready = self._ready[split_position:]
+
+        if self._ready and (final or len(self._ready) >= self._min_chunk_length):
+            chunks.append(self._ready)
+            self._ready = ""
+
+        return [x.strip() for x in chunks if x.strip()]
+
+    def feed(self, text: str) -> List[str]:
+        """
+        Add streamed text and return the chunks which are ready to be sent.
+        """
+        self._pending += text
+        cut = self._safe_cut()
+        if cut:
+            self._ready += self._post_process(self._pending[:cut])
+            self._pending = self._pending[cut:]
+        return self._take_chunks(final=False)
+
+    def finish(self) -> List[str]:
+        """
+        Flush everything left once the stream has ended.
+        """
+        self._ready += self._post_process(self._pending)
+        self._pending = ""
+        return self._take_chunks(final=True)
@@ -1,23 +1,112 @@
 from src.weighted_sampler import WeightedKeySampler
 from src.personality import Personality
-from typing import Dict
-from collections import namedtuple
-from src.messenger import AnthropicMessageHandler, AnthropicMessage
+from src.rate_limiter import AdaptiveTokenBucket
+from src.metrics import metrics
+from src.state_store import PendingCall
+from src.batch_lane import BatchLane
+from src.resilience import CircuitBreaker
+from src.log import get_logger
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+from collections import defaultdict, deque, namedtuple
+from src.messenger import (
+    AnthropicBatchMessageHandler,
+    AnthropicGroupMessageHandler,
+    AnthropicMessageHandler,
+    AnthropicMessage,
+    AnthropicPrefetchHandler,
+    MentionOrigin,
+)
 import asyncio
+import time
+
+logger = get_logger(__name__)
 
 AnthropicCall = namedtuple("AnthropicCall", ["personality_name", "channel_id"])
 
+# Humans get four calls for every call triggered by another bot when both wait
+DEFAULT_LANE_SHARES = {MentionOrigin.HUMAN: 4, MentionOrigin.BOT: 1}
+
 
 class AnthropicScheduler:
-    def __init__(self, calls_per_second: int, decay_chance_per_minute: float):
+    def __init__(
+        self,
+        calls_per_second: int,
+        decay_chance_per_minute: float,
+        num_workers: int = 4,
+        burst_capacity: Optional[int] = None,
+        deadline_seconds: Optional[float] = None,
+        recency_half_life_seconds: Optional[float] = None,
+        lane_shares: Optional[Dict[MentionOrigin, float]] = None,
+        max_bot_turns_per_channel: Optional[int] = None,
+        bot_turn_window_seconds: float = 600,
+        multi_persona: bool = False,
+        max_personas_per_call: int = 4,
+        batch_lane: Optional[BatchLane] = None,
+        batch_origins: Iterable[MentionOrigin] = (MentionOrigin.BOT,),
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        prefetch_likely_calls: int = 0,
+        prefetch_interval: float = 1,
+    ):
+        """
+        Args:
+            burst_capacity: Use an adaptive token bucket allowing this many calls in a
+                burst instead of sampling at a fixed interval
+            deadline_seconds: Drop a call when the bot wasn't pinged in the channel
+                for this long without getting to answer
+            recency_half_life_seconds: Prefer calls whose last ping is recent
+            lane_shares: Share of the calls for mentions by humans and by bots, e.g.
+                DEFAULT_LANE_SHARES. None samples every call by weight alone
+            max_bot_turns_per_channel: Ignore mentions by bots in a channel which had
+                this many bot triggered calls in the last bot_turn_window_seconds
+            multi_persona: Take the pending calls of a channel together and answer
+                them with one completion through the group message handler
+            max_personas_per_call: Most calls answered by one completion
+            batch_lane: Answer the calls of batch_origins through the Message Batches
+                API, outside of the real-time call budget
+            circuit_breaker: Pause scheduling while it is open instead of sampling
+                calls which would fail
+            prefetch_likely_calls: Build the context of this many of the most likely
+                calls ahead of time, refreshed every prefetch_interval seconds and
+                whenever a call is requested
+        """
         sampling_interval = 1 / calls_per_second
+        self.rate_limiter: Optional[AdaptiveTokenBucket] = None
+        if burst_capacity is not None:
+            self.rate_limiter = AdaptiveTokenBucket(
+                rate_per_second=calls_per_second, capacity=burst_capacity
+            )
         self.call_storage = WeightedKeySampler(
             sampling_interval=sampling_interval,
             output_func=self.make_anthropic_call,
             decay_chance_per_minute=decay_chance_per_minute,
+            num_workers=num_workers,
+            rate_limiter=self.rate_limiter,
+            deadline_seconds=deadline_seconds,
+            recency_half_life_seconds=recency_half_life_seconds,
+            lane_shares=lane_shares,
+            secondary_indexes={
+                "personality": lambda call: call.personality_name,
+                "channel": lambda call: call.channel_id,
+            },
+            group_by="channel" if multi_persona else None,
+            group_output_func=self.make_group_anthropic_call,
+            max_group_size=max_personas_per_call,
+            circuit_breaker=circuit_breaker,
         )
         self.personalities: Dict[str, Personality] = {}
         self.anthropic_message_handlers: Dict[str, AnthropicMessageHandler] = {}
+        self.group_message_handler: Optional[AnthropicGroupMessageHandler] = None
+        self.batch_lane = batch_lane
+        self.batch_origins = set(batch_origins)
+        self.max_bot_turns_per_channel = max_bot_turns_per_channel
+        self.bot_turn_window_seconds = bot_turn_window_seconds
+        # Channel id to the times of recent calls triggered by bots
+        self._bot_turns: Dict[int, Deque[float]] = defaultdict(deque)
+        # Channel id to the monotonic time it is muted until
+        self._muted_channels: Dict[int, float] = {}
+        self.prefetch_likely_calls = prefetch_likely_calls
+        self.prefetch_interval = prefetch_interval
+        self._prefetch_wakeup = asyncio.Event()
 
     def register_anthropic_message_handler(
         self,
@@ -25,6 +114,12 @@ class AnthropicScheduler:
         anthropic_message_handler: AnthropicMessageHandler,
     ):
         self.anthropic_message_handlers[personality.name] = anthropic_message_handler
+        self._store_personality(personality)
+
+    def register_group_message_handler(
+        self, group_message_handler: AnthropicGroupMessageHandler
+    ):
+        self.group_message_handler = group_message_handler
 
     def _store_personality(self, personality: Personality):
         self.personalities[personality.name] = personality
@@ -32,40 +127,178 @@ class AnthropicScheduler:
     def _get_personality(self, personality_name: str) -> Personality:
         return self.personalities[personality_name]
 
-    async def request_anthropic_call(self, personality: Personality, channel_id: int):
+    def _recent_bot_turns(self, channel_id: int) -> int:
+        turns = self._bot_turns[channel_id]
+        window_start = time.monotonic() - self.bot_turn_window_seconds
+        while turns and turns[0] < window_start:
+            turns.popleft()
+        return len(turns)
+
+    async def request_anthropic_call(
+        self,
+        personality: Personality,
+        channel_id: int,
+        origin: MentionOrigin = MentionOrigin.HUMAN,
+    ):
         """
         Request an anthropic call for the given personality.
 
         The call will be made by the scheduler at a later time.
         """
-        print(
-            f"Requesting anthropic call for personality: {personality.name} to channel: {channel_id}"
+        logger.debug(
+            "Requesting anthropic call for personality: %s to channel: %s from: %s",
+            personality.name,
+            channel_id,
+            origin.value,
         )
+        if self.is_channel_muted(channel_id):
+            logger.debug("Ignoring call to muted channel: %s", channel_id)
+            return
+        if (
+            origin == MentionOrigin.BOT
+            and self.max_bot_turns_per_channel is not None
+            and self._recent_bot_turns(channel_id) >= self.max_bot_turns_per_channel
+        ):
+            logger.debug("Bot turn cap reached in channel: %s", channel_id)
+            metrics.increment("bot_turns_capped", channel=channel_id)
+            return
         self._store_personality(personality)
-        await self.call_storage.record_key(AnthropicCall(personality.name, channel_id))
+        anthropic_call = AnthropicCall(personality.name, channel_id)
+        handler = self.anthropic_message_handlers.get(personality.name)
+        if origin == MentionOrigin.BOT and (
+            self.call_storage.request_times(anthropic_call) is None
+        ):
+            # Counted when the call is requested, a call already pending is one turn
+            self._bot_turns[channel_id].append(time.monotonic())
+        if (
+            self.batch_lane is not None
+            and origin in self.batch_origins
+            and isinstance(handler, AnthropicBatchMessageHandler)
+        ):
+            self.batch_lane.add(
+                anthropic_call, handler, AnthropicMessage(channel_id, personality)
+            )
+            return
+        await self.call_storage.record_key(anthropic_call, lane=origin)
+        self._prefetch_wakeup.set()
+
+    def _start_call(self, anthropic_call: AnthropicCall) -> Tuple[dict, float]:
+        """
+        Record the metrics of a call about to be handled.
+
+        Returns the metric labels of the call and when it was first requested.
+        """
+        labels = dict(
+            personality=anthropic_call.personality_name,
+            channel=anthropic_call.channel_id,
+        )
+        first_requested, _ = self.call_storage.request_times(anthropic_call) or (
+            time.monotonic(),
+            None,
+        )
+        metrics.observe("queued", time.monotonic() - first_requested, **labels)
+
+        lane = self.call_storage.lane(anthropic_call)
+        metrics.increment("calls", lane=lane.value if lane is not None else "none")
+        return labels, first_requested
 
     async def make_anthropic_call(self, anthropic_call: AnthropicCall):
         """
         Make an anthropic call for the given anthropic call data
         The call will happen as soon as possible.
         """
-        print(
-            "Scheduling anthropic call for personality: ",
+        logger.info(
+            "Handling call for personality: %s to channel: %s",
             anthropic_call.personality_name,
-            "to channel: ",
             anthropic_call.channel_id,
         )
         personality = self._get_personality(anthropic_call.personality_name)
-        print(
-            f"Handling call for personality: {personality.name} to channel: {anthropic_call.channel_id}"
-        )
         anthropic_message_handler = self.anthropic_message_handlers[
             anthropic_call.personality_name
         ]
 
-        await anthropic_message_handler.handle_anthropic_message(
-            AnthropicMessage(anthropic_call.channel_id, personality)
+        labels, first_requested = self._start_call(anthropic_call)
+        with metrics.span("handle_call", **labels):
+            await anthropic_message_handler.handle_anthropic_message(
+                AnthropicMessage(anthropic_call.channel_id, personality)
+            )
+
+        metrics.observe(
+            "mention_to_reply", time.monotonic() - first_requested, **labels
+        )
+
+    async def make_group_anthropic_call(self, anthropic_calls: List[AnthropicCall]):
+        """
+        Answer the calls of one channel with a single completion, or one by one
+        without a group message handler.
+        """
+        if self.group_message_handler is None:
+            await asyncio.gather(*(self.make_anthropic_call(x) for x in anthropic_calls))
+            return
+
+        channel_id = anthropic_calls[0].channel_id
+        logger.info(
+            "Handling call for personalities: %s to channel: %s",
+            [x.personality_name for x in anthropic_calls],
+            channel_id,
         )
+        started = [self._start_call(x) for x in anthropic_calls]
+        with metrics.span("handle_group_call", channel=channel_id):
+            await self.group_message_handler.handle_anthropic_messages(
+                [
+                    AnthropicMessage(
+                        x.channel_id, self._get_personality(x.personality_name)
+                    )
+                    for x in anthropic_calls
+                ]
+            )
+
+        for labels, first_requested in started:
+            metrics.observe(
+                "mention_to_reply", time.monotonic() - first_requested, **labels
+            )
+
+    def export_pending_calls(self) -> List[PendingCall]:
+        """
+        Get the pending calls with their request times as unix timestamps.
+        """
+        clock_offset = time.time() - time.monotonic()
+        return [
+            (
+                call.personality_name,
+                call.channel_id,
+                lane.value if lane is not None else None,
+                weight,
+                first_requested + clock_offset,
+                last_requested + clock_offset,
+            )
+            for call, lane, weight, first_requested, last_requested in (
+                self.call_storage.snapshot()
+            )
+        ]
+
+    async def restore_pending_calls(self, pending_calls: List[PendingCall]):
+        """
+        Resume the calls which were pending before a restart.
+
+        Calls of personalities without a registered handler are dropped, calls past
+        their deadline expire on the next sample.
+        """
+        clock_offset = time.monotonic() - time.time()
+        restored = 0
+        for name, channel_id, lane, weight, first, last in pending_calls:
+            if name not in self.anthropic_message_handlers:
+                logger.info("Dropping pending call of unknown personality: %s", name)
+                continue
+            await self.call_storage.restore_key(
+                AnthropicCall(name, channel_id),
+                MentionOrigin(lane) if lane is not None else None,
+                weight,
+                first + clock_offset,
+                last + clock_offset,
+            )
+            restored += 1
+        logger.info("Restored %s pending calls", restored)
 
     async def silence_bots(self):
         """
@@ -74,6 +307,8 @@ class AnthropicScheduler:
         This will clear all pending requests to speak.
         """
         await self.call_storage.clear_counts()
+        if self.batch_lane is not None:
+            self.batch_lane.discard(lambda call: True)
 
     async def silence_bot(self, personality_name: str):
         """
@@ -81,14 +316,102 @@ class AnthropicScheduler:
 
         This will clear the pending request to speak for the given personality.
         """
-        await self.call_storage.clear_count_for_key(personality_name)
+        await self.call_storage.clear_counts_by("personality", personality_name)
+        if self.batch_lane is not None:
+            self.batch_lane.discard(
+                lambda call: call.personality_name == personality_name
+            )
+
+    def is_channel_muted(self, channel_id: int) -> bool:
+        muted_until = self._muted_channels.get(channel_id)
+        if muted_until is None:
+            return False
+        if muted_until <= time.monotonic():
+            del self._muted_channels[channel_id]
+            return False
+        return True
+
+    async def mute_channel(self, channel_id: int, seconds: Optional[float] = None):
+        """
+        Clear the pending calls to a channel and ignore new ones for the given time,
+        or until it is unmuted.
+        """
+        self._muted_channels[channel_id] = (
+            time.monotonic() + seconds if seconds is not None else float("inf")
+        )
+        await self.call_storage.clear_counts_by("channel", channel_id)
+        if self.batch_lane is not None:
+            self.batch_lane.discard(lambda call: call.channel_id == channel_id)
+
+    async def unmute_channel(self, channel_id: int):
+        self._muted_channels.pop(channel_id, None)
+
+    async def acquire_call_budget(self):
+        """
+        Wait for the rate limit to allow a call made outside of sampling, e.g. a
+        conversation summary.
+        """
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire()
+
+    async def pending_calls(self, channel_id: int) -> List[Tuple[str, int]]:
+        """
+        Get the personalities waiting to speak in a channel with their weights.
+        """
+        calls = self.call_storage.keys_by("channel", channel_id)
+        return sorted(
+            (
+                (call.personality_name, self.call_storage.pending_weight(call))
+                for call in calls
+            ),
+            key=lambda x: -x[1],
+        )
+
+    def _prefetch_likely_calls(self):
+        for anthropic_call in self.call_storage.likely_keys(self.prefetch_likely_calls):
+            handler = self.anthropic_message_handlers.get(
+                anthropic_call.personality_name
+            )
+            if isinstance(handler, AnthropicPrefetchHandler):
+                handler.prefetch_anthropic_message(
+                    AnthropicMessage(
+                        anthropic_call.channel_id,
+                        self._get_personality(anthropic_call.personality_name),
+                    )
+                )
+
+    async def _prefetch_loop(self):
+        """
+        Keep the contexts of the calls most likely to be selected next up to date.
+        """
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._prefetch_wakeup.wait(), self.prefetch_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._prefetch_wakeup.clear()
+            try:
+                self._prefetch_likely_calls()
+            except Exception:
+                logger.exception("Failed to prefetch contexts")
 
     async def run(self):
         """
         Start the scheduler with the given event loop
         """
-        print("Starting AnthropicScheduler")
-        return await self.call_storage.run()
+        logger.info("Starting AnthropicScheduler")
+        tasks = []
+        if self.batch_lane is not None:
+            tasks.append(asyncio.create_task(self.batch_lane.run()))
+        if self.prefetch_likely_calls:
+            tasks.append(asyncio.create_task(self._prefetch_loop()))
+        try:
+            return await self.call_storage.run()
+        finally:
+            for task in tasks:
+                task.cancel()
 
     async def stop(self):
         await self.call_storage.stop()
@@ -1,10 +1,55 @@
 from src.personality import Personality
 from src.discord_bot import DiscordService
 from src.messenger import DiscordMessage
+from src.summary import ConversationSummarizer
+from src.metrics import metrics
+from src.errors import BackoffError
 import discord
-from typing import List
+from src.log import get_logger
+from typing import Dict, List, Optional, Tuple
+import asyncio
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
+
+logger = get_logger(__name__)
+
+# Rough estimate, good enough to keep a prompt within budget
+CHARS_PER_TOKEN = 4
+
+# Message cache, member index and summary versions a context was built from
+Freshness = Tuple[int, Optional[int], Optional[int]]
+
+PING_RULES = (
+    "You can ping people with an @name here to talk to them. Don't add punctuation to the names like commas or apostrophes or periods. "
+    "You should only ping people in conversations if you want a response from them. If you don't  want a response, just mention their name without the @ symbol so you don't ping them."
+    "Don't add underscores or formatting. Don't misspell or mis-format names when referring to others even if that interferes with your other directives."
+    "\nYou should only ping others if the following conditions are met:"
+    "\n1. You want to talk to them."
+    "\n2. They have something to add to the conversation."
+    "\n3. The conversation is not getting repetitive."
+    "\n4. The conversation is not coming to a natural close."
+    "\n5. You should minimize the number of pings you send."
+    "\n6. You should minimize the number of people you ping if you choose to ping people."
+    "\nExamples:"
+    "\nINCORRECT format 1:"
+    "\nOther Bot"
+    "\nINCORRECT format 2:"
+    "\n @Other Bot's idea"
+    "\nINCORRECT format 3:"
+    "\n @OtherBot."
+    "\nCORRECT format 1:"
+    "\n @Other Bot 's idea"
+    "\nCORRECT format 2:"
+    "\n @Other Bot ."
+    "The following are the members of the server who you can ping to talk to: "
+)
+
+
+@dataclass
+class SystemBlock:
+    text: str
+    # Cache everything up to and including this block
+    cache_breakpoint: bool = False
 
 
 @dataclass
@@ -13,12 +58,37 @@ class AnthropicContext:
     system_directive: str
     larping_allowed: bool
     name: str
+    # Same text as system_directive split into blocks, most static first
+    system_blocks: List[SystemBlock] = field(default_factory=list)
+    channel_id: Optional[int] = None
 
 
 class ContextBuilder:
-    def __init__(self, discord_service: DiscordService, personality: Personality):
+    def __init__(
+        self,
+        discord_service: DiscordService,
+        personality: Personality,
+        history_token_budget: Optional[int] = None,
+        summarizer: Optional[ConversationSummarizer] = None,
+        prefetch_limiter: Optional[asyncio.Semaphore] = None,
+    ):
+        """
+        Args:
+            history_token_budget: Fill the message history newest first up to this many
+                tokens instead of sending the last message_history_limit messages
+            summarizer: Folds messages which left the history window into a summary
+            prefetch_limiter: Semaphore shared between builders to cap the number of
+                contexts prefetched at once
+        """
         self.discord_service = discord_service
         self.personality = personality
+        self.history_token_budget = history_token_budget
+        self.summarizer = summarizer
+        # Guild id to (member index version, system blocks)
+        self._system_blocks: Dict[int, Tuple[int, List[SystemBlock]]] = {}
+        self.prefetch_limiter = prefetch_limiter
+        # Channel id to the task building its context ahead of time
+        self._prefetched: Dict[int, asyncio.Task] = {}
 
     def _build_personality_context(self) -> str:
         """
@@ -26,37 +96,19 @@ class ContextBuilder:
         """
         return self.personality.build_context()
 
-    def _build_ping_context(self, channel: discord.TextChannel) -> str:
+    def _build_ping_context(self) -> str:
         """
         Build context to allow bots to ping each other.
         """
-        server_members = [x.display_name for x in channel.guild.members]
-        discord_guild_context = (
-            "You can ping people with an @name here to talk to them. Don't add punctuation to the names like commas or apostrophes or periods. "
-            "You should only ping people in conversations if you want a response from them. If you don't  want a response, just mention their name without the @ symbol so you don't ping them."
-            "Don't add underscores or formatting. Don't misspell or mis-format names when referring to others even if that interferes with your other directives."
-            "\nYou should only ping others if the following conditions are met:"
-            "\n1. You want to talk to them."
-            "\n2. They have something to add to the conversation."
-            "\n3. The conversation is not getting repetitive."
-            "\n4. The conversation is not coming to a natural close."
-            "\n5. You should minimize the number of pings you send."
-            "\n6. You should minimize the number of people you ping if you choose to ping people."
-            "\nExamples:"
-            "\nINCORRECT format 1:"
-            "\nOther Bot"
-            "\nINCORRECT format 2:"
-            "\n @Other Bot's idea"
-            "\nINCORRECT format 3:"
-            "\n @OtherBot."
-            "\nCORRECT format 1:"
-            "\n @Other Bot 's idea"
-            "\nCORRECT format 2:"
-            "\n @Other Bot ."
-            "The following are the members of the server who you can ping to talk to: "
-            + ", ".join(server_members)
-        )
-        return discord_guild_context
+        return PING_RULES
+
+    def _build_ping_members_context(self, channel: discord.TextChannel) -> str:
+        """
+        Build the list of members the bot can ping.
+        """
+        member_index = self.discord_service.get_member_index(channel.guild)
+        server_members = member_index.display_names(channel.guild.id)
+        return ", ".join(server_members)
 
     def _build_chat_history_context(self, channel: discord.TextChannel) -> str:
         """
@@ -90,26 +142,193 @@ class ContextBuilder:
         ]
         return anthropic_messages
 
+    @staticmethod
+    def _estimate_tokens(message: DiscordMessage) -> int:
+        return (len(message.author) + len(message.content)) // CHARS_PER_TOKEN + 1
+
+    def _build_budgeted_message_history(
+        self, channel_id: int, messages: List[DiscordMessage]
+    ) -> List[dict]:
+        """
+        Build the most recent messages that fit in the token budget.
+
+        Messages which scrolled out of the budget or aged out of the history are folded
+        into the channel summary.
+        """
+        messages = [x for x in messages if not self._message_is_whitespace(x)]
+        window = []
+        used_tokens = 0
+        for message in reversed(messages):
+            tokens = self._estimate_tokens(message)
+            if used_tokens + tokens > self.history_token_budget:
+                if not window:
+                    # Always keep the newest message, truncated to the budget
+                    window.append(
+                        replace(
+                            message,
+                            content=message.content[
+                                : self.history_token_budget * CHARS_PER_TOKEN
+                            ],
+                        )
+                    )
+                break
+            window.append(message)
+            used_tokens += tokens
+        window.reverse()
+
+        if self.summarizer is not None:
+            self.summarizer.fold(channel_id, messages, window)
+
+        return self._build_message_history(window)
+
+    def _build_summary_block(self, channel_id: int) -> Optional[SystemBlock]:
+        """
+        Build the summary of older messages which no longer fit in the history.
+        """
+        if self.summarizer is None:
+            return None
+        summary = self.summarizer.get_summary(channel_id)
+        if summary is None:
+            return None
+        return SystemBlock(f"\nSummary of the earlier conversation: {summary}")
+
     def _build_response_length_directive(self) -> str:
         """
         Build the directive for the response length of the bot.
         """
         return "The longer your response is the more it will cost you personally to send it. Your response should generally be less than a paragraph long."
 
+    def _build_system_blocks(self, channel: discord.TextChannel) -> List[SystemBlock]:
+        """
+        Build the system directive for the bot as prompt cacheable blocks.
+
+        The personality and ping rules never change so they are cached on their own,
+        the member list only changes with the guild members.
+        Memoized per guild until the members of the guild change.
+        """
+        member_index = self.discord_service.get_member_index(channel.guild)
+        version = member_index.version(channel.guild.id)
+        cached = self._system_blocks.get(channel.guild.id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        system_blocks = [
+            SystemBlock(
+                f"{self._build_personality_context()}\n{self._build_ping_context()}",
+                cache_breakpoint=True,
+            ),
+            SystemBlock(
+                f"{self._build_ping_members_context(channel)}\n{self._build_response_length_directive()}",
+                cache_breakpoint=True,
+            ),
+        ]
+        self._system_blocks[channel.guild.id] = (version, system_blocks)
+        return system_blocks
+
     def _build_system_directive(self, channel: discord.TextChannel) -> str:
         """
         Build the system directive for the bot.
         """
-        return f"{self._build_personality_context()}\n{self._build_ping_context(channel)}\n{self._build_response_length_directive()}"
+        return "".join(block.text for block in self._build_system_blocks(channel))
+
+    def _freshness(self, channel_id: int) -> Freshness:
+        """
+        Versions of everything a context is built from which changes over time.
+        """
+        member_version = None
+        channel = self.discord_service.get_channel(channel_id)
+        if channel is not None:
+            member_index = self.discord_service.get_member_index(channel.guild)
+            member_version = member_index.version(channel.guild.id)
+        summary_version = None
+        if self.summarizer is not None:
+            summary_version = self.summarizer.version(channel_id)
+        return (
+            self.discord_service.message_cache.version(channel_id),
+            member_version,
+            summary_version,
+        )
+
+    def prefetch(self, channel_id: int):
+        """
+        Build the context of a channel in the background, so build_context can return
+        it right away. Does nothing while the prefetched context is still fresh.
+        """
+        task = self._prefetched.get(channel_id)
+        if task is not None and not task.done():
+            # Refreshed on the next prefetch once this build is done
+            return
+        if self.discord_service.get_channel(channel_id) is None:
+            # Unknown channel, nothing to build ahead of time
+            return
+        if (
+            task is not None
+            and not task.cancelled()
+            and task.exception() is None
+            and task.result()[0] == self._freshness(channel_id)
+        ):
+            return
+        self._prefetched[channel_id] = asyncio.create_task(
+            self._prefetch(channel_id)
+        )
+
+    async def _prefetch(
+        self, channel_id: int
+    ) -> Tuple[Freshness, AnthropicContext]:
+        if self.prefetch_limiter is None:
+            freshness = self._freshness(channel_id)
+            return freshness, await self._build_context(channel_id)
+        async with self.prefetch_limiter:
+            freshness = self._freshness(channel_id)
+            return freshness, await self._build_context(channel_id)
 
     async def build_context(self, channel_id: int) -> AnthropicContext:
+        """
+        Build the context of a channel, reusing the prefetched one if it is fresh.
+        """
+        task = self._prefetched.pop(channel_id, None)
+        if task is not None:
+            try:
+                freshness, context = await task
+            except Exception:
+                logger.exception("Context prefetch failed for channel: %s", channel_id)
+            else:
+                if freshness == self._freshness(channel_id):
+                    metrics.increment("context_prefetch", result="hit")
+                    return context
+                metrics.increment("context_prefetch", result="stale")
+        return await self._build_context(channel_id)
+
+    async def _build_context(self, channel_id: int) -> AnthropicContext:
         channel = self.discord_service.get_channel(channel_id)
-        messages = await self.discord_service.get_messages(channel)
-        anthropic_messages = self._build_message_history(messages)
-        system_directive = self._build_system_directive(channel)
+        if channel is None:
+            # Not cached until the client is ready, e.g. a call restored at startup
+            raise BackoffError()
+        labels = dict(personality=self.personality.name, channel=channel_id)
+        with metrics.span("history_fetch", **labels):
+            if self.history_token_budget is None:
+                messages = await self.discord_service.get_messages(channel)
+                anthropic_messages = self._build_message_history(messages)
+            else:
+                messages = await self.discord_service.get_messages(
+                    channel,
+                    limit=self.discord_service.message_cache.max_messages_per_channel,
+                )
+                anthropic_messages = self._build_budgeted_message_history(
+                    channel_id, messages
+                )
+
+        with metrics.span("directive_build", **labels):
+            system_blocks = self._build_system_blocks(channel)
+        summary_block = self._build_summary_block(channel_id)
+        if summary_block is not None:
+            # After the cached blocks so the summary doesn't invalidate them
+            system_blocks = [*system_blocks, summary_block]
         return AnthropicContext(
             anthropic_messages,
-            system_directive,
+            "".join(block.text for block in system_blocks),
             larping_allowed=self.personality.larping_allowed,
             name=self.personality.name,
+            system_blocks=system_blocks,
+            channel_id=channel_id,
         )
@@ -1,20 +1,107 @@
 import discord
 import datetime
-from src.messenger import DiscordMessageHandler, DiscordMessage
-from typing import List
+from src.messenger import DiscordMessageHandler, DiscordMessage, MentionOrigin
+from src.message_cache import ChannelMessageCache
+from src.mention_index import GuildMemberIndex
+from src.admin import AdminCommands
+from src.send_queue import ChannelSendQueue
+from src.metrics import metrics
+from src.log import get_logger
+from typing import Dict, List, Optional
+from dataclasses import replace
 import asyncio
 
 
+logger = get_logger(__name__)
+
+# Rate limits longer than this raise instead of sleeping, discord.py's minimum
+MAX_RATELIMIT_TIMEOUT = 30.0
+
+
+class SharedGateway:
+    def __init__(self):
+        """
+        Routes the events of a single listening client to every personality.
+
+        Only the listener holds a websocket and member cache, the other clients are
+        send-only and receive their mentions from here by user id.
+        """
+        self.listener: Optional["DiscordService"] = None
+        # Discord user id to the client of that personality
+        self._services: Dict[int, "DiscordService"] = {}
+
+    def register(self, service: "DiscordService"):
+        """
+        Route mentions of a logged in client to it.
+        """
+        logger.info("Routing mentions of %s through the shared gateway", service.user)
+        self._services[service.user.id] = service
+
+    def unregister(self, service: "DiscordService"):
+        if service.user is not None:
+            self._services.pop(service.user.id, None)
+
+    def mentioned_services(self, message: discord.Message) -> List["DiscordService"]:
+        """
+        Get the clients mentioned in a message, except the one which sent it.
+        """
+        services = []
+        for user in message.mentions:
+            service = self._services.get(user.id)
+            if service is not None and user.id != message.author.id:
+                services.append(service)
+        return services
+
+
 class DiscordService(discord.Client):
-    def __init__(self, discord_token: str):
+    def __init__(
+        self,
+        discord_token: str,
+        message_cache: Optional[ChannelMessageCache] = None,
+        member_index: Optional[GuildMemberIndex] = None,
+        gateway: Optional[SharedGateway] = None,
+        send_only: bool = False,
+        admin_commands: Optional[AdminCommands] = None,
+        send_queue: Optional[ChannelSendQueue] = None,
+        personality_name: Optional[str] = None,
+    ):
+        """
+        Args:
+            gateway: Share one listening client between every personality
+            send_only: Log in over REST without a websocket, events come from the
+                listener of the gateway
+            admin_commands: Answer admin commands of moderators, given to one client
+                so a command gets one reply
+            send_queue: Outbound queue shared between every bot so replies to a
+                channel are paced together
+            personality_name: Label of the metrics of this client, defaults to the
+                display name of its user
+        """
         intents = discord.Intents.default()
-        intents.message_content = True
-        intents.members = True
+        intents.message_content = not send_only
+        intents.members = not send_only
         self.discord_token = discord_token
-        super().__init__(intents=intents)
+        # The send queue waits out long rate limits instead of the HTTP client
+        super().__init__(intents=intents, max_ratelimit_timeout=MAX_RATELIMIT_TIMEOUT)
+        self.gateway = gateway
+        self.send_only = send_only
+        self.admin_commands = admin_commands
+        self.personality_name = personality_name
+        # Set once the gateway delivered the guilds, so get_channel can find them
+        self._listening = asyncio.Event()
+        if gateway is not None and not send_only:
+            gateway.listener = self
         self._main_channels = {}
         self.message_history_limit = 20
         self.messenger: DiscordMessageHandler = None
+        # Shared between every bot so channel history is only fetched once
+        self.message_cache = (
+            message_cache if message_cache is not None else ChannelMessageCache()
+        )
+        self.member_index = (
+            member_index if member_index is not None else GuildMemberIndex()
+        )
+        self.send_queue = send_queue if send_queue is not None else ChannelSendQueue()
 
     def get_main_channel(self, guild: str) -> discord.TextChannel:
         """
@@ -23,17 +110,17 @@ class DiscordService(discord.Client):
         if guild in self._main_channels:
             return self._main_channels[guild]
 
-        print(f"Cache miss for getting main channel in guild: {guild}")
+        logger.debug("Cache miss for getting main channel in guild: %s", guild)
 
         for channel in guild.text_channels:
             if channel.name == "general":
-                print(f"Found main channel in guild: {channel}")
+                logger.debug("Found main channel in guild: %s", channel)
                 self._main_channels[guild] = channel
                 return channel
 
         # If no main channel is found, use the first text channel
         for channel in guild.text_channels:
-            print(f"Using random channel in guild: {channel}")
+            logger.debug("Using random channel in guild: %s", channel)
             self._main_channels[guild] = channel
             return channel
 
@@ -41,41 +128,18 @@ class DiscordService(discord.Client):
         """
         Send a message to the general channel of a guild.
         """
-        print("Sending discord message")
+        logger.debug("Sending discord message")
         channel = self.get_main_channel(guild)
         await channel.send(message)
 
-    @staticmethod
-    def _find_permutations_of_removed_punctuation(words: List[str]) -> List[str]:
-        punctuations = [
-            ",",
-            ".",
-            "!",
-            "?",
-            ";",
-            ":",
-            "(",
-            ")",
-            "[",
-            "]",
-            "{",
-            "}",
-            "'",
-            '"',
-        ]
-        possible_permutations = []
-        for word in words:
-            for punctuation in punctuations:
-                possible_permutations.append(word.replace(punctuation, ""))
-        return possible_permutations
-
-    @staticmethod
-    def _find_permutations_of_words(words: List[str]) -> List[str]:
-        possible_display_names = []
-        words = [x.lstrip("@") for x in words]
-        for i in range(1, len(words)):
-            possible_display_names.append(" ".join(words[0:i]))
-        return possible_display_names
+    def get_member_index(self, guild: discord.Guild) -> GuildMemberIndex:
+        """
+        Get the member index, building the guild from its member list on first use.
+        """
+        if not self.member_index.has_guild(guild.id):
+            logger.info("Building member index for guild: %s", guild)
+            self.member_index.build_guild(guild.id, guild.members)
+        return self.member_index
 
     async def _replace_mentions(
         self, message: str, channel: discord.TextChannel
@@ -83,53 +147,73 @@ class DiscordService(discord.Client):
         MAX_NUMBER_OF_WORDS_IN_A_NAME = 10
         # Find all @mentions in the message
         words = message.split()
+        member_index = self.get_member_index(channel.guild)
 
-        for i in range(len(words)):
-            try:
-                current_word = words[i]
-            except IndexError:
-                break
+        replaced_words = []
+        i = 0
+        while i < len(words):
+            current_word = words[i]
+            match = None
+            if current_word.startswith("@"):
+                match = member_index.longest_match(
+                    channel.guild.id, words[i : i + MAX_NUMBER_OF_WORDS_IN_A_NAME]
+                )
 
-            if not current_word.startswith("@"):
+            if match is None:
+                replaced_words.append(current_word)
+                i += 1
                 continue
 
-            possible_display_names = (
-                DiscordService._find_permutations_of_removed_punctuation(
-                    DiscordService._find_permutations_of_words(
-                        words[i : i + MAX_NUMBER_OF_WORDS_IN_A_NAME]
-                    )
-                )
-            )
-            possible_display_names = list(set(possible_display_names))
-
-            for possible_display_name in possible_display_names:
-                possible_display_name_length = len(possible_display_name.split())
-                for member in channel.guild.members:
-                    if member.display_name == possible_display_name:
-                        print("Pinging member:", member)
-                        words[i] = member.mention
-                        # Remove the extra words that were part of the display name
-                        for _ in range(possible_display_name_length - 1):
-                            if i + 1 < len(words):
-                                words.pop(i + 1)
-                        break
-
-        message = " ".join(words)
+            mention, display_name_length = match
+            logger.debug("Pinging member: %s", mention)
+            replaced_words.append(mention)
+            # Skip the extra words that were part of the display name
+            i += display_name_length
+
+        message = " ".join(replaced_words)
         return message
 
-    async def send_message(self, message: str, channel_id: int):
+    def get_channel(self, id: int):
+        """
+        Get a cached channel, send-only clients have no cache and read the listener's.
+        """
+        if self.send_only:
+            return self.gateway.listener.get_channel(id)
+        return super().get_channel(id)
+
+    def _sendable_channel(self, channel_id: int) -> discord.abc.Messageable:
+        """
+        Get a channel to send to as this client.
+        """
+        if self.send_only:
+            return self.get_partial_messageable(channel_id)
+        return self.get_channel(channel_id)
+
+    async def send_message(self, message: str, channel_id: int) -> asyncio.Future:
         """
-        Send a message to a specific channel.
+        Queue a message for a specific channel.
+
+        Returns a future resolved once the message is sent, failures are logged by
+        the send queue so callers don't need to wait for it.
         """
         if not message:
-            return
+            return self.send_queue.enqueue(channel_id, self.user.id, message, None)
 
         channel = self.get_channel(channel_id)
 
-        message = await self._replace_mentions(message, channel)
+        with metrics.span("mention_rewrite", channel=channel_id):
+            message = await self._replace_mentions(message, channel)
 
-        print("Sending discord message")
-        await channel.send(message)
+        logger.debug("Queueing discord message")
+        return self.send_queue.enqueue(
+            channel_id, self.user.id, message, self._sendable_channel(channel_id).send
+        )
+
+    def typing(self, channel_id: int):
+        """
+        Show the typing indicator in a channel for the duration of the context manager.
+        """
+        return self._sendable_channel(channel_id).typing()
 
     def _strip_mentions(self, message: discord.Message) -> str:
         """
@@ -146,45 +230,189 @@ class DiscordService(discord.Client):
             ).replace(f"<@!{mention.id}>", f"@{mention.display_name}")
         return cleaned_message
 
+    def _to_discord_message(self, message: discord.Message) -> DiscordMessage:
+        """
+        Convert a discord message to a bot independent DiscordMessage for the cache.
+        """
+        return DiscordMessage(
+            author=message.author.display_name,
+            content=self._strip_mentions(message).strip(),
+            timestamp=message.created_at,
+            sent_by_me=False,
+            message_id=message.id,
+            author_id=message.author.id,
+        )
+
+    async def _fetch_messages(
+        self, channel: discord.TextChannel, after: datetime.datetime, limit: int
+    ) -> List[DiscordMessage]:
+        """
+        Fetch the newest messages after a time from the REST API.
+        """
+        return [
+            self._to_discord_message(message)
+            async for message in channel.history(
+                limit=limit, oldest_first=False, after=after
+            )
+        ]
+
+    def _fetch_limit(self, missing_after: Optional[datetime.datetime]) -> int:
+        if missing_after is None:
+            return self.message_history_limit
+        # Resuming a restored channel, fetching as many messages as the cache keeps
+        # either reaches its newest message or replaces every restored one, so the
+        # cache never has a gap
+        return max(
+            self.message_history_limit, self.message_cache.max_messages_per_channel
+        )
+
     async def get_messages(
-        self, channel: discord.TextChannel, hours=1
+        self, channel: discord.TextChannel, hours=1, limit: Optional[int] = None
     ) -> list[DiscordMessage]:
         """
-        Fetch messages from the last hour.
+        Get messages from the last hour.
+
+        At most message_history_limit messages unless a limit is given.
         """
-        messages = []
         one_hour_ago = datetime.datetime.now(
             datetime.timezone.utc
         ) - datetime.timedelta(hours=hours)
-        async for message in channel.history(
-            limit=self.message_history_limit, oldest_first=False, after=one_hour_ago
+        messages = await self.message_cache.get_messages(
+            channel.id,
+            lambda missing_after: self._fetch_messages(
+                channel,
+                max(one_hour_ago, missing_after) if missing_after else one_hour_ago,
+                self._fetch_limit(missing_after),
+            ),
+            after=one_hour_ago,
+            limit=limit if limit is not None else self.message_history_limit,
+        )
+        return [
+            replace(message, sent_by_me=message.author_id == self.user.id)
+            for message in messages
+        ]
+
+    async def on_message(self, message: discord.Message):
+        """Handle incoming messages"""
+        self.message_cache.add_message(
+            message.channel.id, self._to_discord_message(message)
+        )
+
+        # Bots, including this one replying with the usage, can't run admin commands
+        if (
+            self.admin_commands is not None
+            and not message.author.bot
+            and message.author != self.user
+            and self.admin_commands.is_command(message.content)
         ):
-            messages.append(
-                DiscordMessage(
-                    author=message.author.display_name,
-                    content=self._strip_mentions(message).strip(),
-                    timestamp=message.created_at,
-                    sent_by_me=message.author == self.user,
+            await self._handle_admin_command(message)
+            return
+
+        if self.gateway is not None:
+            # Every personality's mentions arrive through this client
+            await asyncio.gather(
+                *(
+                    service.handle_mention(message)
+                    for service in self.gateway.mentioned_services(message)
                 )
             )
-        return sorted(messages, key=lambda x: x.timestamp)
+            return
 
-    async def on_message(self, message: discord.Message):
-        """Handle incoming messages"""
         # Ignore own messages
         if message.author == self.user:
             return
 
         # Check if the bot was mentioned
         if self.user in message.mentions:
+            await self.handle_mention(message)
+
+    async def _handle_admin_command(self, message: discord.Message):
+        permissions = getattr(message.author, "guild_permissions", None)
+        if permissions is None or not permissions.manage_messages:
+            logger.info("Ignoring admin command from %s", message.author)
+            return
+        reply = await self.admin_commands.handle(message.content, message.channel.id)
+        await self.send_message(reply, message.channel.id)
+
+    async def handle_mention(self, message: discord.Message):
+        """
+        Hand a message mentioning this bot to the messenger.
+        """
+        with metrics.span(
+            "mention_received",
+            personality=self.personality_name or self.user.display_name,
+            channel=message.channel.id,
+        ):
             # Remove all user mentions from the message
             recent_messages = await self.get_messages(message.channel)
             await self.messenger.handle_discord_message(
-                recent_messages, message.channel.id
+                recent_messages,
+                message.channel.id,
+                origin=MentionOrigin.BOT if message.author.bot else MentionOrigin.HUMAN,
             )
 
     async def run(self):
-        await self.start(self.discord_token)
+        if not self.send_only:
+            await self.start(self.discord_token)
+            return
+
+        async with self:
+            await self.login(self.discord_token)
+            self.gateway.register(self)
+            try:
+                # Keep the HTTP session open, the listener delivers the events
+                await asyncio.Future()
+            finally:
+                self.gateway.unregister(self)
+
+    async def on_message_edit(self, before: discord.Message, after: discord.Message):
+        self.message_cache.edit_message(
+            after.channel.id, after.id, self._strip_mentions(after).strip()
+        )
+
+    async def on_message_delete(self, message: discord.Message):
+        self.message_cache.delete_message(message.channel.id, message.id)
+
+    async def on_member_join(self, member: discord.Member):
+        self.member_index.add_member(member.guild.id, member)
+
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        if before.display_name != after.display_name:
+            self.member_index.add_member(after.guild.id, after)
+
+    async def on_user_update(self, before: discord.User, after: discord.User):
+        if before.display_name == after.display_name:
+            return
+        for guild in after.mutual_guilds:
+            member = guild.get_member(after.id)
+            if member is not None:
+                self.member_index.add_member(guild.id, member)
+
+    async def on_member_remove(self, member: discord.Member):
+        self.member_index.remove_member(member.guild.id, member.id)
+
+    async def on_guild_remove(self, guild: discord.Guild):
+        self.member_index.remove_guild(guild.id)
 
     async def on_ready(self):
-        print(f"Logged in as {self.user}")
+        logger.info("Logged in as %s", self.user)
+        if self.gateway is not None:
+            self.gateway.register(self)
+        self.message_cache.listener_connected(self)
+        self._listening.set()
+
+    async def wait_until_listening(self):
+        """
+        Wait until the channels are cached, for send-only clients in the listener.
+        """
+        if self.send_only:
+            await self.gateway.listener.wait_until_listening()
+        else:
+            await self._listening.wait()
+
+    async def on_resumed(self):
+        # Missed events are replayed on resume so the cache has no gap
+        self.message_cache.listener_connected(self)
+
+    async def on_disconnect(self):
+        self.message_cache.listener_disconnected(self)
@@ -1,2 +1,25 @@
+from typing import Optional
+
+
 class TimeoutError(Exception):
     pass
+
+
+class BackoffError(Exception):
+    """
+    Raised by a sampler output function when the key should be retried later.
+    """
+
+    def __init__(self, retry_after: Optional[float] = None):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class RateLimitedError(BackoffError):
+    pass
+
+
+class ServiceUnavailableError(BackoffError):
+    """
+    Raised when the API keeps failing or the circuit breaker is open.
+    """
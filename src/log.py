@@ -0,0 +1,108 @@
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional, TextIO, Tuple
+import logging
+import queue
+import sys
+import time
+
+ROOT_LOGGER_NAME = "claudebot"
+# Level which disables logging entirely
+OFF = logging.CRITICAL + 1
+
+_listener: Optional[QueueListener] = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"{ROOT_LOGGER_NAME}.{name}")
+
+
+class _DeferredFormattingQueueHandler(QueueHandler):
+    """
+    Enqueue records without formatting them, the listener thread formats them.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, max_per_interval: int, interval: float = 1.0):
+        """
+        Sample noisy lines by letting through at most max_per_interval records of the
+        same message template per interval. Warnings and errors are never dropped.
+        """
+        super().__init__()
+        self.max_per_interval = max_per_interval
+        self.interval = interval
+        # Template to (window start, records in window, suppressed records)
+        self._windows: Dict[Tuple[str, object], Tuple[float, int, int]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        window_start, count, suppressed = self._windows.get(key, (now, 0, 0))
+        if now - window_start >= self.interval:
+            if suppressed:
+                record.msg = f"{record.msg} (+{suppressed} similar suppressed)"
+            window_start, count, suppressed = now, 0, 0
+
+        if count < self.max_per_interval:
+            self._windows[key] = (window_start, count + 1, suppressed)
+            return True
+
+        self._windows[key] = (window_start, count, suppressed + 1)
+        return False
+
+
+def configure_logging(
+    level="INFO",
+    stream: TextIO = sys.stdout,
+    max_lines_per_second: Optional[int] = 20,
+):
+    """
+    Log through a queue so formatting and writing happen on a background thread
+    instead of blocking the event loop.
+
+    Args:
+        level: Logging level name or number, "OFF" disables logging
+        max_lines_per_second: Rate limit for each message template, None to log everything
+    """
+    global _listener
+    stop_logging()
+
+    if isinstance(level, str):
+        level = OFF if level.upper() == "OFF" else logging.getLevelName(level.upper())
+
+    logger = logging.getLogger(ROOT_LOGGER_NAME)
+    logger.setLevel(level)
+    logger.propagate = False
+    logger.handlers.clear()
+    if level >= OFF:
+        return
+
+    stream_handler = logging.StreamHandler(stream)
+    stream_handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _DeferredFormattingQueueHandler(log_queue)
+    if max_lines_per_second is not None:
+        queue_handler.addFilter(RateLimitFilter(max_lines_per_second))
+    logger.addHandler(queue_handler)
+
+    _listener = QueueListener(log_queue, stream_handler)
+    _listener.start()
+
+
+def stop_logging():
+    """
+    Flush the queued records and stop the background thread.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,127 @@
+from typing import Dict, List, Optional, Tuple
+
+PUNCTUATION = ",.!?;:()[]{}'\""
+
+
+def normalize_name_token(word: str) -> str:
+    """
+    Normalize a word so names match regardless of @ prefixes and punctuation.
+    """
+    return word.lstrip("@").translate(str.maketrans("", "", PUNCTUATION))
+
+
+class _TrieNode:
+    def __init__(self):
+        self.children: Dict[str, "_TrieNode"] = {}
+        # Member id to mention of every member whose display name ends here
+        self.mentions: Dict[int, str] = {}
+
+
+class GuildMemberIndex:
+    def __init__(self):
+        """
+        Token trie of member display names per guild used to resolve @name pings.
+
+        Kept current from member join, update and leave events instead of scanning
+        the member list for every outgoing message.
+        """
+        self._roots: Dict[int, _TrieNode] = {}
+        self._member_tokens: Dict[int, Dict[int, List[str]]] = {}
+        self._display_names: Dict[int, Dict[int, str]] = {}
+        # Bumped whenever the members of a guild change so dependants can invalidate
+        self._versions: Dict[int, int] = {}
+
+    @staticmethod
+    def _tokenize(display_name: str) -> List[str]:
+        return [normalize_name_token(word) for word in display_name.split()]
+
+    def has_guild(self, guild_id: int) -> bool:
+        return guild_id in self._roots
+
+    def build_guild(self, guild_id: int, members) -> None:
+        """
+        (Re)build the index of a guild from its member list.
+        """
+        self._roots[guild_id] = _TrieNode()
+        self._member_tokens[guild_id] = {}
+        self._display_names[guild_id] = {}
+        for member in members:
+            self.add_member(guild_id, member)
+        self._bump_version(guild_id)
+
+    def _bump_version(self, guild_id: int) -> None:
+        self._versions[guild_id] = self._versions.get(guild_id, 0) + 1
+
+    def version(self, guild_id: int) -> int:
+        return self._versions.get(guild_id, 0)
+
+    def display_names(self, guild_id: int) -> List[str]:
+        """
+        Display names of the members of a guild in a deterministic order.
+        """
+        return sorted(
+            self._display_names.get(guild_id, {}).values(),
+            key=lambda name: (name.casefold(), name),
+        )
+
+    def add_member(self, guild_id: int, member) -> None:
+        """
+        Add or update a member, any previous display name is replaced.
+        """
+        if guild_id not in self._roots:
+            return
+        self.remove_member(guild_id, member.id)
+        tokens = self._tokenize(member.display_name)
+        if not tokens:
+            return
+
+        node = self._roots[guild_id]
+        for token in tokens:
+            node = node.children.setdefault(token, _TrieNode())
+        node.mentions[member.id] = member.mention
+        self._member_tokens[guild_id][member.id] = tokens
+        self._display_names[guild_id][member.id] = member.display_name
+        self._bump_version(guild_id)
+
+    def remove_member(self, guild_id: int, member_id: int) -> None:
+        tokens = self._member_tokens.get(guild_id, {}).pop(member_id, None)
+        if tokens is None:
+            return
+        self._display_names[guild_id].pop(member_id, None)
+        self._bump_version(guild_id)
+
+        path = [self._roots[guild_id]]
+        for token in tokens:
+            path.append(path[-1].children[token])
+        path[-1].mentions.pop(member_id, None)
+
+        # Prune nodes which no longer lead to a member
+        for depth in range(len(tokens), 0, -1):
+            node = path[depth]
+            if node.children or node.mentions:
+                break
+            del path[depth - 1].children[tokens[depth - 1]]
+
+    def remove_guild(self, guild_id: int) -> None:
+        self._roots.pop(guild_id, None)
+        self._member_tokens.pop(guild_id, None)
+        self._display_names.pop(guild_id, None)
+        self._bump_version(guild_id)
+
+    def longest_match(
+        self, guild_id: int, words: List[str]
+    ) -> Optional[Tuple[str, int]]:
+        """
+        Find the longest member display name at the start of the words.
+
+        Returns the mention and the number of words it spans.
+        """
+        node = self._roots.get(guild_id)
+        match = None
+        for length, word in enumerate(words, start=1):
+            if node is None:
+                break
+            node = node.children.get(normalize_name_token(word))
+            if node is not None and node.mentions:
+                match = (next(iter(node.mentions.values())), length)
+        return match
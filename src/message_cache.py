@@ -0,0 +1,183 @@
+from collections import OrderedDict, defaultdict
+from dataclasses import replace
+from src.messenger import DiscordMessage
+from src.state_store import StateStore
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Set
+from src.log import get_logger
+import asyncio
+import datetime
+
+logger = get_logger(__name__)
+
+
+class ChannelMessageCache:
+    def __init__(
+        self,
+        max_messages_per_channel: int = 50,
+        journal: Optional[StateStore] = None,
+    ):
+        """
+        Process wide ring buffer of recent messages per channel.
+
+        Every DiscordService receives the same gateway events, so they all feed and read
+        the same cache instead of each fetching the channel history.
+
+        Args:
+            max_messages_per_channel: Number of most recent messages kept per channel
+            journal: Store recording every change so the cache survives a restart
+        """
+        self.max_messages_per_channel = max_messages_per_channel
+        self._messages: Dict[int, OrderedDict[int, DiscordMessage]] = {}
+        # Channels whose history is known to be complete since the last fetch
+        self._warm_channels: Set[int] = set()
+        self._fetch_locks: Dict[int, asyncio.Lock] = {}
+        self._connected_listeners: Set[Hashable] = set()
+        self._journal = journal
+        # Restored channels only need the messages sent since their newest message
+        self._resume_after: Dict[int, datetime.datetime] = {}
+        # Bumped on every change to a channel, so derived data can tell it is stale
+        self._versions: Dict[int, int] = defaultdict(int)
+
+    def _channel_messages(self, channel_id: int) -> OrderedDict:
+        if channel_id not in self._messages:
+            self._messages[channel_id] = OrderedDict()
+        return self._messages[channel_id]
+
+    def _sort(self, channel_id: int):
+        self._messages[channel_id] = OrderedDict(
+            sorted(
+                self._channel_messages(channel_id).items(),
+                key=lambda item: item[1].timestamp,
+            )
+        )
+
+    def _trim(self, channel_id: int):
+        messages = self._channel_messages(channel_id)
+        while len(messages) > self.max_messages_per_channel:
+            messages.popitem(last=False)
+
+    def add_message(self, channel_id: int, message: DiscordMessage):
+        """
+        Add a message received from the gateway.
+
+        Safe to call once per bot for the same message.
+        """
+        messages = self._channel_messages(channel_id)
+        if message.message_id in messages:
+            return
+        newest = next(reversed(messages.values()), None)
+        messages[message.message_id] = message
+        self._versions[channel_id] += 1
+        if self._journal is not None:
+            self._journal.message_added(channel_id, message)
+        # Gateway events can arrive out of order between clients
+        if newest is not None and newest.timestamp > message.timestamp:
+            self._sort(channel_id)
+        self._trim(channel_id)
+
+    def edit_message(self, channel_id: int, message_id: int, content: str):
+        messages = self._messages.get(channel_id)
+        if messages is None or message_id not in messages:
+            return
+        messages[message_id] = replace(messages[message_id], content=content)
+        self._versions[channel_id] += 1
+        if self._journal is not None:
+            self._journal.message_edited(channel_id, message_id, content)
+
+    def delete_message(self, channel_id: int, message_id: int):
+        messages = self._messages.get(channel_id)
+        if messages is not None and messages.pop(message_id, None) is not None:
+            self._versions[channel_id] += 1
+        if self._journal is not None:
+            self._journal.message_deleted(channel_id, message_id)
+
+    def _merge_fetched(self, channel_id: int, fetched: List[DiscordMessage]):
+        messages = self._channel_messages(channel_id)
+        for message in fetched:
+            if message.message_id not in messages and self._journal is not None:
+                self._journal.message_added(channel_id, message)
+            messages.setdefault(message.message_id, message)
+        self._sort(channel_id)
+        self._trim(channel_id)
+        self._warm_channels.add(channel_id)
+        self._versions[channel_id] += 1
+
+    async def get_messages(
+        self,
+        channel_id: int,
+        fetch: Callable[
+            [Optional[datetime.datetime]], Awaitable[List[DiscordMessage]]
+        ],
+        after: Optional[datetime.datetime] = None,
+        limit: Optional[int] = None,
+    ) -> List[DiscordMessage]:
+        """
+        Get the cached messages of a channel, oldest first.
+
+        Calls fetch to backfill from the REST API only when the channel is cold.
+        Concurrent callers for the same cold channel share one fetch. fetch is given
+        the time after which messages are missing, or None if the whole history is.
+        """
+        if channel_id not in self._warm_channels:
+            lock = self._fetch_locks.setdefault(channel_id, asyncio.Lock())
+            async with lock:
+                if channel_id not in self._warm_channels:
+                    logger.debug("Message cache miss for channel: %s", channel_id)
+                    fetched = await fetch(self._resume_after.get(channel_id))
+                    self._resume_after.pop(channel_id, None)
+                    self._merge_fetched(channel_id, fetched)
+
+        messages = list(self._channel_messages(channel_id).values())
+        if after is not None:
+            messages = [x for x in messages if x.timestamp > after]
+        if limit is not None:
+            messages = messages[-limit:]
+        return messages
+
+    def version(self, channel_id: int) -> int:
+        """
+        Get a number which changes whenever the messages of a channel change.
+        """
+        return self._versions[channel_id]
+
+    def restore(self, messages: Dict[int, List[DiscordMessage]]):
+        """
+        Load messages stored before a restart.
+
+        The channels stay cold, but their next fetch only asks for what was sent after
+        the newest restored message.
+        """
+        for channel_id, channel_messages in messages.items():
+            for message in channel_messages:
+                self._channel_messages(channel_id).setdefault(
+                    message.message_id, message
+                )
+            self._sort(channel_id)
+            self._trim(channel_id)
+            newest = next(reversed(self._messages[channel_id].values()), None)
+            if newest is not None:
+                self._resume_after[channel_id] = newest.timestamp
+        logger.info("Restored the message cache of %s channels", len(messages))
+
+    def invalidate(self, channel_id: Optional[int] = None):
+        """
+        Mark a channel, or every channel, as needing a fetch.
+        """
+        if channel_id is None:
+            self._warm_channels.clear()
+        else:
+            self._warm_channels.discard(channel_id)
+
+    def listener_connected(self, listener: Hashable):
+        self._connected_listeners.add(listener)
+
+    def listener_disconnected(self, listener: Hashable):
+        """
+        Once no client is receiving gateway events anymore messages can be missed.
+        """
+        self._connected_listeners.discard(listener)
+        if not self._connected_listeners:
+            logger.warning(
+                "All gateway listeners disconnected, invalidating message cache"
+            )
+            self.invalidate()
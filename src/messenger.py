@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
+from enum import Enum
 import datetime
 from typing import List
 from src.personality import Personality
@@ -11,6 +12,8 @@ class DiscordMessage:
     content: str
     timestamp: datetime
     sent_by_me: bool
+    message_id: int = 0
+    author_id: int = 0
 
     def __str__(self):
         return f"{self.author}: {self.content} ({self.timestamp.strftime('%Y-%m-%d %H:%M:%S')})"
@@ -19,6 +22,15 @@ class DiscordMessage:
         return str(self)
 
 
+class MentionOrigin(str, Enum):
+    """
+    Who sent the message mentioning a bot, used as the scheduling priority lane.
+    """
+
+    HUMAN = "human"
+    BOT = "bot"
+
+
 @dataclass
 class AnthropicMessage:
     channel_id: int
@@ -28,7 +40,10 @@ class AnthropicMessage:
 class DiscordMessageHandler(ABC):
     @abstractmethod
     async def handle_discord_message(
-        self, message: List[DiscordMessage], channel_id: int
+        self,
+        message: List[DiscordMessage],
+        channel_id: int,
+        origin: MentionOrigin = MentionOrigin.HUMAN,
     ):
         pass
 
@@ -37,3 +52,39 @@ class AnthropicMessageHandler(ABC):
     @abstractmethod
     async def handle_anthropic_message(self, message: AnthropicMessage):
         pass
+
+
+class AnthropicGroupMessageHandler(ABC):
+    @abstractmethod
+    async def handle_anthropic_messages(self, messages: List[AnthropicMessage]):
+        """
+        Answer as every personality of the messages, which share a channel.
+        """
+        pass
+
+
+class AnthropicBatchMessageHandler(ABC):
+    @abstractmethod
+    async def prepare_batch_message(self, message: AnthropicMessage):
+        """
+        Build the context of a message which will be answered through a batch.
+        """
+        pass
+
+    @abstractmethod
+    async def deliver_batch_message(
+        self, message: AnthropicMessage, context, response: str
+    ):
+        """
+        Send the response to a message once its batch has ended.
+        """
+        pass
+
+
+class AnthropicPrefetchHandler(ABC):
+    @abstractmethod
+    def prefetch_anthropic_message(self, message: AnthropicMessage):
+        """
+        Start preparing a message which is likely to be handled soon.
+        """
+        pass
@@ -0,0 +1,181 @@
+from contextlib import contextmanager
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+from src.log import get_logger
+import asyncio
+import bisect
+import os
+import time
+
+logger = get_logger(__name__)
+
+# Seconds, chosen to cover everything from a cache hit to a slow completion
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class _Histogram:
+    def __init__(self):
+        self.bucket_counts: List[int] = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        index = bisect.bisect_left(LATENCY_BUCKETS, value)
+        if index < len(self.bucket_counts):
+            self.bucket_counts[index] += 1
+
+
+class Metrics:
+    def __init__(self):
+        """
+        Registry of stage latencies, counters and gauges of the mention to reply pipeline.
+        """
+        self._histograms: Dict[str, Dict[Labels, _Histogram]] = defaultdict(dict)
+        self._counters: Dict[str, Dict[Labels, float]] = defaultdict(
+            lambda: defaultdict(float)
+        )
+        self._gauges: Dict[str, Dict[Labels, float]] = defaultdict(dict)
+
+    def observe(self, stage: str, seconds: float, **labels):
+        """
+        Record how long a stage of the pipeline took.
+        """
+        key = _labels(labels)
+        histograms = self._histograms[stage]
+        if key not in histograms:
+            histograms[key] = _Histogram()
+        histograms[key].observe(seconds)
+
+    @contextmanager
+    def span(self, stage: str, **labels):
+        """
+        Time the body of the with statement as a stage.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.monotonic() - start, **labels)
+
+    def increment(self, counter: str, value: float = 1, **labels):
+        self._counters[counter][_labels(labels)] += value
+
+    def set_gauge(self, gauge: str, value: float, **labels):
+        self._gauges[gauge][_labels(labels)] = value
+
+    def render(self) -> str:
+        """
+        Render every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for stage, histograms in sorted(self._histograms.items()):
+            name = f"claudebot_{stage}_seconds"
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in sorted(histograms.items()):
+                cumulative = 0
+                for bucket, count in zip(LATENCY_BUCKETS, histogram.bucket_counts):
+                    cumulative += count
+                    lines.append(
+                        f"{name}_bucket{_format_labels(labels, ('le', str(bucket)))} {cumulative}"
+                    )
+                lines.append(
+                    f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {histogram.count}"
+                )
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+        for counter, values in sorted(self._counters.items()):
+            name = f"claudebot_{counter}_total"
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in sorted(values.items()):
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for gauge, values in sorted(self._gauges.items()):
+            name = f"claudebot_{gauge}"
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in sorted(values.items()):
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+# Process wide registry, like the default registry of prometheus_client
+metrics = Metrics()
+
+
+class MetricsExporter:
+    def __init__(
+        self,
+        registry: Metrics,
+        port: Optional[int] = None,
+        snapshot_path: Optional[str] = None,
+        snapshot_interval: float = 15,
+    ):
+        """
+        Expose the metrics on a local HTTP endpoint and/or a periodically written file.
+
+        Args:
+            port: Serve the metrics on 127.0.0.1 at this port
+            snapshot_path: Write the metrics to this file every snapshot_interval seconds
+        """
+        self.registry = registry
+        self.port = port
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+
+    async def _handle_request(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            # Every path serves the metrics, the request itself doesn't matter
+            await reader.readline()
+            body = self.registry.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\n".encode()
+                + b"Connection: close\r\n\r\n"
+                + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def _write_snapshot(self):
+        temporary_path = f"{self.snapshot_path}.tmp"
+        with open(temporary_path, "w") as f:
+            f.write(self.registry.render())
+        os.replace(temporary_path, self.snapshot_path)
+
+    async def _snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            self._write_snapshot()
+
+    async def run(self):
+        tasks = []
+        if self.snapshot_path is not None:
+            tasks.append(self._snapshot_loop())
+        if self.port is not None:
+            server = await asyncio.start_server(
+                self._handle_request, "127.0.0.1", self.port
+            )
+            logger.info("Serving metrics on http://127.0.0.1:%s/metrics", self.port)
+            tasks.append(server.serve_forever())
+        if tasks:
+            await asyncio.gather(*tasks)
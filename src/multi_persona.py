@@ -0,0 +1,124 @@
+from src.bot_service import BotService
+from src.chat import AnthropicChat
+from src.context import AnthropicContext, SystemBlock, PING_RULES
+from src.messenger import AnthropicGroupMessageHandler, AnthropicMessage
+from src.metrics import metrics
+from src.log import get_logger
+from dataclasses import replace
+from typing import Dict, List
+import asyncio
+import re
+
+logger = get_logger(__name__)
+
+REPLY_PATTERN = re.compile(
+    r'<reply name="([^"]+)">(.*?)(?:</reply>|$)', re.DOTALL | re.IGNORECASE
+)
+
+REPLY_FORMAT = (
+    "\nYou write the next message of each of the participants above, in their own "
+    "voice and without knowing what the others are about to say. "
+    "Answer with one block per participant and nothing outside of the blocks, e.g.\n"
+    '<reply name="Name">message</reply>\n'
+    "Leave a participant out if they have nothing to say."
+)
+
+
+def parse_replies(response: str) -> Dict[str, str]:
+    """
+    Get the message of every participant from a multi persona completion.
+
+    A block cut off by the token limit keeps the text it has.
+    """
+    replies = {}
+    for name, text in REPLY_PATTERN.findall(response):
+        text = text.strip()
+        if text:
+            replies[name.strip()] = text
+    return replies
+
+
+class MultiPersonaResponder(AnthropicGroupMessageHandler):
+    def __init__(self, anthropic_chat: AnthropicChat):
+        """
+        Answer as several personalities of a channel with a single completion.
+
+        The channel history and member list are built once and sent once, the
+        replies are parsed out of the completion and sent by each personality's bot.
+        """
+        self.anthropic_chat = anthropic_chat
+        # Personality name to its bot
+        self._bots: Dict[str, BotService] = {}
+
+    def add_bot(self, bot: BotService):
+        self._bots[bot.context_builder.personality.name] = bot
+
+    async def _build_context(
+        self, channel_id: int, bots: List[BotService]
+    ) -> AnthropicContext:
+        """
+        Build the context of the first bot, speaking for all of them.
+        """
+        context = await bots[0].context_builder.build_context(channel_id)
+        personalities = "\n".join(
+            f"{bot.context_builder.personality.name}: "
+            f"{bot.context_builder.personality.build_context()}"
+            for bot in bots
+        )
+        system_blocks = [
+            SystemBlock(
+                f"The participants you write for:\n{personalities}\n"
+                f"{PING_RULES}",
+                cache_breakpoint=True,
+            ),
+            # The member list and summary don't depend on the personality
+            *context.system_blocks[1:],
+            SystemBlock(REPLY_FORMAT),
+        ]
+        return AnthropicContext(
+            # None of the history is this completion's own
+            [{"role": "user", "content": x["content"]} for x in context.messages],
+            "".join(block.text for block in system_blocks),
+            # Larping is removed per reply
+            larping_allowed=True,
+            name=", ".join(bot.context_builder.personality.name for bot in bots),
+            system_blocks=system_blocks,
+            channel_id=channel_id,
+        )
+
+    async def handle_anthropic_messages(self, messages: List[AnthropicMessage]):
+        channel_id = messages[0].channel_id
+        bots = [self._bots[message.personality.name] for message in messages]
+        context = await self._build_context(channel_id, bots)
+        response = await self.anthropic_chat.send_message(context)
+        replies = parse_replies(response)
+        metrics.increment("multi_persona_replies", len(replies), channel=channel_id)
+
+        if not replies:
+            logger.warning(
+                "Unparseable multi persona response, answering one by one: %s",
+                response,
+            )
+            await asyncio.gather(
+                *(
+                    bot.handle_anthropic_message(message)
+                    for bot, message in zip(bots, messages)
+                )
+            )
+            return
+
+        for bot in bots:
+            personality = bot.context_builder.personality
+            reply = replies.get(personality.name)
+            if reply is None:
+                logger.debug("No multi persona reply for: %s", personality.name)
+                continue
+            reply = self.anthropic_chat.post_process(
+                reply,
+                replace(
+                    context,
+                    name=personality.name,
+                    larping_allowed=personality.larping_allowed,
+                ),
+            )
+            await bot.discord_service.send_message(reply, channel_id)
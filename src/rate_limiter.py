@@ -0,0 +1,113 @@
+from typing import Mapping, Optional
+from src.log import get_logger
+import asyncio
+import datetime
+import time
+
+logger = get_logger(__name__)
+
+
+class AdaptiveTokenBucket:
+    def __init__(
+        self,
+        rate_per_second: float,
+        capacity: int,
+        min_rate_per_second: Optional[float] = None,
+    ):
+        """
+        Token bucket rate limiter which slows down when the API pushes back.
+
+        Args:
+            rate_per_second: Steady state rate tokens are refilled at
+            capacity: Maximum number of tokens, i.e. the allowed burst
+            min_rate_per_second: Floor for the rate after repeated rate limits
+        """
+        self.base_rate_per_second = rate_per_second
+        self.rate_per_second = rate_per_second
+        self.min_rate_per_second = (
+            min_rate_per_second
+            if min_rate_per_second is not None
+            else rate_per_second / 8
+        )
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity,
+            self._tokens + (now - self._last_refill) * self.rate_per_second,
+        )
+        self._last_refill = now
+
+    def time_until_available(self) -> float:
+        """
+        Seconds until a token can be taken.
+        """
+        self._refill()
+        pause = max(0.0, self._paused_until - time.monotonic())
+        missing = max(0.0, 1 - self._tokens)
+        return max(pause, missing / self.rate_per_second)
+
+    async def acquire(self):
+        """
+        Wait for a token and take it.
+        """
+        while True:
+            wait = self.time_until_available()
+            if wait <= 0:
+                self._tokens -= 1
+                return
+            await asyncio.sleep(wait)
+
+    def refund(self):
+        """
+        Give back a token which ended up unused.
+        """
+        self._refill()
+        self._tokens = min(self.capacity, self._tokens + 1)
+
+    def on_success(self):
+        """
+        Recover towards the base rate after a successful call.
+        """
+        self.rate_per_second = min(
+            self.base_rate_per_second,
+            self.rate_per_second + self.base_rate_per_second / 10,
+        )
+
+    def on_rate_limited(self, retry_after: Optional[float] = None):
+        """
+        Halve the rate and drain the bucket, pausing for retry_after if given.
+        """
+        self.rate_per_second = max(self.min_rate_per_second, self.rate_per_second / 2)
+        self._refill()
+        self._tokens = min(self._tokens, 0.0)
+        if retry_after:
+            self._pause(retry_after)
+        logger.warning(
+            "Rate limited, slowing down to %.2f calls/min", self.rate_per_second * 60
+        )
+
+    def _pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def observe_headers(self, headers: Mapping[str, str]):
+        """
+        Pause until the limit resets when the rate limit headers say we are out of requests.
+        """
+        remaining = headers.get("anthropic-ratelimit-requests-remaining")
+        reset = headers.get("anthropic-ratelimit-requests-reset")
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining = int(remaining)
+            reset_at = datetime.datetime.fromisoformat(reset.replace("Z", "+00:00"))
+        except ValueError:
+            return
+
+        if remaining <= 0:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            self._pause((reset_at - now).total_seconds())
@@ -0,0 +1,247 @@
+from collections import deque
+from src.errors import ServiceUnavailableError
+from src.metrics import metrics
+from src.log import get_logger
+from typing import Awaitable, Callable, List, Optional, TypeVar
+import asyncio
+import random
+import time
+
+logger = get_logger(__name__)
+
+T = TypeVar("T")
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30):
+        """
+        Stop calling an API which keeps failing, then let one probe call through.
+
+        Args:
+            failure_threshold: Consecutive failures which open the circuit
+            reset_seconds: Time the circuit stays open before a probe call is allowed
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        # A probe call is in flight while half open
+        self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def time_until_probe(self) -> float:
+        """
+        Seconds until a probe call is allowed, 0 when closed.
+        """
+        if self._opened_at is None:
+            return 0.0
+        return max(0.0, self._opened_at + self.reset_seconds - time.monotonic())
+
+    def allow_request(self) -> bool:
+        """
+        Whether a call may be made now, the first call after the reset time probes.
+        """
+        if self._opened_at is None:
+            return True
+        if self.time_until_probe() > 0 or self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def release_probe(self):
+        """
+        Let another call probe when the probe call ended without an outcome, e.g. it
+        was cancelled.
+        """
+        self._probing = False
+
+    def record_success(self):
+        if self._opened_at is not None:
+            logger.info("API recovered, closing circuit")
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        metrics.set_gauge("circuit_open", 0)
+
+    def record_failure(self):
+        self._failures += 1
+        if self._probing or (
+            self._opened_at is None and self._failures >= self.failure_threshold
+        ):
+            logger.warning(
+                "API failed %s times in a row, opening circuit for %.0fs",
+                self._failures,
+                self.reset_seconds,
+            )
+            self._opened_at = time.monotonic()
+            self._probing = False
+            metrics.set_gauge("circuit_open", 1)
+            metrics.increment("circuit_opened")
+
+    async def wait_until_allowed(self):
+        """
+        Wait while the circuit is open or its probe call is in flight.
+        """
+        while self._opened_at is not None:
+            delay = self.time_until_probe()
+            if delay <= 0 and not self._probing:
+                return
+            await asyncio.sleep(delay or 1)
+
+
+class LatencyTracker:
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        """
+        Latencies of the most recent successful calls.
+
+        Args:
+            min_samples: Percentiles are unknown until this many calls were observed
+        """
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        self._latencies.append(seconds)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        if len(self._latencies) < self.min_samples:
+            return None
+        latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        return latencies[index]
+
+
+class ResilientCaller:
+    def __init__(
+        self,
+        is_retryable: Callable[[BaseException], bool],
+        attempt_timeout_seconds: float = 30,
+        deadline_seconds: float = 60,
+        max_attempts: int = 3,
+        base_delay_seconds: float = 0.5,
+        max_delay_seconds: float = 8,
+        hedge_percentile: Optional[float] = None,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+    ):
+        """
+        Make calls with a deadline, retrying transient failures with jittered backoff.
+
+        Args:
+            is_retryable: Whether a failure is transient, e.g. overloaded or 5xx.
+                Other failures are raised right away
+            attempt_timeout_seconds: Give up on a single attempt after this long
+            deadline_seconds: Give up on the call, retries included, after this long
+            hedge_percentile: Send a second request when the first takes longer than
+                this percentile of recent latencies, the first response wins
+            circuit_breaker: Told of every outcome, calls fail fast while it is open
+        """
+        self.is_retryable = is_retryable
+        self.attempt_timeout_seconds = attempt_timeout_seconds
+        self.deadline_seconds = deadline_seconds
+        self.max_attempts = max_attempts
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.hedge_percentile = hedge_percentile
+        self.circuit_breaker = circuit_breaker
+        self.latencies = LatencyTracker()
+
+    def _backoff_delay(self, attempt: int) -> float:
+        """
+        Full jitter, so retries of concurrent calls don't arrive together.
+        """
+        return random.uniform(
+            0,
+            min(self.max_delay_seconds, self.base_delay_seconds * 2 ** (attempt - 1)),
+        )
+
+    async def call(self, attempt_func: Callable[[], Awaitable[T]]) -> T:
+        """
+        Call attempt_func until it succeeds, fails permanently or runs out of time.
+
+        Raises ServiceUnavailableError while the circuit breaker is open, otherwise the
+        last failure.
+        """
+        breaker = self.circuit_breaker
+        is_probe = breaker is not None and breaker.is_open
+        if breaker is not None and not breaker.allow_request():
+            raise ServiceUnavailableError(breaker.time_until_probe())
+
+        try:
+            return await self._call(attempt_func)
+        except BaseException:
+            if is_probe and breaker.is_open:
+                breaker.release_probe()
+            raise
+
+    async def _call(self, attempt_func: Callable[[], Awaitable[T]]) -> T:
+        breaker = self.circuit_breaker
+        deadline = time.monotonic() + self.deadline_seconds
+        attempt = 1
+        while True:
+            start = time.monotonic()
+            try:
+                result = await asyncio.wait_for(
+                    self._hedged(attempt_func),
+                    min(self.attempt_timeout_seconds, deadline - start),
+                )
+            except Exception as e:
+                if not self.is_retryable(e):
+                    # The API answered, it just didn't like the request
+                    if breaker is not None:
+                        breaker.record_success()
+                    raise
+                if breaker is not None:
+                    breaker.record_failure()
+                delay = self._backoff_delay(attempt)
+                if (
+                    attempt >= self.max_attempts
+                    or (breaker is not None and breaker.is_open)
+                    or time.monotonic() + delay >= deadline
+                ):
+                    raise
+                logger.info("Retrying failed call in %.1fs: %r", delay, e)
+                metrics.increment("llm_retries")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+
+            if breaker is not None:
+                breaker.record_success()
+            self.latencies.observe(time.monotonic() - start)
+            return result
+
+    async def _hedged(self, attempt_func: Callable[[], Awaitable[T]]) -> T:
+        """
+        Make the attempt, racing a second request against it when it is slow.
+        """
+        hedge_after = None
+        if self.hedge_percentile is not None:
+            hedge_after = self.latencies.percentile(self.hedge_percentile)
+        if hedge_after is None:
+            return await attempt_func()
+
+        tasks: List[asyncio.Task] = [asyncio.ensure_future(attempt_func())]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if done:
+                return tasks[0].result()
+
+            metrics.increment("llm_hedged")
+            tasks.append(asyncio.ensure_future(attempt_func()))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+from src.metrics import metrics
+from typing import Awaitable, Callable, Dict, Tuple
+import asyncio
+import time
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = 256, ttl_seconds: float = 300):
+        """
+        LRU cache of completions with a time to live, coalescing concurrent requests.
+
+        Args:
+            max_entries: Least recently used responses are evicted past this many
+            ttl_seconds: Responses older than this are not reused
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # Fingerprint to (time cached, response), least recently used first
+        self._entries: OrderedDict[str, Tuple[float, str]] = OrderedDict()
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    def _get(self, fingerprint: str):
+        entry = self._entries.get(fingerprint)
+        if entry is None:
+            return None
+        cached_at, response = entry
+        if time.monotonic() - cached_at > self.ttl_seconds:
+            del self._entries[fingerprint]
+            return None
+        self._entries.move_to_end(fingerprint)
+        return response
+
+    def _put(self, fingerprint: str, response: str):
+        self._entries[fingerprint] = (time.monotonic(), response)
+        self._entries.move_to_end(fingerprint)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_create(
+        self, fingerprint: str, create: Callable[[], Awaitable[str]]
+    ) -> str:
+        """
+        Get the cached response for a fingerprint, or create it once no matter how many
+        callers ask for it at the same time. Failures are not cached.
+        """
+        response = self._get(fingerprint)
+        if response is not None:
+            metrics.increment("response_cache", result="hit")
+            return response
+
+        in_flight = self._in_flight.get(fingerprint)
+        if in_flight is not None:
+            metrics.increment("response_cache", result="coalesced")
+            return await asyncio.shield(in_flight)
+
+        metrics.increment("response_cache", result="miss")
+        future = asyncio.ensure_future(create())
+        self._in_flight[fingerprint] = future
+        future.add_done_callback(lambda x: self._on_done(fingerprint, x))
+        # Shielded so a cancelled caller doesn't cancel the request for the others
+        return await asyncio.shield(future)
+
+    def _on_done(self, fingerprint: str, future: asyncio.Future):
+        self._in_flight.pop(fingerprint, None)
+        if not future.cancelled() and future.exception() is None:
+            self._put(fingerprint, future.result())
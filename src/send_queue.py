@@ -0,0 +1,175 @@
+from collections import deque
+from dataclasses import dataclass, field
+from src.rate_limiter import AdaptiveTokenBucket
+from src.metrics import metrics
+from src.log import get_logger
+from typing import Awaitable, Callable, Deque, Dict, Hashable, List
+import asyncio
+import discord
+
+logger = get_logger(__name__)
+
+# Discord rejects messages longer than this
+DISCORD_MESSAGE_LIMIT = 2000
+
+
+def _is_sentence_end(text: str, i: int) -> bool:
+    if text[i] == "\n":
+        return True
+    return text[i] in ".!?" and i + 1 < len(text) and text[i + 1].isspace()
+
+
+def split_message(text: str, max_length: int = DISCORD_MESSAGE_LIMIT) -> List[str]:
+    """
+    Split text into parts of at most max_length characters, preferring sentence
+    boundaries, then whitespace.
+    """
+    parts = []
+    text = text.strip()
+    while len(text) > max_length:
+        split_position = next(
+            (i + 1 for i in range(max_length - 1, 0, -1) if _is_sentence_end(text, i)),
+            None,
+        )
+        if split_position is None:
+            split_position = text.rfind(" ", 0, max_length) + 1 or max_length
+        parts.append(text[:split_position].strip())
+        text = text[split_position:].strip()
+    if text:
+        parts.append(text)
+    return parts
+
+
+@dataclass
+class _OutboundMessage:
+    content: str
+    sender: Hashable
+    send: Callable[[str], Awaitable[object]]
+    futures: List[asyncio.Future] = field(default_factory=list)
+
+
+class ChannelSendQueue:
+    def __init__(
+        self,
+        messages_per_second: float = 1,
+        burst: int = 5,
+        max_message_length: int = DISCORD_MESSAGE_LIMIT,
+        max_attempts: int = 3,
+    ):
+        """
+        Outbound message queue per channel, shared by every bot.
+
+        Each channel is drained in order by its own task within a send budget, so a
+        burst of replies neither stalls the scheduler workers nor trips Discord's
+        per channel rate limit. Consecutive queued messages from the same bot are
+        merged when they fit in one message.
+
+        Args:
+            messages_per_second: Sustained sends per channel
+            burst: Sends allowed at once before pacing kicks in
+            max_attempts: Sends of a message before its future fails
+        """
+        self.messages_per_second = messages_per_second
+        self.burst = burst
+        self.max_message_length = max_message_length
+        self.max_attempts = max_attempts
+        self._queues: Dict[int, Deque[_OutboundMessage]] = {}
+        self._budgets: Dict[int, AdaptiveTokenBucket] = {}
+        self._drain_tasks: Dict[int, asyncio.Task] = {}
+
+    def enqueue(
+        self,
+        channel_id: int,
+        sender: Hashable,
+        content: str,
+        send: Callable[[str], Awaitable[object]],
+    ) -> asyncio.Future:
+        """
+        Queue a message, split on sentence boundaries if it is too long.
+
+        Returns a future resolved once every part has been sent.
+        """
+        loop = asyncio.get_running_loop()
+        parts = split_message(content, self.max_message_length)
+        if not parts:
+            sent = loop.create_future()
+            sent.set_result(None)
+            return sent
+
+        queue = self._queues.setdefault(channel_id, deque())
+        futures = []
+        for part in parts:
+            future = loop.create_future()
+            queue.append(_OutboundMessage(part, sender, send, [future]))
+            futures.append(future)
+        metrics.set_gauge("send_queue_depth", len(queue), channel=channel_id)
+
+        task = self._drain_tasks.get(channel_id)
+        if task is None or task.done():
+            self._drain_tasks[channel_id] = asyncio.create_task(self._drain(channel_id))
+
+        sent = asyncio.gather(*futures)
+        # Failures are already logged, don't warn when nobody awaits the result
+        sent.add_done_callback(lambda x: x.cancelled() or x.exception())
+        return sent
+
+    def _budget(self, channel_id: int) -> AdaptiveTokenBucket:
+        if channel_id not in self._budgets:
+            self._budgets[channel_id] = AdaptiveTokenBucket(
+                rate_per_second=self.messages_per_second, capacity=self.burst
+            )
+        return self._budgets[channel_id]
+
+    def _next_message(self, queue: Deque[_OutboundMessage]) -> _OutboundMessage:
+        """
+        Pop the next message, merged with the following ones of the same bot that fit.
+        """
+        message = queue.popleft()
+        while (
+            queue
+            and queue[0].sender == message.sender
+            and len(message.content) + 1 + len(queue[0].content)
+            <= self.max_message_length
+        ):
+            following = queue.popleft()
+            message.content += "\n" + following.content
+            message.futures.extend(following.futures)
+            metrics.increment("send_queue_coalesced")
+        return message
+
+    async def _send(self, channel_id: int, message: _OutboundMessage):
+        budget = self._budget(channel_id)
+        for attempt in range(1, self.max_attempts + 1):
+            await budget.acquire()
+            try:
+                with metrics.span("discord_send", channel=channel_id):
+                    await message.send(message.content)
+                budget.on_success()
+                return
+            except discord.RateLimited as e:
+                logger.warning(
+                    "Rate limited in channel: %s for %.1fs", channel_id, e.retry_after
+                )
+                budget.on_rate_limited(e.retry_after)
+            except discord.HTTPException as e:
+                if e.status != 429 or attempt == self.max_attempts:
+                    raise
+                budget.on_rate_limited()
+        raise discord.RateLimited(0)
+
+    async def _drain(self, channel_id: int):
+        queue = self._queues[channel_id]
+        while queue:
+            message = self._next_message(queue)
+            metrics.set_gauge("send_queue_depth", len(queue), channel=channel_id)
+            try:
+                await self._send(channel_id, message)
+            except Exception as e:
+                logger.exception("Failed to send message to channel: %s", channel_id)
+                for future in message.futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for future in message.futures:
+                if not future.done():
+                    future.set_result(None)
@@ -0,0 +1,557 @@
+from src.personality import Personality
+from src.chat_scheduler import AnthropicScheduler
+from src.messenger import AnthropicMessage, AnthropicMessageHandler, MentionOrigin
+from src.errors import BackoffError, RateLimitedError, ServiceUnavailableError
+from src.metrics import metrics, MetricsExporter
+from src.resilience import CircuitBreaker
+from src.log import configure_logging, get_logger, stop_logging
+from src.state_store import PendingCall, StateStore
+from typing import Dict, List, Mapping, Optional, Set, Tuple
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import tempfile
+
+logger = get_logger(__name__)
+
+# Scheduler methods a shard may run on the coordinator for admin commands
+REMOTE_SCHEDULER_METHODS = (
+    "silence_bots",
+    "silence_bot",
+    "mute_channel",
+    "unmute_channel",
+    "pending_calls",
+    "acquire_call_budget",
+)
+
+
+async def _send(writer: asyncio.StreamWriter, **payload):
+    writer.write(json.dumps(payload).encode() + b"\n")
+    await writer.drain()
+
+
+class _ShardConnection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Coordinator side of the connection to one shard process.
+        """
+        self.reader = reader
+        self.writer = writer
+        self._call_ids = itertools.count()
+        self._pending: Dict[int, asyncio.Future] = {}
+
+    async def call(self, personality_name: str, channel_id: int):
+        """
+        Ask the shard to handle a call and wait for the outcome.
+        """
+        call_id = next(self._call_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[call_id] = future
+        try:
+            await _send(
+                self.writer,
+                type="call",
+                id=call_id,
+                personality=personality_name,
+                channel_id=channel_id,
+            )
+            await future
+        except ConnectionError:
+            raise BackoffError()
+        finally:
+            self._pending.pop(call_id, None)
+
+    def resolve(self, call_id: int, error: Optional[str], retry_after, detail: str):
+        future = self._pending.get(call_id)
+        if future is None or future.done():
+            return
+        if error is None:
+            future.set_result(None)
+        elif error == "timeout":
+            future.set_exception(TimeoutError())
+        elif error == "rate_limited":
+            future.set_exception(RateLimitedError(retry_after))
+        elif error == "unavailable":
+            future.set_exception(ServiceUnavailableError(retry_after))
+        elif error == "backoff":
+            future.set_exception(BackoffError(retry_after))
+        else:
+            future.set_exception(RuntimeError(detail))
+
+    def fail_pending(self, retry_after: float):
+        """
+        The shard died, calls in flight are retried once it is back.
+        """
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(BackoffError(retry_after))
+
+
+class _RemoteMessageHandler(AnthropicMessageHandler):
+    def __init__(self, coordinator: "ShardCoordinator", shard_index: int):
+        self.coordinator = coordinator
+        self.shard_index = shard_index
+
+    async def handle_anthropic_message(self, message: AnthropicMessage):
+        connection = self.coordinator.connections.get(self.shard_index)
+        if connection is None:
+            # Back off until the shard has been restarted
+            raise BackoffError(self.coordinator.restart_delay)
+
+        breaker = self.coordinator.circuit_breaker
+        if breaker is None:
+            await connection.call(message.personality.name, message.channel_id)
+            return
+        is_probe = breaker.is_open
+        if not breaker.allow_request():
+            raise ServiceUnavailableError(breaker.time_until_probe())
+        try:
+            await connection.call(message.personality.name, message.channel_id)
+        except (ServiceUnavailableError, TimeoutError):
+            breaker.record_failure()
+            raise
+        except BaseException:
+            # Rate limited, the shard went away or the call was cancelled
+            if is_probe and breaker.is_open:
+                breaker.release_probe()
+            raise
+        breaker.record_success()
+
+
+class ShardCoordinator:
+    def __init__(
+        self,
+        personalities: List[Personality],
+        num_shards: int,
+        restart_delay: float = 5,
+        log_level="INFO",
+        **factory_arguments,
+    ):
+        """
+        Spread the bots over worker processes sharing one scheduler.
+
+        The coordinator owns the AnthropicScheduler, so the rate limit and weighted
+        sampling stay global. Each shard runs a BotFactory with its share of the
+        personalities and talks to the coordinator over a unix socket. A shard which
+        dies is restarted without affecting the others.
+
+        Args:
+            num_shards: Number of worker processes
+            restart_delay: Seconds to wait before restarting a dead shard
+            factory_arguments: Passed to the BotFactory of every shard
+        """
+        self.personalities = {x.name: x for x in personalities}
+        self.num_shards = min(num_shards, len(personalities))
+        self.restart_delay = restart_delay
+        self.log_level = log_level
+        self.factory_arguments = factory_arguments
+        # Opened by completions failing in any shard
+        self.circuit_breaker = None
+        if factory_arguments.get("circuit_breaker_failures", 5) is not None:
+            self.circuit_breaker = CircuitBreaker(
+                factory_arguments.get("circuit_breaker_failures", 5)
+            )
+        self.anthropic_scheduler = AnthropicScheduler(
+            calls_per_second=factory_arguments["calls_per_minute"] / 60,
+            decay_chance_per_minute=factory_arguments["decay_chance_per_minute"],
+            num_workers=factory_arguments.get("num_scheduler_workers", 4),
+            burst_capacity=factory_arguments.get("burst_capacity"),
+            deadline_seconds=factory_arguments.get("call_deadline_seconds"),
+            recency_half_life_seconds=factory_arguments.get(
+                "recency_half_life_seconds"
+            ),
+            lane_shares=factory_arguments.get("lane_shares"),
+            max_bot_turns_per_channel=factory_arguments.get(
+                "max_bot_turns_per_channel"
+            ),
+            bot_turn_window_seconds=factory_arguments.get(
+                "bot_turn_window_seconds", 600
+            ),
+            circuit_breaker=self.circuit_breaker,
+        )
+        self.metrics_exporter = MetricsExporter(
+            metrics,
+            port=factory_arguments.get("metrics_port"),
+            snapshot_path=factory_arguments.get("metrics_snapshot_path"),
+        )
+        # Shards keep their message caches in the same file
+        self.state_store = None
+        if factory_arguments.get("state_path") is not None:
+            self.state_store = StateStore(factory_arguments["state_path"])
+        self.connections: Dict[int, _ShardConnection] = {}
+        # Shards whose bots have their channels cached
+        self._ready_shards: Set[int] = set()
+        self._shards_ready = asyncio.Event()
+        self._pending_calls_restored = False
+        self._connection_tasks: Set[asyncio.Task] = set()
+        self._query_tasks: Set[asyncio.Task] = set()
+        self.shard_personalities: List[List[Personality]] = [
+            personalities[i :: self.num_shards] for i in range(self.num_shards)
+        ]
+        for shard_index, shard in enumerate(self.shard_personalities):
+            for personality in shard:
+                self.anthropic_scheduler.register_anthropic_message_handler(
+                    personality, _RemoteMessageHandler(self, shard_index)
+                )
+        self.socket_path = os.path.join(tempfile.mkdtemp(), "shards.sock")
+
+    def _shard_factory_arguments(self, shard_index: int) -> dict:
+        arguments = dict(self.factory_arguments)
+        # One shard answers admin commands so each command gets one reply
+        arguments["admin_commands"] = shard_index == 0
+        # Only the coordinator serves metrics
+        arguments["metrics_port"] = None
+        arguments["metrics_snapshot_path"] = None
+        return arguments
+
+    def _observe_limiter(self, method: str, arguments: list):
+        rate_limiter = self.anthropic_scheduler.rate_limiter
+        if rate_limiter is None:
+            return
+        if method == "on_success":
+            rate_limiter.on_success()
+        elif method == "on_rate_limited":
+            rate_limiter.on_rate_limited(*arguments)
+        elif method == "observe_headers":
+            rate_limiter.observe_headers(*arguments)
+
+    async def _handle_shard(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        connection = _ShardConnection(reader, writer)
+        shard_index = None
+        task = asyncio.current_task()
+        self._connection_tasks.add(task)
+        try:
+            async for line in reader:
+                payload = json.loads(line)
+                if payload["type"] == "hello":
+                    shard_index = payload["shard"]
+                    self.connections[shard_index] = connection
+                    logger.info("Shard %s connected", shard_index)
+                elif payload["type"] == "ready":
+                    self._ready_shards.add(shard_index)
+                    if len(self._ready_shards) == self.num_shards:
+                        self._shards_ready.set()
+                elif payload["type"] == "request":
+                    await self.anthropic_scheduler.request_anthropic_call(
+                        self.personalities[payload["personality"]],
+                        payload["channel_id"],
+                        MentionOrigin(payload["origin"]),
+                    )
+                elif payload["type"] == "result":
+                    connection.resolve(
+                        payload["id"],
+                        payload["error"],
+                        payload.get("retry_after"),
+                        payload.get("detail", ""),
+                    )
+                elif payload["type"] == "limiter":
+                    self._observe_limiter(payload["method"], payload["arguments"])
+                elif payload["type"] == "query":
+                    query_task = asyncio.create_task(
+                        self._answer_query(writer, payload)
+                    )
+                    self._query_tasks.add(query_task)
+                    query_task.add_done_callback(self._query_tasks.discard)
+        finally:
+            if self.connections.get(shard_index) is connection:
+                del self.connections[shard_index]
+            connection.fail_pending(self.restart_delay)
+            writer.close()
+            self._connection_tasks.discard(task)
+            logger.warning("Shard %s disconnected", shard_index)
+
+    async def _restore_pending_calls(self):
+        # A restored call needs the channel of its bot to build the context
+        await self._shards_ready.wait()
+        await self.anthropic_scheduler.restore_pending_calls(
+            self.state_store.load_pending_calls()
+        )
+        self._pending_calls_restored = True
+
+    def _export_pending_calls(self) -> Optional[List[PendingCall]]:
+        # Keep the stored calls until they have been restored
+        if not self._pending_calls_restored:
+            return None
+        return self.anthropic_scheduler.export_pending_calls()
+
+    async def _answer_query(self, writer: asyncio.StreamWriter, payload: dict):
+        if payload["method"] not in REMOTE_SCHEDULER_METHODS:
+            result = None
+        else:
+            method = getattr(self.anthropic_scheduler, payload["method"])
+            result = await method(*payload["arguments"])
+        await _send(writer, type="query_result", id=payload["id"], result=result)
+
+    async def _supervise_shard(self, shard_index: int):
+        """
+        Keep a shard process running, restarting it when it dies.
+        """
+        context = multiprocessing.get_context("spawn")
+        while True:
+            process = context.Process(
+                target=run_shard,
+                args=(
+                    self.socket_path,
+                    shard_index,
+                    self.shard_personalities[shard_index],
+                    self._shard_factory_arguments(shard_index),
+                    self.log_level,
+                ),
+                name=f"claudebot-shard-{shard_index}",
+                daemon=True,
+            )
+            process.start()
+            logger.info(
+                "Started shard %s with pid %s for %s",
+                shard_index,
+                process.pid,
+                [x.name for x in self.shard_personalities[shard_index]],
+            )
+            try:
+                while process.is_alive():
+                    await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                process.terminate()
+                raise
+
+            logger.error(
+                "Shard %s exited with code %s, restarting in %ss",
+                shard_index,
+                process.exitcode,
+                self.restart_delay,
+            )
+            metrics.increment("shard_restarts", shard=shard_index)
+            await asyncio.sleep(self.restart_delay)
+
+    async def run(self):
+        server = await asyncio.start_unix_server(self._handle_shard, self.socket_path)
+        tasks = [
+            asyncio.create_task(self._supervise_shard(i)) for i in range(self.num_shards)
+        ]
+        tasks.append(asyncio.create_task(self.metrics_exporter.run()))
+        if self.state_store is not None:
+            tasks.append(asyncio.create_task(self._restore_pending_calls()))
+            tasks.append(
+                asyncio.create_task(self.state_store.run(self._export_pending_calls))
+            )
+        try:
+            await self.anthropic_scheduler.run()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            server.close()
+            # Closing the connections lets their handlers finish on end of file
+            for connection in list(self.connections.values()):
+                connection.writer.close()
+            await asyncio.gather(*self._connection_tasks, return_exceptions=True)
+
+    async def stop(self):
+        await self.anthropic_scheduler.stop()
+
+
+class _RemoteRateLimiter:
+    def __init__(self, scheduler: "RemoteScheduler"):
+        """
+        Forwards what the chats learn about the rate limit to the coordinator.
+        """
+        self._scheduler = scheduler
+
+    def on_success(self):
+        self._scheduler.notify_limiter("on_success")
+
+    def on_rate_limited(self, retry_after: Optional[float] = None):
+        self._scheduler.notify_limiter("on_rate_limited", retry_after)
+
+    def observe_headers(self, headers: Mapping[str, str]):
+        headers = {
+            key: value
+            for key, value in headers.items()
+            if key.startswith("anthropic-ratelimit-")
+        }
+        if headers:
+            self._scheduler.notify_limiter("observe_headers", headers)
+
+
+class RemoteScheduler:
+    def __init__(self, socket_path: str, shard_index: int):
+        """
+        Stand-in for the AnthropicScheduler inside a shard, forwarding to the coordinator.
+        """
+        self.socket_path = socket_path
+        self.shard_index = shard_index
+        self.rate_limiter = _RemoteRateLimiter(self)
+        self.anthropic_message_handlers: Dict[str, AnthropicMessageHandler] = {}
+        self.personalities: Dict[str, Personality] = {}
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connected = asyncio.Event()
+        self._tasks = set()
+        self._query_ids = itertools.count()
+        self._queries: Dict[int, asyncio.Future] = {}
+
+    def register_anthropic_message_handler(
+        self,
+        personality: Personality,
+        anthropic_message_handler: AnthropicMessageHandler,
+    ):
+        self.personalities[personality.name] = personality
+        self.anthropic_message_handlers[personality.name] = anthropic_message_handler
+
+    async def request_anthropic_call(
+        self,
+        personality: Personality,
+        channel_id: int,
+        origin: MentionOrigin = MentionOrigin.HUMAN,
+    ):
+        await self._connected.wait()
+        await _send(
+            self._writer,
+            type="request",
+            personality=personality.name,
+            channel_id=channel_id,
+            origin=origin.value,
+        )
+
+    async def _query(self, method: str, *arguments):
+        """
+        Run a scheduler method on the coordinator and wait for its result.
+        """
+        await self._connected.wait()
+        query_id = next(self._query_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._queries[query_id] = future
+        try:
+            await _send(
+                self._writer,
+                type="query",
+                id=query_id,
+                method=method,
+                arguments=arguments,
+            )
+            return await future
+        finally:
+            self._queries.pop(query_id, None)
+
+    async def silence_bots(self):
+        await self._query("silence_bots")
+
+    async def silence_bot(self, personality_name: str):
+        await self._query("silence_bot", personality_name)
+
+    async def mute_channel(self, channel_id: int, seconds: Optional[float] = None):
+        await self._query("mute_channel", channel_id, seconds)
+
+    async def unmute_channel(self, channel_id: int):
+        await self._query("unmute_channel", channel_id)
+
+    async def pending_calls(self, channel_id: int) -> List[Tuple[str, int]]:
+        return [tuple(x) for x in await self._query("pending_calls", channel_id)]
+
+    async def acquire_call_budget(self):
+        await self._query("acquire_call_budget")
+
+    def notify_limiter(self, method: str, *arguments):
+        if self._writer is None:
+            return
+        task = asyncio.create_task(
+            _send(self._writer, type="limiter", method=method, arguments=arguments)
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _handle_call(self, payload: dict):
+        result = dict(type="result", id=payload["id"], error=None)
+        try:
+            handler = self.anthropic_message_handlers[payload["personality"]]
+            await handler.handle_anthropic_message(
+                AnthropicMessage(
+                    payload["channel_id"], self.personalities[payload["personality"]]
+                )
+            )
+        except TimeoutError:
+            result["error"] = "timeout"
+        except BackoffError as e:
+            if isinstance(e, RateLimitedError):
+                result["error"] = "rate_limited"
+            elif isinstance(e, ServiceUnavailableError):
+                result["error"] = "unavailable"
+            else:
+                result["error"] = "backoff"
+            result["retry_after"] = e.retry_after
+        except Exception as e:
+            logger.exception("Call for %s failed", payload["personality"])
+            result["error"] = "exception"
+            result["detail"] = repr(e)
+        await _send(self._writer, **result)
+
+    async def run(self):
+        reader, self._writer = await asyncio.open_unix_connection(self.socket_path)
+        await _send(self._writer, type="hello", shard=self.shard_index)
+        self._connected.set()
+        async for line in reader:
+            payload = json.loads(line)
+            if payload["type"] == "call":
+                task = asyncio.create_task(self._handle_call(payload))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            elif payload["type"] == "query_result":
+                future = self._queries.get(payload["id"])
+                if future is not None and not future.done():
+                    future.set_result(payload["result"])
+        raise ConnectionError("Lost connection to the shard coordinator")
+
+    async def report_ready(self):
+        """
+        Tell the coordinator the bots of this shard have their channels cached.
+        """
+        await self._connected.wait()
+        await _send(self._writer, type="ready")
+
+    async def stop(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+async def _run_shard(
+    socket_path: str,
+    shard_index: int,
+    personalities: List[Personality],
+    factory_arguments: dict,
+):
+    # Imported here so the coordinator doesn't load the discord client
+    from src.bot_factory import BotFactory
+
+    remote_scheduler = RemoteScheduler(socket_path, shard_index)
+    bot_factory = BotFactory(**factory_arguments, anthropic_scheduler=remote_scheduler)
+    bots = [bot_factory.create_bot(personality) for personality in personalities]
+
+    async def report_ready():
+        await bot_factory.wait_until_listening()
+        await remote_scheduler.report_ready()
+
+    await asyncio.gather(
+        bot_factory.run(), report_ready(), *(bot.run() for bot in bots)
+    )
+
+
+def run_shard(
+    socket_path: str,
+    shard_index: int,
+    personalities: List[Personality],
+    factory_arguments: dict,
+    log_level="INFO",
+):
+    """
+    Entry point of a shard process.
+    """
+    configure_logging(log_level)
+    try:
+        asyncio.run(
+            _run_shard(socket_path, shard_index, personalities, factory_arguments)
+        )
+    finally:
+        stop_logging()
@@ -0,0 +1,166 @@
+from src.messenger import DiscordMessage
+from src.log import get_logger
+from typing import Callable, Dict, List, Optional, Tuple
+import asyncio
+import datetime
+import sqlite3
+
+logger = get_logger(__name__)
+
+# (personality name, channel id, lane, weight, first requested, last requested)
+# with the request times as unix timestamps
+PendingCall = Tuple[str, int, Optional[str], float, float, float]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    channel_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    author TEXT NOT NULL,
+    author_id INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    PRIMARY KEY (channel_id, message_id)
+);
+CREATE TABLE IF NOT EXISTS pending_calls (
+    personality_name TEXT NOT NULL,
+    channel_id INTEGER NOT NULL,
+    lane TEXT,
+    weight REAL NOT NULL,
+    first_requested REAL NOT NULL,
+    last_requested REAL NOT NULL,
+    PRIMARY KEY (personality_name, channel_id)
+);
+"""
+
+
+class StateStore:
+    def __init__(
+        self,
+        path: str,
+        max_messages_per_channel: int = 50,
+        flush_interval: float = 5,
+    ):
+        """
+        SQLite file holding the message caches and pending calls across restarts.
+
+        Message changes are journaled in memory and written in one transaction every
+        flush_interval seconds, together with a snapshot of the pending calls.
+
+        Args:
+            max_messages_per_channel: Messages kept per channel when compacting
+        """
+        self.path = path
+        self.max_messages_per_channel = max_messages_per_channel
+        self.flush_interval = flush_interval
+        self._connection = sqlite3.connect(path, timeout=5)
+        # Without a sync per commit, a crash loses at most the last few writes
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+        # Operations waiting for the next flush, as (sql, parameters)
+        self._journal: List[Tuple[str, tuple]] = []
+
+    def message_added(self, channel_id: int, message: DiscordMessage):
+        self._journal.append(
+            (
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    channel_id,
+                    message.message_id,
+                    message.author,
+                    message.author_id,
+                    message.content,
+                    message.timestamp.isoformat(),
+                ),
+            )
+        )
+
+    def message_edited(self, channel_id: int, message_id: int, content: str):
+        self._journal.append(
+            (
+                "UPDATE messages SET content = ? WHERE channel_id = ? AND message_id = ?",
+                (content, channel_id, message_id),
+            )
+        )
+
+    def message_deleted(self, channel_id: int, message_id: int):
+        self._journal.append(
+            (
+                "DELETE FROM messages WHERE channel_id = ? AND message_id = ?",
+                (channel_id, message_id),
+            )
+        )
+
+    def load_messages(self) -> Dict[int, List[DiscordMessage]]:
+        """
+        Get the stored messages of every channel, oldest first.
+        """
+        messages: Dict[int, List[DiscordMessage]] = {}
+        rows = self._connection.execute(
+            "SELECT channel_id, message_id, author, author_id, content, timestamp "
+            "FROM messages ORDER BY timestamp"
+        )
+        for channel_id, message_id, author, author_id, content, timestamp in rows:
+            messages.setdefault(channel_id, []).append(
+                DiscordMessage(
+                    author=author,
+                    content=content,
+                    timestamp=datetime.datetime.fromisoformat(timestamp),
+                    sent_by_me=False,
+                    message_id=message_id,
+                    author_id=author_id,
+                )
+            )
+        return messages
+
+    def load_pending_calls(self) -> List[PendingCall]:
+        return list(self._connection.execute("SELECT * FROM pending_calls"))
+
+    def flush(self, pending_calls: Optional[List[PendingCall]] = None):
+        """
+        Write the journaled message changes and replace the pending calls snapshot.
+        """
+        journal, self._journal = self._journal, []
+        with self._connection:
+            for sql, parameters in journal:
+                self._connection.execute(sql, parameters)
+            if journal:
+                self._compact_messages()
+            if pending_calls is not None:
+                self._connection.execute("DELETE FROM pending_calls")
+                self._connection.executemany(
+                    "INSERT INTO pending_calls VALUES (?, ?, ?, ?, ?, ?)",
+                    pending_calls,
+                )
+
+    def _compact_messages(self):
+        """
+        Drop messages which scrolled out of the cache.
+        """
+        self._connection.execute(
+            """
+            DELETE FROM messages WHERE (channel_id, message_id) IN (
+                SELECT channel_id, message_id FROM (
+                    SELECT channel_id, message_id, ROW_NUMBER() OVER (
+                        PARTITION BY channel_id ORDER BY timestamp DESC
+                    ) AS position FROM messages
+                ) WHERE position > ?
+            )
+            """,
+            (self.max_messages_per_channel,),
+        )
+
+    async def run(self, pending_calls_func: Optional[Callable[[], List[PendingCall]]]):
+        """
+        Flush periodically until cancelled, then flush one last time.
+        """
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                self.flush(pending_calls_func() if pending_calls_func else None)
+        finally:
+            self.flush(pending_calls_func() if pending_calls_func else None)
+            logger.info("Saved state to %s", self.path)
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,123 @@
+from src.messenger import DiscordMessage
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from src.log import get_logger
+import asyncio
+import datetime
+
+logger = get_logger(__name__)
+
+# Key ordering messages like the channel history does
+MessageKey = Tuple[datetime.datetime, int]
+
+
+def _key(message: DiscordMessage) -> MessageKey:
+    return message.timestamp, message.message_id
+
+
+class ConversationSummarizer:
+    def __init__(
+        self,
+        summarize_func: Callable[
+            [Optional[str], List[DiscordMessage]], Awaitable[str]
+        ],
+        acquire_call_budget: Optional[Callable[[], Awaitable[None]]] = None,
+        max_unfolded_messages: int = 200,
+    ):
+        """
+        Rolling per-channel summaries of messages which left the context window.
+
+        Messages leave the window when they no longer fit the token budget, or when
+        they age out of the channel history between two contexts.
+
+        Args:
+            summarize_func: Async function folding messages into the previous summary
+            acquire_call_budget: Awaited before each summary so it counts against the
+                rate limit of the scheduler
+            max_unfolded_messages: Messages kept per channel while their fold is
+                pending, the oldest are dropped when summaries keep failing
+        """
+        self._summarize_func = summarize_func
+        self._acquire_call_budget = acquire_call_budget
+        self.max_unfolded_messages = max_unfolded_messages
+        self._summaries: Dict[int, str] = {}
+        # Bumped whenever the summary of a channel changes
+        self._versions: Dict[int, int] = {}
+        # Newest message folded into the summary of each channel
+        self._folded_until: Dict[int, MessageKey] = {}
+        # Messages seen in a history which are not folded yet
+        self._unfolded: Dict[int, Dict[MessageKey, DiscordMessage]] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def get_summary(self, channel_id: int) -> Optional[str]:
+        return self._summaries.get(channel_id)
+
+    def version(self, channel_id: int) -> int:
+        """
+        Get a number which changes whenever the summary of a channel changes.
+        """
+        return self._versions.get(channel_id, 0)
+
+    def fold(
+        self,
+        channel_id: int,
+        messages: List[DiscordMessage],
+        window: List[DiscordMessage],
+    ):
+        """
+        Fold the messages older than the window into the channel summary.
+
+        messages is the channel history the window was taken from. Messages seen
+        by an earlier call which are no longer in the history aged out of it and are
+        folded too. The summary is updated in the background, messages already
+        folded are skipped.
+        """
+        folded_until = self._folded_until.get(channel_id)
+        unfolded = self._unfolded.setdefault(channel_id, {})
+        for message in messages:
+            if folded_until is None or _key(message) > folded_until:
+                # Later edits replace the message
+                unfolded[_key(message)] = message
+        if len(unfolded) > self.max_unfolded_messages:
+            keys = sorted(unfolded)
+            for key in keys[: len(keys) - self.max_unfolded_messages]:
+                del unfolded[key]
+
+        window_start = _key(window[0]) if window else None
+        new_messages = [
+            unfolded[key]
+            for key in sorted(unfolded)
+            if window_start is None or key < window_start
+        ]
+        if not new_messages:
+            return
+
+        task = self._tasks.get(channel_id)
+        if task is not None and not task.done():
+            # The next fold will pick these messages up
+            return
+
+        self._tasks[channel_id] = asyncio.create_task(
+            self._update_summary(channel_id, new_messages)
+        )
+
+    async def _update_summary(self, channel_id: int, messages: List[DiscordMessage]):
+        logger.debug(
+            "Folding %s messages into summary of channel: %s", len(messages), channel_id
+        )
+        try:
+            if self._acquire_call_budget is not None:
+                await self._acquire_call_budget()
+            summary = await self._summarize_func(
+                self._summaries.get(channel_id), messages
+            )
+        except Exception:
+            logger.exception("Failed to update summary of channel: %s", channel_id)
+            return
+
+        self._summaries[channel_id] = summary
+        self._versions[channel_id] = self.version(channel_id) + 1
+        folded_until = max(_key(x) for x in messages)
+        self._folded_until[channel_id] = folded_until
+        unfolded = self._unfolded.get(channel_id, {})
+        for key in [x for x in unfolded if x <= folded_until]:
+            del unfolded[key]
@@ -0,0 +1,86 @@
+from typing import Dict, Hashable, List, Optional, Tuple
+import math
+import time
+
+
+class TimingWheel:
+    def __init__(
+        self,
+        horizon_seconds: float,
+        tick_seconds: float = 1.0,
+        start_time: Optional[float] = None,
+    ):
+        """
+        Hashed timing wheel of key deadlines with O(1) scheduling and O(1) amortized
+        expiry.
+
+        A key can be rescheduled any number of times, only its latest deadline counts.
+        Superseded entries are dropped when the wheel passes their slot.
+
+        Args:
+            horizon_seconds: Typical distance of a deadline, the wheel has enough slots
+                to cover it in one rotation
+            tick_seconds: Resolution of the deadlines, keys expire up to one tick late
+            start_time: Current time on the clock of the deadlines, time.monotonic()
+                by default
+        """
+        self.tick_seconds = tick_seconds
+        self._num_slots = max(1, math.ceil(horizon_seconds / tick_seconds)) + 1
+        self._slots: List[List[Tuple[Hashable, float]]] = [
+            [] for _ in range(self._num_slots)
+        ]
+        self._deadlines: Dict[Hashable, float] = {}
+        if start_time is None:
+            start_time = time.monotonic()
+        # Last tick whose slot was collected
+        self._current_tick = self._tick(start_time) - 1
+
+    def _tick(self, timestamp: float) -> int:
+        return math.floor(timestamp / self.tick_seconds)
+
+    def schedule(self, key: Hashable, deadline: float):
+        """
+        Set the deadline of a key, replacing any earlier one.
+        """
+        self._deadlines[key] = deadline
+        # Deadlines in the past go in the next slot to be collected
+        tick = max(self._tick(deadline), self._current_tick + 1)
+        self._slots[tick % self._num_slots].append((key, deadline))
+
+    def cancel(self, key: Hashable):
+        self._deadlines.pop(key, None)
+
+    def expire(self, now: float) -> List[Hashable]:
+        """
+        Remove and return every key whose deadline is at or before now.
+        """
+        # Only ticks which are entirely in the past are collected
+        last_tick = self._tick(now) - 1
+        # A full rotation visits every slot, further ticks wouldn't find anything new
+        first_tick = max(self._current_tick + 1, last_tick - self._num_slots + 1)
+
+        expired = []
+        for tick in range(first_tick, last_tick + 1):
+            slot = self._slots[tick % self._num_slots]
+            if not slot:
+                continue
+            remaining = []
+            for key, deadline in slot:
+                if self._deadlines.get(key) != deadline:
+                    # Rescheduled or cancelled since
+                    continue
+                if deadline <= now:
+                    del self._deadlines[key]
+                    expired.append(key)
+                else:
+                    # Due in a later rotation
+                    remaining.append((key, deadline))
+            self._slots[tick % self._num_slots] = remaining
+        self._current_tick = max(self._current_tick, last_tick)
+        return expired
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._deadlines
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
@@ -0,0 +1,392 @@
+from abc import ABC, abstractmethod
+import heapq
+import itertools
+import random
+from typing import Callable, Dict, Hashable, Iterator, List, Optional, Tuple
+
+
+class WeightedIndex(ABC):
+    """
+    Storage for key weights used by the WeightedKeySampler.
+    """
+
+    @abstractmethod
+    def add(self, key: Hashable, weight: float) -> None:
+        """
+        Add weight to a key, inserting it if it doesn't exist.
+        """
+
+    @abstractmethod
+    def pop(self, key: Hashable) -> float:
+        """
+        Remove a key and return its weight.
+        """
+
+    @abstractmethod
+    def sample(self) -> Optional[Hashable]:
+        """
+        Select a key at random, weighted by its weight.
+        """
+
+    @abstractmethod
+    def least_weighted_key(self) -> Optional[Hashable]:
+        """
+        Get the key with the smallest weight.
+        """
+
+    def most_weighted_keys(self, n: int) -> List[Hashable]:
+        """
+        Get the n keys most likely to be sampled, most likely first. O(len) unless
+        the index keeps the keys ordered.
+        """
+        largest = heapq.nlargest(n, self.items(), key=lambda x: x[1])
+        return [key for key, _ in largest]
+
+    @abstractmethod
+    def clear(self) -> None:
+        pass
+
+    @abstractmethod
+    def items(self) -> Iterator[Tuple[Hashable, float]]:
+        pass
+
+    @abstractmethod
+    def __getitem__(self, key: Hashable) -> float:
+        pass
+
+    @abstractmethod
+    def __contains__(self, key: Hashable) -> bool:
+        pass
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    def __delitem__(self, key: Hashable) -> None:
+        self.pop(key)
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+
+class DictWeightedIndex(WeightedIndex):
+    """
+    Plain dictionary storage. Sampling and least weighted lookups are O(n).
+    """
+
+    def __init__(self):
+        self._weights: Dict[Hashable, float] = {}
+
+    def add(self, key: Hashable, weight: float) -> None:
+        self._weights[key] = self._weights.get(key, 0) + weight
+
+    def pop(self, key: Hashable) -> float:
+        return self._weights.pop(key)
+
+    def sample(self) -> Optional[Hashable]:
+        if not self._weights:
+            return None
+        keys, weights = zip(*self._weights.items())
+        return random.choices(keys, weights=weights, k=1)[0]
+
+    def least_weighted_key(self) -> Optional[Hashable]:
+        if not self._weights:
+            return None
+        return min(self._weights, key=self._weights.get)
+
+    def clear(self) -> None:
+        self._weights.clear()
+
+    def items(self) -> Iterator[Tuple[Hashable, float]]:
+        return iter(list(self._weights.items()))
+
+    def __getitem__(self, key: Hashable) -> float:
+        return self._weights[key]
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._weights
+
+    def __len__(self) -> int:
+        return len(self._weights)
+
+
+class FenwickWeightedIndex(WeightedIndex):
+    """
+    Fenwick (binary indexed) tree of weights for O(log n) sampling, with lazy
+    min and max heaps for O(log n) amortized least and most weighted lookups.
+    """
+
+    def __init__(self, initial_capacity: int = 64):
+        self._capacity = initial_capacity
+        self._tree: List[float] = [0.0] * (initial_capacity + 1)
+        self._weights: List[float] = [0.0] * (initial_capacity + 1)
+        self._slots: Dict[Hashable, int] = {}
+        self._keys: List[Optional[Hashable]] = [None] * (initial_capacity + 1)
+        self._free_slots: List[int] = []
+        self._next_slot = 1
+        self._total = 0.0
+        # Entries are (weight, tie breaker, key) and may be stale
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        # Same with negated weights
+        self._max_heap: List[Tuple[float, int, Hashable]] = []
+        self._counter = itertools.count()
+
+    def _update(self, slot: int, delta: float) -> None:
+        self._total += delta
+        while slot <= self._capacity:
+            self._tree[slot] += delta
+            slot += slot & -slot
+
+    def _grow(self) -> None:
+        """
+        Double the capacity and rebuild the tree in O(n).
+        """
+        self._capacity *= 2
+        self._weights.extend([0.0] * (self._capacity + 1 - len(self._weights)))
+        self._keys.extend([None] * (self._capacity + 1 - len(self._keys)))
+        self._tree = self._weights[:]
+        for slot in range(1, self._capacity + 1):
+            parent = slot + (slot & -slot)
+            if parent <= self._capacity:
+                self._tree[parent] += self._tree[slot]
+
+    def _allocate_slot(self, key: Hashable) -> int:
+        if self._free_slots:
+            slot = self._free_slots.pop()
+        else:
+            if self._next_slot > self._capacity:
+                self._grow()
+            slot = self._next_slot
+            self._next_slot += 1
+        self._slots[key] = slot
+        self._keys[slot] = key
+        return slot
+
+    def _push_heap(self, key: Hashable, weight: float) -> None:
+        heapq.heappush(self._heap, (weight, next(self._counter), key))
+        heapq.heappush(self._max_heap, (-weight, next(self._counter), key))
+        # Drop stale entries once they outnumber the live ones
+        if len(self._heap) > 2 * len(self._slots) + 64:
+            self._heap = [
+                (self._weights[self._slots[key]], next(self._counter), key)
+                for key in self._slots
+            ]
+            heapq.heapify(self._heap)
+        if len(self._max_heap) > 2 * len(self._slots) + 64:
+            self._max_heap = [
+                (-self._weights[self._slots[key]], next(self._counter), key)
+                for key in self._slots
+            ]
+            heapq.heapify(self._max_heap)
+
+    def _is_live(self, weight: float, key: Hashable) -> bool:
+        slot = self._slots.get(key)
+        return slot is not None and self._weights[slot] == weight
+
+    def add(self, key: Hashable, weight: float) -> None:
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._allocate_slot(key)
+        self._weights[slot] += weight
+        self._update(slot, weight)
+        self._push_heap(key, self._weights[slot])
+
+    def pop(self, key: Hashable) -> float:
+        slot = self._slots.pop(key)
+        weight = self._weights[slot]
+        self._update(slot, -weight)
+        self._weights[slot] = 0.0
+        self._keys[slot] = None
+        self._free_slots.append(slot)
+        if not self._slots:
+            # Reset to avoid accumulating floating point drift
+            self._total = 0.0
+            self._tree = [0.0] * (self._capacity + 1)
+        return weight
+
+    def _find_slot(self, target: float) -> int:
+        """
+        Find the first slot whose prefix sum exceeds the target.
+        """
+        slot = 0
+        step = 1 << self._capacity.bit_length()
+        while step:
+            next_slot = slot + step
+            if next_slot <= self._capacity and self._tree[next_slot] <= target:
+                slot = next_slot
+                target -= self._tree[next_slot]
+            step >>= 1
+        return slot + 1
+
+    def sample(self) -> Optional[Hashable]:
+        if not self._slots:
+            return None
+        slot = self._find_slot(random.random() * self._total)
+        key = self._keys[slot] if slot <= self._capacity else None
+        if key is None:
+            # Floating point drift pushed us past the last live slot
+            return self.least_weighted_key()
+        return key
+
+    def least_weighted_key(self) -> Optional[Hashable]:
+        while self._heap:
+            weight, _, key = self._heap[0]
+            if self._is_live(weight, key):
+                return key
+            heapq.heappop(self._heap)
+        return None
+
+    def most_weighted_keys(self, n: int) -> List[Hashable]:
+        """
+        O(n log n) amortized, the entries popped on the way are pushed back.
+        """
+        keys = []
+        live_entries = []
+        while self._max_heap and len(keys) < n:
+            entry = heapq.heappop(self._max_heap)
+            negated_weight, _, key = entry
+            # A key re-added with the same weight can have two live entries
+            if self._is_live(-negated_weight, key) and key not in keys:
+                keys.append(key)
+                live_entries.append(entry)
+        for entry in live_entries:
+            heapq.heappush(self._max_heap, entry)
+        return keys
+
+    def clear(self) -> None:
+        self.__init__(self._capacity)
+
+    def items(self) -> Iterator[Tuple[Hashable, float]]:
+        return iter([(key, self._weights[slot]) for key, slot in self._slots.items()])
+
+    def __getitem__(self, key: Hashable) -> float:
+        return self._weights[self._slots[key]]
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._slots
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+
+class LanedWeightedIndex(WeightedIndex):
+    """
+    Weights split into priority lanes which share sampling by stride scheduling.
+
+    A lane with share 4 is sampled four times as often as a lane with share 1 while
+    both have keys, and an idle lane doesn't bank credit. Within a lane keys are
+    sampled by weight. A key lives in one lane and moves up when it is added to a
+    lane earlier in lane_shares.
+    """
+
+    def __init__(
+        self,
+        lane_shares: Dict[Hashable, float],
+        index_factory: Callable[[], WeightedIndex] = FenwickWeightedIndex,
+    ):
+        self._lane_shares = dict(lane_shares)
+        self._priorities = {lane: i for i, lane in enumerate(lane_shares)}
+        self._lanes: Dict[Hashable, WeightedIndex] = {
+            lane: index_factory() for lane in lane_shares
+        }
+        self._key_lanes: Dict[Hashable, Hashable] = {}
+        # Virtual time of each lane, advanced by 1 / share whenever it is charged
+        self._passes: Dict[Hashable, float] = {lane: 0.0 for lane in lane_shares}
+        self.default_lane = next(iter(lane_shares))
+
+    def _active_lanes(self) -> List[Hashable]:
+        return [lane for lane, index in self._lanes.items() if index]
+
+    def add(
+        self, key: Hashable, weight: float, lane: Optional[Hashable] = None
+    ) -> None:
+        lane = lane if lane is not None else self.default_lane
+        current_lane = self._key_lanes.get(key)
+        if current_lane is not None and (
+            self._priorities[current_lane] <= self._priorities[lane]
+        ):
+            lane = current_lane
+        elif current_lane is not None:
+            # Promote the key with the weight it already has
+            weight += self._lanes[current_lane].pop(key)
+
+        if not self._lanes[lane]:
+            # A lane waking up starts at the current virtual time instead of catching up
+            active_passes = [self._passes[x] for x in self._active_lanes()]
+            if active_passes:
+                self._passes[lane] = max(self._passes[lane], min(active_passes))
+        self._lanes[lane].add(key, weight)
+        self._key_lanes[key] = lane
+
+    def lane(self, key: Hashable) -> Optional[Hashable]:
+        return self._key_lanes.get(key)
+
+    def higher_priority_lane(
+        self, lane: Optional[Hashable], other: Optional[Hashable]
+    ) -> Hashable:
+        lanes = [x for x in (lane, other) if x is not None] or [self.default_lane]
+        return min(lanes, key=self._priorities.get)
+
+    def charge(self, key: Hashable) -> None:
+        """
+        Account a sampled key against the share of its lane.
+        """
+        lane = self._key_lanes[key]
+        self._passes[lane] += 1 / self._lane_shares[lane]
+
+    def pop(self, key: Hashable) -> float:
+        return self._lanes[self._key_lanes.pop(key)].pop(key)
+
+    def sample(self) -> Optional[Hashable]:
+        active_lanes = self._active_lanes()
+        if not active_lanes:
+            return None
+        lane = min(active_lanes, key=lambda x: (self._passes[x], self._priorities[x]))
+        return self._lanes[lane].sample()
+
+    def most_weighted_keys(self, n: int) -> List[Hashable]:
+        """
+        Get the keys sample would most likely pick next, taking the heaviest keys of
+        each lane in the order stride scheduling picks the lanes.
+        """
+        candidates = {
+            lane: self._lanes[lane].most_weighted_keys(n)
+            for lane in self._active_lanes()
+        }
+        passes = {lane: self._passes[lane] for lane in candidates}
+        keys = []
+        while len(keys) < n and candidates:
+            lane = min(candidates, key=lambda x: (passes[x], self._priorities[x]))
+            keys.append(candidates[lane].pop(0))
+            passes[lane] += 1 / self._lane_shares[lane]
+            if not candidates[lane]:
+                del candidates[lane]
+        return keys
+
+    def least_weighted_key(self) -> Optional[Hashable]:
+        """
+        Get the least weighted key of the lowest priority lane with keys.
+        """
+        active_lanes = self._active_lanes()
+        if not active_lanes:
+            return None
+        return self._lanes[active_lanes[-1]].least_weighted_key()
+
+    def clear(self) -> None:
+        for index in self._lanes.values():
+            index.clear()
+        self._key_lanes.clear()
+
+    def items(self) -> Iterator[Tuple[Hashable, float]]:
+        return itertools.chain.from_iterable(
+            index.items() for index in self._lanes.values()
+        )
+
+    def __getitem__(self, key: Hashable) -> float:
+        return self._lanes[self._key_lanes[key]][key]
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._key_lanes
+
+    def __len__(self) -> int:
+        return len(self._key_lanes)
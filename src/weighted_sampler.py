@@ -1,7 +1,26 @@
 import asyncio
+import heapq
+import itertools
 import random
-from typing import Callable, Dict, Hashable, Optional, Coroutine
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Coroutine, Set, Tuple
 from collections import defaultdict
+from src.errors import BackoffError
+from src.metrics import metrics
+from src.log import get_logger
+from src.rate_limiter import AdaptiveTokenBucket
+from src.resilience import CircuitBreaker
+from src.timing_wheel import TimingWheel
+from src.weighted_index import (
+    FenwickWeightedIndex,
+    LanedWeightedIndex,
+    WeightedIndex,
+)
+
+logger = get_logger(__name__)
+
+# Samples drawn before giving up on the recency bias and taking the last one
+RECENCY_SAMPLING_ATTEMPTS = 16
 
 
 class WeightedKeySampler:
@@ -10,6 +29,19 @@ class WeightedKeySampler:
         sampling_interval: float,
         decay_chance_per_minute: float,
         output_func: Callable[[Hashable], Coroutine],
+        num_workers: int = 1,
+        index: Optional[WeightedIndex] = None,
+        rate_limiter: Optional[AdaptiveTokenBucket] = None,
+        base_backoff_seconds: float = 5,
+        max_backoff_seconds: float = 300,
+        deadline_seconds: Optional[float] = None,
+        recency_half_life_seconds: Optional[float] = None,
+        lane_shares: Optional[Dict[Hashable, float]] = None,
+        secondary_indexes: Optional[Dict[str, Callable[[Hashable], Hashable]]] = None,
+        group_by: Optional[str] = None,
+        group_output_func: Optional[Callable[[List[Hashable]], Coroutine]] = None,
+        max_group_size: int = 4,
+        circuit_breaker: Optional[CircuitBreaker] = None,
     ):
         """
         Initialize the weighted key sampler.
@@ -18,33 +50,320 @@ class WeightedKeySampler:
             sampling_interval: Time in seconds between sampling events
             output_func: Async function to call with the selected key when sampling
             decay_chance: Chance that the least weighted key will be removed from the sampler
+            num_workers: Number of workers calling output_func concurrently
+            index: Storage for the key weights, defaults to a FenwickWeightedIndex
+            rate_limiter: Sample when the limiter allows instead of every sampling_interval
+            base_backoff_seconds: First delay for a key whose output_func raised BackoffError
+            max_backoff_seconds: Cap for the exponential backoff of a key
+            deadline_seconds: Drop a key which wasn't sampled within this many seconds
+                of its last record
+            recency_half_life_seconds: Halve the chance of sampling a key for every
+                this many seconds since its last record
+            lane_shares: Priority lanes, highest first, with their share of the samples.
+                Replaces index with a LanedWeightedIndex
+            secondary_indexes: Name to a function deriving an attribute of a key, pending
+                keys can be looked up and cleared by that attribute in O(k)
+            group_by: Secondary index whose pending keys are taken together with the
+                sampled key, the group costs one sample and goes to group_output_func
+            max_group_size: Most keys taken in one group
+            circuit_breaker: Don't sample while it is open, keys keep their weight
         """
-        self._counts: Dict[Hashable, int] = defaultdict(int)
+        self._counts: WeightedIndex = (
+            index if index is not None else FenwickWeightedIndex()
+        )
+        self._laned_counts: Optional[LanedWeightedIndex] = None
+        if lane_shares is not None:
+            self._laned_counts = LanedWeightedIndex(lane_shares)
+            self._counts = self._laned_counts
+        # Lane of every pending key, also while it is held
+        self._key_lanes: Dict[Hashable, Hashable] = {}
+        self._secondary_key_funcs = secondary_indexes or {}
+        # Index name to attribute value to the pending keys with that value
+        self._secondary_indexes: Dict[str, Dict[Hashable, Set[Hashable]]] = {
+            name: defaultdict(set) for name in self._secondary_key_funcs
+        }
         self._sampling_interval = sampling_interval
         self._output_func = output_func
+        self._group_by = group_by
+        self._group_output_func = group_output_func
+        self._max_group_size = max_group_size
         self._lock = asyncio.Lock()
         self._should_stop = asyncio.Event()
         self.decay_chance_per_minute = decay_chance_per_minute
+        self._num_workers = num_workers
+        self._dispatch_queue: asyncio.Queue = asyncio.Queue()
+        self._in_flight: Set[Hashable] = set()
+        # Dispatched groups not finished yet, a group occupies one worker
+        self._busy_workers = 0
+        # Counts recorded while a key is in flight, merged back once it finishes
+        self._deferred_counts: Dict[Hashable, int] = defaultdict(int)
+        self._rate_limiter = rate_limiter
+        self._circuit_breaker = circuit_breaker
+        self._work_available = asyncio.Event()
+        self._base_backoff_seconds = base_backoff_seconds
+        self._max_backoff_seconds = max_backoff_seconds
+        self._backoff_failures: Dict[Hashable, int] = defaultdict(int)
+        # Keys held back after a failure, as (release time, tie breaker, key)
+        self._backoff_heap: List[Tuple[float, int, Hashable]] = []
+        self._backed_off_weights: Dict[Hashable, int] = {}
+        self._backoff_counter = itertools.count()
+        self._deadline_seconds = deadline_seconds
+        self._deadlines: Optional[TimingWheel] = None
+        if deadline_seconds is not None:
+            self._deadlines = TimingWheel(deadline_seconds)
+        self._recency_half_life_seconds = recency_half_life_seconds
+        # Key to the (first, last) time it was recorded since it was last output
+        self._request_times: Dict[Hashable, Tuple[float, float]] = {}
+        # First record of a key while it was in flight, pending after the output
+        self._deferred_first_requested: Dict[Hashable, float] = {}
 
-    async def record_key(self, key: Hashable) -> None:
+    async def record_key(self, key: Hashable, lane: Optional[Hashable] = None) -> None:
         """
         Record a call for the given key.
         Thread-safe method that can be called concurrently.
 
         Args:
             key: The hashable key to record
+            lane: Priority lane of the record when lane_shares are configured, a key
+                stays in the highest lane it was recorded in
         """
-        print("Recording key: ", key)
+        logger.debug("Recording key: %s", key)
+        now = time.monotonic()
         async with self._lock:
-            self._counts[key] += 1
+            if self._laned_counts is not None:
+                self._key_lanes[key] = self._laned_counts.higher_priority_lane(
+                    self._key_lanes.get(key), lane
+                )
+            if self._is_held(key):
+                self._deferred_counts[key] += 1
+            else:
+                self._add_count(key, 1)
+            if key in self._in_flight:
+                self._deferred_first_requested.setdefault(key, now)
+            if key not in self._request_times:
+                self._index_key(key)
+            first_requested, _ = self._request_times.get(key, (now, now))
+            self._request_times[key] = (first_requested, now)
+            if self._deadlines is not None:
+                self._deadlines.schedule(key, now + self._deadline_seconds)
+        self._work_available.set()
+
+    def _add_count(self, key: Hashable, weight: int) -> None:
+        if self._laned_counts is not None:
+            self._laned_counts.add(key, weight, self._key_lanes.get(key))
+        else:
+            self._counts.add(key, weight)
+
+    def lane(self, key: Hashable) -> Optional[Hashable]:
+        """
+        Get the priority lane of a pending key.
+        """
+        return self._key_lanes.get(key)
+
+    def request_times(self, key: Hashable) -> Optional[Tuple[float, float]]:
+        """
+        Get the monotonic (first, last) time a pending key was recorded.
+        """
+        return self._request_times.get(key)
+
+    def _is_held(self, key: Hashable) -> bool:
+        """
+        Keys in flight or backing off can't be sampled until they are released.
+        """
+        return key in self._in_flight or key in self._backed_off_weights
+
+    def _release(self, key: Hashable, weight: int) -> None:
+        """
+        Make a held key available for sampling again.
+        """
+        weight += self._deferred_counts.pop(key, 0)
+        if weight:
+            self._add_count(key, weight)
+            self._work_available.set()
+
+    def _index_key(self, key: Hashable) -> None:
+        for name, key_func in self._secondary_key_funcs.items():
+            self._secondary_indexes[name][key_func(key)].add(key)
+
+    def _unindex_key(self, key: Hashable) -> None:
+        for name, key_func in self._secondary_key_funcs.items():
+            index = self._secondary_indexes[name]
+            value = key_func(key)
+            keys = index.get(value)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                del index[value]
+
+    def _forget(self, key: Hashable) -> None:
+        """
+        Drop the request times and deadline of a key which is no longer pending.
+        """
+        if key in self._request_times:
+            self._unindex_key(key)
+        self._request_times.pop(key, None)
+        self._deferred_first_requested.pop(key, None)
+        self._key_lanes.pop(key, None)
+        if self._deadlines is not None:
+            self._deadlines.cancel(key)
+
+    def _output_done(self, key: Hashable) -> None:
+        """
+        Start the request times over from the records made while the key was in flight.
+        """
+        first_requested = self._deferred_first_requested.pop(key, None)
+        if first_requested is None:
+            self._forget(key)
+            return
+        _, last_requested = self._request_times[key]
+        self._request_times[key] = (first_requested, last_requested)
+
+    def _expire_stale_keys(self) -> None:
+        """
+        Drop keys whose deadline passed before they were sampled.
+        """
+        if self._deadlines is None:
+            return
+        now = time.monotonic()
+        for key in self._deadlines.expire(now):
+            if key in self._in_flight:
+                # Being handled right now, check again once it is released
+                self._deadlines.schedule(key, now)
+                continue
+            if key in self._counts:
+                del self._counts[key]
+            self._deferred_counts.pop(key, None)
+            self._backed_off_weights.pop(key, None)
+            self._backoff_failures.pop(key, None)
+            self._forget(key)
+            logger.info("Dropping stale key: %s", key)
+            metrics.increment("sampler_expired")
+
+    def _back_off(self, key: Hashable, weight: int, retry_after: Optional[float]):
+        """
+        Hold a failing key back with an exponential delay, other keys are unaffected.
+        """
+        self._backoff_failures[key] += 1
+        delay = min(
+            self._max_backoff_seconds,
+            self._base_backoff_seconds * 2 ** (self._backoff_failures[key] - 1),
+        )
+        delay = max(delay, retry_after or 0)
+        logger.info("Backing off key %s for %.1fs", key, delay)
+        self._backed_off_weights[key] = weight
+        heapq.heappush(
+            self._backoff_heap,
+            (time.monotonic() + delay, next(self._backoff_counter), key),
+        )
+
+    def _release_backed_off_keys(self) -> None:
+        now = time.monotonic()
+        while self._backoff_heap and self._backoff_heap[0][0] <= now:
+            _, _, key = heapq.heappop(self._backoff_heap)
+            weight = self._backed_off_weights.pop(key, None)
+            if weight is not None:
+                self._release(key, weight)
+
+    def _next_backoff_release_delay(self) -> Optional[float]:
+        if not self._backoff_heap:
+            return None
+        return max(0.0, self._backoff_heap[0][0] - time.monotonic())
+
+    def _clear_key(self, key: Hashable) -> None:
+        if key in self._counts:
+            del self._counts[key]
+        self._deferred_counts.pop(key, None)
+        self._backed_off_weights.pop(key, None)
+        self._backoff_failures.pop(key, None)
+        if key in self._in_flight:
+            # Forgotten once the output is done
+            self._deferred_first_requested.pop(key, None)
+        else:
+            self._forget(key)
 
     async def clear_count_for_key(self, key: Hashable) -> None:
         """
         Clear the count for the given key.
         """
         async with self._lock:
-            if key in self._counts:
-                del self._counts[key]
+            self._clear_key(key)
+
+    def keys_by(self, index_name: str, value: Hashable) -> List[Hashable]:
+        """
+        Get the pending keys whose secondary index attribute has the given value.
+        """
+        return list(self._secondary_indexes[index_name].get(value, ()))
+
+    async def clear_counts_by(self, index_name: str, value: Hashable) -> int:
+        """
+        Clear the counts of every key whose secondary index attribute has the value.
+
+        Returns the number of keys cleared.
+        """
+        async with self._lock:
+            keys = self.keys_by(index_name, value)
+            for key in keys:
+                self._clear_key(key)
+        return len(keys)
+
+    def snapshot(self) -> List[Tuple[Hashable, Optional[Hashable], int, float, float]]:
+        """
+        Get every pending key as (key, lane, weight, first record, last record), with
+        the record times on the monotonic clock. Keys in flight count as pending.
+        """
+        entries = []
+        for key, (first_requested, last_requested) in self._request_times.items():
+            weight = self.pending_weight(key)
+            if key in self._in_flight:
+                weight = max(weight, 1)
+            if weight:
+                entries.append(
+                    (key, self._key_lanes.get(key), weight, first_requested, last_requested)
+                )
+        return entries
+
+    async def restore_key(
+        self,
+        key: Hashable,
+        lane: Optional[Hashable],
+        weight: int,
+        first_requested: float,
+        last_requested: float,
+    ) -> None:
+        """
+        Add a key from a snapshot taken before a restart.
+        """
+        async with self._lock:
+            if self._laned_counts is not None:
+                self._key_lanes[key] = self._laned_counts.higher_priority_lane(
+                    self._key_lanes.get(key), lane
+                )
+            if key not in self._request_times:
+                self._index_key(key)
+            self._request_times[key] = (first_requested, last_requested)
+            if self._deadlines is not None:
+                self._deadlines.schedule(key, last_requested + self._deadline_seconds)
+            if self._is_held(key):
+                self._deferred_counts[key] += weight
+            else:
+                self._add_count(key, weight)
+        self._work_available.set()
+
+    def likely_keys(self, n: int) -> List[Hashable]:
+        """
+        Get the n sampleable keys most likely to be sampled next, most likely first.
+        """
+        return self._counts.most_weighted_keys(n)
+
+    def pending_weight(self, key: Hashable) -> int:
+        """
+        Get the weight of a key including the records held back while it is in flight
+        or backing off.
+        """
+        weight = self._counts[key] if key in self._counts else 0
+        weight += self._backed_off_weights.get(key, 0)
+        return weight + self._deferred_counts.get(key, 0)
 
     async def clear_counts(self) -> None:
         """
@@ -52,6 +371,14 @@ class WeightedKeySampler:
         """
         async with self._lock:
             self._counts.clear()
+            self._deferred_counts.clear()
+            self._backed_off_weights.clear()
+            self._backoff_heap.clear()
+            self._backoff_failures.clear()
+            self._deferred_first_requested.clear()
+            for key in list(self._request_times):
+                if key not in self._in_flight:
+                    self._forget(key)
 
     def __str__(self) -> str:
         string_list = []
@@ -63,9 +390,7 @@ class WeightedKeySampler:
         """
         Get the least weighted key in the sampler.
         """
-        if not self._counts:
-            return None
-        return min(self._counts, key=self._counts.get)
+        return self._counts.least_weighted_key()
 
     def _delete_least_weighted_key(self):
         """
@@ -74,65 +399,226 @@ class WeightedKeySampler:
         least_weighted_key = self._get_least_weighted_key()
         if least_weighted_key is not None:
             del self._counts[least_weighted_key]
+            self._forget(least_weighted_key)
+            metrics.increment("sampler_decay_evictions")
 
     def _should_decay(self) -> bool:
         """
         Decide if the least weighted key should be removed from the sampler.
         """
         if self.decay_chance_per_minute / self._samples_per_minute() > random.random():
-            print("Should decay")
+            logger.debug("Should decay")
             return True
         return False
 
     def _samples_per_minute(self) -> float:
         return 60 / self._sampling_interval
 
-    async def _sample_and_reset(self) -> None:
+    def _update_gauges(self) -> None:
+        metrics.set_gauge("sampler_queue_depth", len(self._counts))
+        metrics.set_gauge("sampler_in_flight", len(self._in_flight))
+        metrics.set_gauge("sampler_backed_off", len(self._backed_off_weights))
+
+    def _sample_key(self) -> Optional[Hashable]:
+        """
+        Select a key weighted by its count, biased toward recent records if configured.
+
+        The bias is applied by rejection sampling so the index never needs reweighting.
+        """
+        selected_key = self._counts.sample()
+        if self._recency_half_life_seconds is None:
+            return selected_key
+
+        now = time.monotonic()
+        for _ in range(RECENCY_SAMPLING_ATTEMPTS):
+            if selected_key is None:
+                return None
+            _, last_requested = self._request_times.get(selected_key, (now, now))
+            age = now - last_requested
+            if random.random() < 0.5 ** (age / self._recency_half_life_seconds):
+                return selected_key
+            selected_key = self._counts.sample()
+        return selected_key
+
+    def _workers_busy(self) -> bool:
+        return self._busy_workers >= self._num_workers
+
+    async def _sample_and_reset(self) -> bool:
         """
-        Randomly select a key weighted by its count, reset counts, and call output function.
+        Randomly select a key weighted by its count, reset its count, and hand it to a worker.
         This method is called periodically by the sampling task.
+
+        Returns whether a key was dispatched.
         """
+        self._update_gauges()
+        if self._workers_busy():
+            # Every worker is busy, keep the weights for the next tick
+            return False
+
         async with self._lock:
+            self._release_backed_off_keys()
+            self._expire_stale_keys()
             if self._should_decay():
                 self._delete_least_weighted_key()
 
-            items = list(self._counts.items())
-            if not items:
-                return
+            selected_key = self._sample_key()
+            if selected_key is None:
+                return False
 
-            keys, weights = zip(*items)
-            selected_key = random.choices(keys, weights=weights, k=1)[0]
+            if self._laned_counts is not None:
+                self._laned_counts.charge(selected_key)
+            entries = [(key, self._counts.pop(key)) for key in self._group(selected_key)]
+            self._in_flight.update(key for key, _ in entries)
+            self._busy_workers += 1
 
-            try:
-                await self._output_func(selected_key)
-            except TimeoutError:
-                print("TimeoutError from Claude ignored")
-                # Pretend it didn't happen
-                return
+        self._dispatch_queue.put_nowait(entries)
+        return True
+
+    def _group(self, key: Hashable) -> List[Hashable]:
+        """
+        Get the sampled key followed by the sampleable keys grouped with it.
+        """
+        if self._group_by is None:
+            return [key]
+        value = self._secondary_key_funcs[self._group_by](key)
+        companions = [
+            x
+            for x in self.keys_by(self._group_by, value)
+            if x != key and x in self._counts
+        ]
+        return [key, *companions[: self._max_group_size - 1]]
+
+    async def _output(self, keys: List[Hashable]) -> None:
+        if len(keys) == 1:
+            await self._output_func(keys[0])
+        else:
+            metrics.increment("sampler_grouped_keys", len(keys) - 1)
+            await self._group_output_func(keys)
+
+    async def _dispatch(self, entries: List[Tuple[Hashable, int]]) -> None:
+        """
+        Call the output function for the selected keys outside of the lock.
+        """
+        try:
+            await self._output([key for key, _ in entries])
+        except TimeoutError:
+            logger.warning("TimeoutError from Claude ignored")
+            # Pretend it didn't happen
+            async with self._lock:
+                for key, weight in entries:
+                    self._in_flight.discard(key)
+                    self._deferred_first_requested.pop(key, None)
+                    self._release(key, weight)
+            return
+        except BackoffError as e:
+            async with self._lock:
+                for key, weight in entries:
+                    self._in_flight.discard(key)
+                    self._deferred_first_requested.pop(key, None)
+                    self._back_off(key, weight, e.retry_after)
+            return
+        except asyncio.CancelledError:
+            # Shutting down, the keys are still pending
+            async with self._lock:
+                for key, weight in entries:
+                    self._in_flight.discard(key)
+                    self._deferred_first_requested.pop(key, None)
+                    self._release(key, weight)
+            raise
+        except BaseException:
+            async with self._lock:
+                for key, _ in entries:
+                    self._in_flight.discard(key)
+                    self._output_done(key)
+                    self._release(key, 0)
+            raise
+
+        async with self._lock:
+            for key, _ in entries:
+                self._backoff_failures.pop(key, None)
+                self._in_flight.discard(key)
+                self._output_done(key)
+                self._release(key, 0)
 
-            del self._counts[selected_key]
+    async def _worker(self) -> None:
+        """
+        Consume selected keys from the dispatch queue.
+        """
+        while True:
+            entries = await self._dispatch_queue.get()
+            try:
+                await self._dispatch(entries)
+            except Exception:
+                # Keep the worker alive for the next key
+                logger.exception(
+                    "Output function failed for keys: %s", [key for key, _ in entries]
+                )
+            finally:
+                self._dispatch_queue.task_done()
+                self._busy_workers -= 1
+                # A worker is free again
+                self._work_available.set()
 
     async def _sampling_loop(self) -> None:
         """
         Main loop for the sampling task.
         Performs weighted sampling at the specified interval.
         """
-        print("Starting sampling loop")
+        logger.info("Starting sampling loop")
         while self._running:
             await asyncio.sleep(self._sampling_interval)
             await self._sample_and_reset()
 
+    async def _wait_for_work(self) -> None:
+        """
+        Wait until there is a key to sample and a free worker to handle it.
+        """
+        while True:
+            async with self._lock:
+                self._release_backed_off_keys()
+                self._expire_stale_keys()
+                if self._should_stop.is_set():
+                    return
+                if self._counts and not self._workers_busy():
+                    return
+                self._work_available.clear()
+            try:
+                await asyncio.wait_for(
+                    self._work_available.wait(), self._next_backoff_release_delay()
+                )
+            except asyncio.TimeoutError:
+                pass
+
     async def run(self) -> None:
         """Main sampling loop - returns a coroutine for the caller to manage."""
         self._should_stop.clear()
+        workers = [
+            asyncio.create_task(self._worker()) for _ in range(self._num_workers)
+        ]
 
-        while not self._should_stop.is_set():
-            await asyncio.sleep(self._sampling_interval)
-            await self._sample_and_reset()
+        try:
+            while not self._should_stop.is_set():
+                if self._circuit_breaker is not None:
+                    await self._circuit_breaker.wait_until_allowed()
+                if self._rate_limiter is None:
+                    await asyncio.sleep(self._sampling_interval)
+                    await self._sample_and_reset()
+                    continue
+
+                await self._wait_for_work()
+                if self._should_stop.is_set():
+                    break
+                await self._rate_limiter.acquire()
+                if not await self._sample_and_reset():
+                    self._rate_limiter.refund()
+        finally:
+            for worker in workers:
+                worker.cancel()
 
     async def stop(self) -> None:
         """Signal the sampling loop to stop."""
         self._should_stop.set()
+        self._work_available.set()
 
     async def __aenter__(self):
         """Enable use as an async context manager"""
@@ -0,0 +1,52 @@
+from src.chat import AnthropicChat, StreamingPostProcessor
+from src.context import AnthropicContext
+import pytest
+
+MESSAGES = [
+    "*sighs* Bot: well... 5*3 is fifteen.",
+    "5*3 and *smiles*",
+    "Hi *waves* there. *nods* ok.",
+    "No italics here. Bot: just text!",
+    "Line one.\nLine *two*.\nLine 2*2.",
+]
+
+
+def _post_process(message: str, larping_allowed: bool = False) -> str:
+    # post_process doesn't use the API client
+    chat = AnthropicChat.__new__(AnthropicChat)
+    context = AnthropicContext([], "", larping_allowed=larping_allowed, name="Bot")
+    return chat.post_process(message, context)
+
+
+def _stream(message: str, step: int, larping_allowed: bool = False) -> str:
+    processor = StreamingPostProcessor(
+        lambda x: _post_process(x, larping_allowed),
+        larping_allowed,
+        max_chunk_length=2000,
+        min_chunk_length=1,
+    )
+    chunks = []
+    for i in range(0, len(message), step):
+        chunks += processor.feed(message[i : i + step])
+    chunks += processor.finish()
+    return " ".join(chunks)
+
+
+def test_odd_asterisks_keep_full_message():
+    assert _post_process("5*3 and *smiles*") == "5*3 and *smiles*"
+    assert _post_process("*sighs* Bot: well... 5*3 is fifteen.") == (
+        "*sighs*  well... 5*3 is fifteen."
+    )
+
+
+def test_even_asterisks_remove_italics():
+    assert _post_process("Hi *waves* there.") == "Hi  there."
+
+
+@pytest.mark.parametrize("message", MESSAGES)
+@pytest.mark.parametrize("step", [1, 4, 1000])
+@pytest.mark.parametrize("larping_allowed", [False, True])
+def test_streaming_matches_full_message(message, step, larping_allowed):
+    streamed = _stream(message, step, larping_allowed)
+    full = _post_process(message, larping_allowed)
+    assert streamed.split() == full.split()
@@ -0,0 +1,60 @@
+from src.chat_scheduler import AnthropicScheduler, DEFAULT_LANE_SHARES
+from src.messenger import AnthropicMessageHandler, MentionOrigin
+from src.personality import CustomPersonality
+import asyncio
+import pytest
+
+
+class _RecordingHandler(AnthropicMessageHandler):
+    def __init__(self):
+        self.messages = []
+
+    async def handle_anthropic_message(self, message):
+        self.messages.append(message)
+
+
+@pytest.mark.parametrize("lane_shares", [None, DEFAULT_LANE_SHARES])
+def test_bot_turn_cap_holds(lane_shares):
+    async def run():
+        scheduler = AnthropicScheduler(
+            calls_per_second=1,
+            decay_chance_per_minute=0,
+            lane_shares=lane_shares,
+            max_bot_turns_per_channel=2,
+        )
+        personalities = [
+            CustomPersonality(f"Bot {i}", "A test bot.", larping_allowed=False)
+            for i in range(4)
+        ]
+        handler = _RecordingHandler()
+        for personality in personalities:
+            scheduler.register_anthropic_message_handler(personality, handler)
+            await scheduler.request_anthropic_call(
+                personality, channel_id=1, origin=MentionOrigin.BOT
+            )
+        # Another mention of a pending call is the same turn
+        await scheduler.request_anthropic_call(
+            personalities[0], channel_id=1, origin=MentionOrigin.BOT
+        )
+        return await scheduler.pending_calls(1)
+
+    pending_calls = asyncio.run(run())
+    assert sorted(name for name, _ in pending_calls) == ["Bot 0", "Bot 1"]
+
+
+def test_human_mentions_are_not_capped():
+    async def run():
+        scheduler = AnthropicScheduler(
+            calls_per_second=1, decay_chance_per_minute=0, max_bot_turns_per_channel=1
+        )
+        for i in range(3):
+            personality = CustomPersonality(
+                f"Bot {i}", "A test bot.", larping_allowed=False
+            )
+            scheduler.register_anthropic_message_handler(
+                personality, _RecordingHandler()
+            )
+            await scheduler.request_anthropic_call(personality, channel_id=1)
+        return await scheduler.pending_calls(1)
+
+    assert len(asyncio.run(run())) == 3